@@ -0,0 +1,115 @@
+"""
+Scaling benchmark of data-parallel meta quantization on a single multi-core host.
+
+    python bench_distributed.py --ranks 1,2,4 --steps 50 -m ResNet56 -d CIFAR100 -meta MultiFC -bs 128
+
+Each configuration is launched with torchrun over gloo, the cores of the host being split evenly
+between the ranks (OMP_NUM_THREADS). Arguments that are not listed below are passed to the trainer
+of meta-quantize.py; batch_size is the global batch, so the work per step is the same for every
+number of ranks.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+import torch
+
+from meta_utils.trainer import get_parser, MetaQuantTrainer
+from utils import distributed as dist_utils
+
+
+def get_bench_parser():
+
+    parser = argparse.ArgumentParser(description='Distributed meta quantization benchmark', add_help=False)
+    parser.add_argument('--ranks', type=str, default='1,2,4', help='Comma separated numbers of ranks')
+    parser.add_argument('--steps', type=int, default=50, help='Number of timed training steps')
+    parser.add_argument('--warmup', type=int, default=5, help='Number of untimed training steps')
+    parser.add_argument('--output', type=str, default='./Results/bench-distributed.json')
+    parser.add_argument('--worker', action='store_true', default=False, help=argparse.SUPPRESS)
+    return parser
+
+
+def run_worker(bench_args, trainer_argv):
+    """One rank: time `steps` training steps after `warmup` steps, rank 0 writes the result"""
+    args = get_parser().parse_args(trainer_argv)
+    # Keep the records of real runs with the same configuration
+    args.exp_spec = 'bench-distributed' if args.exp_spec == '' else '%s-bench-distributed' % args.exp_spec
+    trainer = MetaQuantTrainer(args)
+    trainer.net.train()
+
+    data_iter = iter(trainer.train_loader)
+    n_steps = bench_args.warmup + bench_args.steps
+    if len(trainer.train_loader) < n_steps:
+        raise ValueError('Only %d steps per epoch, fewer than %d' % (len(trainer.train_loader), n_steps))
+
+    start_time = None
+    for batch_idx in range(n_steps):
+        if batch_idx == bench_args.warmup:
+            dist_utils.barrier()
+            trainer.phase_timer.reset()
+            start_time = time.time()
+        inputs, targets = next(data_iter)
+        if trainer.use_cuda:
+            inputs, targets = inputs.cuda(), targets.cuda()
+        trainer.train_step(0, batch_idx, inputs, targets, time.time())
+    dist_utils.barrier()
+    elapsed = time.time() - start_time
+
+    if trainer.is_main:
+        result = {
+            'ranks': trainer.world_size,
+            'threads_per_rank': torch.get_num_threads(),
+            'steps': bench_args.steps,
+            'batch_size': trainer.batch_size,
+            'step_time': elapsed / bench_args.steps,
+            'throughput': bench_args.steps * trainer.batch_size / elapsed,
+            'phases': dict(trainer.phase_timer.total),
+        }
+        with open(bench_args.output, 'w') as f:
+            json.dump(result, f, indent=1)
+        print('%d ranks: %.3fs / step, %.1f img/s' % (result['ranks'], result['step_time'], result['throughput']))
+    trainer.close()
+
+
+def launch(bench_args, trainer_argv):
+    """Run every configuration with torchrun and print the scaling table"""
+    n_cores = os.cpu_count()
+    output_dir = os.path.dirname(bench_args.output)
+    if output_dir != '' and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    results = []
+    for n_ranks in [int(n) for n in bench_args.ranks.split(',')]:
+        output = '%s-%d.json' % (os.path.splitext(bench_args.output)[0], n_ranks)
+        env = dict(os.environ, OMP_NUM_THREADS=str(max(1, n_cores // n_ranks)))
+        command = [sys.executable, '-m', 'torch.distributed.run', '--standalone', '--nproc_per_node=%d' % n_ranks,
+                   os.path.abspath(__file__), '--worker', '--steps', str(bench_args.steps),
+                   '--warmup', str(bench_args.warmup), '--output', output] + trainer_argv
+        print(' '.join(command))
+        subprocess.check_call(command, env=env)
+        with open(output) as f:
+            results.append(json.load(f))
+
+    base_throughput = results[0]['throughput'] * 1.0 / results[0]['ranks']
+    print('\n%6s %8s %12s %12s %10s %12s' % ('ranks', 'threads', 'step (s)', 'img/s', 'speedup', 'efficiency'))
+    for result in results:
+        speedup = result['throughput'] / results[0]['throughput']
+        efficiency = result['throughput'] / (base_throughput * result['ranks'])
+        print('%6d %8d %12.3f %12.1f %10.2f %11.1f%%' % (result['ranks'], result['threads_per_rank'],
+                                                      result['step_time'], result['throughput'],
+                                                      speedup, 100.0 * efficiency))
+    with open(bench_args.output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print('Saved to %s' % bench_args.output)
+
+
+if __name__ == '__main__':
+
+    bench_args, trainer_argv = get_bench_parser().parse_known_args()
+    if bench_args.worker:
+        run_worker(bench_args, trainer_argv)
+    else:
+        launch(bench_args, trainer_argv)
@@ -0,0 +1,240 @@
+"""
+CPU inference benchmark of meta-quantized ResNets in their evaluation and deployment forms.
+
+    python bench_inference.py --models ResNet20,ResNet56,ResNet18 --batch_sizes 1,32,128 --threads 1,4 \
+        --output ./Results/bench-inference.json [--previous ./Results/bench-inference-old.json]
+
+Variants (--variants), on random weights and inputs:
+    fp32         the network with its latent weights, no quantization (quantized_type None)
+    quantized    reference evaluation, the weights quantized on every forward (-q / -bw)
+    cached       fast evaluation of test(): weights quantized once, inference_mode, channels_last
+    folded       BN folded into the quantized convolutions (utils/deploy.py)
+    torchscript  the folded module scripted with torch.jit
+    onnx         the folded module exported to ONNX, run with onnxruntime (if installed)
+    int8         int8 network run by the quantized CPU kernels (utils/deploy.py)
+    packed       bit-packed file run by the XNOR / popcount engine (utils/binary_inference.py), binary
+                 activations whatever gVar.a32 is (timing only)
+The deployment variants only support some networks (CIFAR ResNets, 1-bit weights for packed, ...): the
+others are reported as skipped with the reason.
+
+Every configuration (model, variant, batch size, number of threads) is timed over --iters forwards
+after --warmup ones; the JSON output keeps the latency percentiles and images / s of each with the git
+commit, so that results of two commits can be compared with --previous.
+"""
+import os
+import json
+import time
+import platform
+import argparse
+import subprocess
+import tempfile
+
+import numpy as np
+import torch
+
+import utils.global_var as gVar
+from models_CIFAR.quantized_meta_resnet import build_meta_resnet
+from utils.quantize import prepare_fast_eval
+from utils.export import export_packed
+from utils.binary_inference import BinaryResNet
+from utils.deploy import fold_resnet, from_meta_resnet, quantize_int8, export_torchscript, export_onnx, \
+    ONNXForward, onnxruntime
+
+
+MODELS = {'ResNet20': 'CIFAR10', 'ResNet32': 'CIFAR10', 'ResNet44': 'CIFAR10', 'ResNet56': 'CIFAR100',
+          'ResNet110': 'CIFAR100', 'ResNet18': 'ImageNet'}
+INPUT_SIZES = {'CIFAR10': 32, 'CIFAR100': 32, 'ImageNet': 224}
+VARIANTS = ['fp32', 'quantized', 'cached', 'folded', 'torchscript', 'onnx', 'int8', 'packed']
+PERCENTILES = [50, 90, 99]
+
+
+def get_bench_parser():
+
+    parser = argparse.ArgumentParser(description='Inference benchmark of meta quantized networks')
+    parser.add_argument('--models', type=str, default='ResNet20,ResNet32,ResNet44,ResNet56,ResNet110,ResNet18',
+                        help='Comma separated models, among %s' % ', '.join(MODELS))
+    parser.add_argument('--variants', type=str, default=','.join(VARIANTS), help='Comma separated variants')
+    parser.add_argument('--quantize', '-q', type=str, default='dorefa', help='Quantization Method')
+    parser.add_argument('--bitW', '-bw', type=int, default=1, help='Quantization Bit')
+    parser.add_argument('--batch_sizes', type=str, default='1,32,128', help='Comma separated batch sizes')
+    parser.add_argument('--threads', type=str, default='1,%d' % os.cpu_count(), help='Comma separated thread counts')
+    parser.add_argument('--warmup', type=int, default=3, help='Number of untimed forwards')
+    parser.add_argument('--iters', type=int, default=20, help='Number of timed forwards')
+    parser.add_argument('--output', type=str, default='./Results/bench-inference.json')
+    parser.add_argument('--previous', type=str, default=None, help='JSON output of another commit to compare with')
+    return parser
+
+
+def git_commit():
+
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def time_forward(forward, inputs, n_warmup, n_iters):
+    """
+    :return: latencies of n_iters forwards (s)
+    """
+    with torch.no_grad():
+        for _ in range(n_warmup):
+            forward(inputs)
+        times = []
+        for _ in range(n_iters):
+            start_time = time.perf_counter()
+            forward(inputs)
+            times.append(time.perf_counter() - start_time)
+    return times
+
+
+class VariantBuilder(object):
+    """Forward functions of every variant of one network, built once and shared by the sweep"""
+
+    def __init__(self, net, args, input_size, workdir):
+        self.net = net.eval()
+        self.args = args
+        self.input_size = input_size
+        self.workdir = workdir
+        self.folded = None
+        self.built = dict()
+
+    def example_inputs(self, batch_size):
+        return torch.randn(batch_size, 3, self.input_size, self.input_size)
+
+    def get_folded(self):
+        if self.folded is None:
+            self.folded = fold_resnet(self.net, self.args.quantize)
+        return self.folded
+
+    def build(self, variant, n_threads):
+        """
+        :return: forward function and the transformation of its inputs
+        """
+        net, quantized_type = self.net, self.args.quantize
+        if variant in ['fp32', 'quantized']:
+            # Invalidate the cached quantized weights of 'cached', the reference path quantizes on every call
+            gVar.eval_version += 1
+            variant_type = None if variant == 'fp32' else quantized_type
+            return lambda x: net(x, variant_type), lambda x: x
+        elif variant == 'cached':
+            prepare_fast_eval(net, quantized_type)
+
+            def forward(x):
+                with torch.inference_mode():
+                    return net(x, quantized_type)
+            return forward, lambda x: x.contiguous(memory_format=torch.channels_last)
+        elif variant == 'onnx':
+            if onnxruntime is None:
+                raise ImportError('onnxruntime is not installed')
+            if 'onnx' not in self.built:
+                path = os.path.join(self.workdir, 'model.onnx')
+                export_onnx(self.get_folded(), path, self.example_inputs(1))
+                self.built['onnx'] = path
+            return ONNXForward(self.built['onnx'], n_threads=n_threads), lambda x: x
+
+        if variant not in self.built:
+            if variant == 'folded':
+                self.built[variant] = self.get_folded()
+            elif variant == 'torchscript':
+                self.built[variant] = export_torchscript(self.get_folded(), os.path.join(self.workdir, 'model.ts.pt'))
+            elif variant == 'int8':
+                calibration = [(self.example_inputs(32), None) for _ in range(2)]
+                self.built[variant] = quantize_int8(from_meta_resnet(net, quantized_type), calibration, n_batches=2)
+            elif variant == 'packed':
+                path = os.path.join(self.workdir, 'model.mqpack')
+                export_packed(net, path, quantized_type)
+                self.built[variant] = BinaryResNet(path, binary=True)
+            else:
+                raise NotImplementedError('Unknown variant %s' % variant)
+        return self.built[variant], lambda x: x
+
+
+def run(args):
+
+    models = args.models.split(',')
+    variants = args.variants.split(',')
+    batch_sizes = [int(n) for n in args.batch_sizes.split(',')]
+    thread_counts = [int(n) for n in args.threads.split(',')]
+    for name in models:
+        if name not in MODELS:
+            raise NotImplementedError('Model %s is not supported' % name)
+
+    results, skipped = [], []
+    for model_name in models:
+        dataset_name = MODELS[model_name]
+        torch.manual_seed(0)
+        net = build_meta_resnet(model_name, dataset_name, bitW=args.bitW)
+        with tempfile.TemporaryDirectory() as workdir:
+            builder = VariantBuilder(net, args, INPUT_SIZES[dataset_name], workdir)
+            for variant in variants:
+                for n_threads in thread_counts:
+                    torch.set_num_threads(n_threads)
+                    try:
+                        forward, transform = builder.build(variant, n_threads)
+                    except (NotImplementedError, ImportError, ValueError) as e:
+                        skipped.append({'model': model_name, 'variant': variant, 'reason': str(e)})
+                        print('%-10s %-12s skipped: %s' % (model_name, variant, e))
+                        break
+                    for batch_size in batch_sizes:
+                        inputs = transform(builder.example_inputs(batch_size))
+                        times = np.array(time_forward(forward, inputs, args.warmup, args.iters))
+                        result = {'model': model_name, 'dataset': dataset_name, 'variant': variant,
+                                  'batch_size': batch_size, 'threads': n_threads,
+                                  'mean_ms': 1e3 * float(times.mean()),
+                                  'images_per_s': batch_size / float(np.median(times))}
+                        for percentile in PERCENTILES:
+                            result['p%d_ms' % percentile] = 1e3 * float(np.percentile(times, percentile))
+                        results.append(result)
+                        print('%-10s %-12s bs %4d, %2d threads: p50 %9.2f ms, p90 %9.2f ms, p99 %9.2f ms, %9.1f img/s'
+                              % (model_name, variant, batch_size, n_threads, result['p50_ms'], result['p90_ms'],
+                                 result['p99_ms'], result['images_per_s']))
+
+    return {
+        'git_commit': git_commit(),
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'torch': torch.__version__,
+        'host': platform.node(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'quantize': args.quantize,
+        'bitW': args.bitW,
+        'a32': gVar.a32,
+        'warmup': args.warmup,
+        'iters': args.iters,
+        'results': results,
+        'skipped': skipped,
+    }
+
+
+def compare(report, previous):
+    """Print the ratio of the images / s of every configuration measured in both reports"""
+    key = lambda result: (result['model'], result['variant'], result['batch_size'], result['threads'])
+    before = {key(result): result for result in previous['results']}
+    print('\nImages / s against %s (%s)' % (previous['git_commit'], previous['time']))
+    print('%-10s %-12s %6s %8s %12s %12s %8s' % ('model', 'variant', 'bs', 'threads', 'before', 'after', 'ratio'))
+    for result in report['results']:
+        if key(result) not in before:
+            continue
+        old = before[key(result)]['images_per_s']
+        print('%-10s %-12s %6d %8d %12.1f %12.1f %8.2f' % (result['model'], result['variant'], result['batch_size'],
+                                                          result['threads'], old, result['images_per_s'],
+                                                          result['images_per_s'] / old))
+
+
+if __name__ == '__main__':
+
+    args = get_bench_parser().parse_args()
+    report = run(args)
+
+    output_dir = os.path.dirname(args.output)
+    if output_dir != '' and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print('Saved to %s' % args.output)
+
+    if args.previous is not None:
+        with open(args.previous) as f:
+            compare(report, json.load(f))
@@ -0,0 +1,84 @@
+"""
+Calibrate the activation scales of a meta-quantized network with quantized activations.
+
+    python calibrate.py -m ResNet20 -d CIFAR10 -q dorefa -bw 1 \
+        --checkpoint ./checkpoint/ResNet20-CIFAR10/<run>/trainer_checkpoint.pth --output resnet20-calibrated.pth
+
+--checkpoint is a state dict, a trainer checkpoint or an incremental checkpoint directory, trained with
+or without ActivationQuantizer (utils/quantize.py). The scale of every MetaQuantConv is fixed to the max
+of |x| over --n_batches training batches, so that the forward no longer reduces each input to its max.
+The calibrated state dict is written to --output and its test accuracy compared with the batch-max
+quantization of the same weights.
+"""
+import argparse
+
+import torch
+
+import utils.global_var as gVar
+from models_CIFAR.quantized_meta_resnet import build_meta_resnet
+from utils.dataset import get_dataloader
+from utils.export import load_model_state
+from utils.quantize import calibrate_activations, test
+
+
+def boolean_string(s):
+    if s not in {'False', 'True'}:
+        raise ValueError('Not a valid boolean string')
+    return s == 'True'
+
+
+def get_calibration_parser():
+
+    parser = argparse.ArgumentParser(description='Activation calibration of meta quantized networks')
+    parser.add_argument('--model', '-m', type=str, default='ResNet20', help='Model Arch')
+    parser.add_argument('--dataset', '-d', type=str, default='CIFAR10', help='Dataset')
+    parser.add_argument('--quantize', '-q', type=str, default='dorefa', help='Quantization Method')
+    parser.add_argument('--bitW', '-bw', type=int, default=1, help='Quantization Bit')
+    parser.add_argument('--checkpoint', type=str, required=True, help='State dict, trainer or incremental checkpoint')
+    parser.add_argument('--output', type=str, default=None, help='Output path, default <model>-<dataset>-calibrated.pth')
+    parser.add_argument('--per_channel', type=boolean_string, default='False', help='One scale per input channel')
+    parser.add_argument('--n_batches', type=int, default=10, help='Number of training batches used to calibrate')
+    parser.add_argument('--compare', type=boolean_string, default='True',
+                        help='Test accuracy of the calibrated scales against batch-max quantization')
+    return parser
+
+
+def build_network(args, act_quant, state_dict):
+
+    gVar.act_quant = act_quant
+    net = build_meta_resnet(args.model, args.dataset, bitW=args.bitW)
+    missing, unexpected = net.load_state_dict(state_dict, strict=False)
+    # Only the activation scales may differ between the checkpoint and the network
+    missing = [key for key in missing if '.act_quantizer.' not in key]
+    unexpected = [key for key in unexpected if '.act_quantizer.' not in key]
+    if len(missing) > 0 or len(unexpected) > 0:
+        raise RuntimeError('Checkpoint does not match %s: missing %s, unexpected %s' % (args.model, missing, unexpected))
+    return net
+
+
+if __name__ == '__main__':
+
+    args = get_calibration_parser().parse_args()
+    gVar.a32 = False
+    gVar.act_per_channel = args.per_channel
+    use_cuda = torch.cuda.is_available()
+    output = args.output if args.output is not None else '%s-%s-calibrated.pth' % (args.model, args.dataset)
+
+    state_dict = load_model_state(args.checkpoint)
+    net = build_network(args, 'calibrated', state_dict)
+    if use_cuda:
+        net.cuda()
+    n_quantizers = calibrate_activations(net, get_dataloader(args.dataset, 'train', 100), args.quantize,
+                                         n_batches=args.n_batches, use_cuda=use_cuda)
+    torch.save(net.state_dict(), output)
+    print('Calibrated %d activation scales on %d batches, written to %s' % (n_quantizers, args.n_batches, output))
+
+    if args.compare:
+        test_loader = get_dataloader(args.dataset, 'test', 100)
+        batch_net = build_network(args, 'batch', state_dict)
+        if use_cuda:
+            batch_net.cuda()
+        for name, model in [('batch max', batch_net), ('calibrated', net)]:
+            test_acc = test(model, quantized_type=args.quantize, test_loader=test_loader, use_cuda=use_cuda,
+                            dataset_name=args.dataset, fast=True)
+            print('%-12s test acc %s' % (name, test_acc))
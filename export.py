@@ -0,0 +1,157 @@
+"""
+Export a trained meta-quantized network for deployment.
+
+    python export.py --format packed -m ResNet20 -d CIFAR10 -q dorefa -bw 1 \
+        --checkpoint ./checkpoint/ResNet20-CIFAR10/<run>/trainer_checkpoint.pth --output resnet20.mqpack
+    python export.py --format int8 -m ResNet20 -d CIFAR10 -q dorefa -bw 4 --checkpoint ...
+    python export.py --format folded --baseline True -m ResNet20 -d CIFAR10 -q dorefa -bw 1 --checkpoint ...
+    python export.py --format onnx -m ResNet20 -d CIFAR10 -q dorefa -bw 1 --checkpoint ...
+
+--checkpoint is a state dict (e.g. a pretrain file), a trainer checkpoint or an incremental
+checkpoint directory.
+packed: 1 bit per quantized weight (see utils/export.py), reloaded through the memory-mapped loader
+    and checked against the trained network on test batches.
+int8: TorchScript of the int8 network run by the quantized CPU kernels (see utils/deploy.py), with
+    the test accuracy and the latency of a test batch against the trained network.
+folded: flattened inference module with BN folded into the quantized convolutions (see
+    utils/deploy.py), also for baseline networks (--baseline True), compared with the eval output
+    and the latency of the trained network.
+torchscript / onnx: the folded module scripted with torch.jit / exported to ONNX for serving, reloaded
+    (ONNX: with onnxruntime, if installed) and compared with the eval output and the CPU latency of the
+    trained network.
+"""
+import argparse
+
+import torch
+
+import utils.global_var as gVar
+from models_CIFAR.quantized_meta_resnet import build_meta_resnet
+from models_CIFAR.quantized_resnet import build_quantized_resnet
+from utils.dataset import get_dataloader
+from utils.export import load_model_state, export_packed, packed_size_report, PackedModel, compare_outputs
+from utils.deploy import from_meta_resnet, quantize_int8, forward_accuracy, fold_resnet, export_torchscript, \
+    export_onnx, ONNXForward, onnxruntime
+from utils.binary_inference import benchmark
+from utils.quantize import prepare_fast_eval
+
+
+EXTENSIONS = {'packed': 'mqpack', 'int8': 'int8.pt', 'folded': 'folded.pt', 'torchscript': 'ts.pt', 'onnx': 'onnx'}
+FOLDED_FORMATS = ['folded', 'torchscript', 'onnx']
+
+
+def boolean_string(s):
+    if s not in {'False', 'True'}:
+        raise ValueError('Not a valid boolean string')
+    return s == 'True'
+
+
+def get_export_parser():
+
+    parser = argparse.ArgumentParser(description='Export of meta quantized networks')
+    parser.add_argument('--model', '-m', type=str, default='ResNet20', help='Model Arch')
+    parser.add_argument('--dataset', '-d', type=str, default='CIFAR10', help='Dataset')
+    parser.add_argument('--quantize', '-q', type=str, default='dorefa', help='Quantization Method')
+    parser.add_argument('--bitW', '-bw', type=int, default=1, help='Quantization Bit')
+    parser.add_argument('--a32', type=boolean_string, nargs='?', const=True, default='True',
+                        help='Full-precision activations (gVar.a32), as in meta-quantize.py (a bare --a32 means True)')
+    parser.add_argument('--act_quant', type=str, default='batch', choices=['batch', 'ema', 'calibrated'],
+                        help='Activation scale of the trained network with --a32 False (see meta-quantize.py)')
+    parser.add_argument('--act_per_channel', type=boolean_string, default='False',
+                        help='One activation scale per input channel (--act_quant ema / calibrated)')
+    parser.add_argument('--baseline', type=boolean_string, default='False',
+                        help='Baseline quantized network of train_baseline_quant.py instead of a meta-quantized one')
+    parser.add_argument('--checkpoint', type=str, required=True, help='State dict, trainer or incremental checkpoint')
+    parser.add_argument('--format', type=str, default='packed', choices=list(EXTENSIONS), help='Export format')
+    parser.add_argument('--output', type=str, default=None, help='Output path, default <model>-<dataset>.<extension>')
+    parser.add_argument('--verify', type=boolean_string, default='True',
+                        help='Compare the exported model with the trained network on test batches')
+    parser.add_argument('--n_batches', type=int, default=10, help='Number of test batches used by --verify')
+    parser.add_argument('--calibration_batches', type=int, default=10,
+                        help='int8: number of training batches used to calibrate the activations')
+    parser.add_argument('--backend', type=str, default='fbgemm', choices=['fbgemm', 'qnnpack'],
+                        help='int8: quantized CPU kernels')
+    parser.add_argument('--opset', type=int, default=13, help='onnx: ONNX opset version')
+    return parser
+
+
+if __name__ == '__main__':
+
+    args = get_export_parser().parse_args()
+    gVar.a32 = args.a32
+    gVar.act_quant, gVar.act_per_channel = args.act_quant, args.act_per_channel
+    output = args.output if args.output is not None else '%s-%s.%s' % (args.model, args.dataset, EXTENSIONS[args.format])
+
+    if args.baseline:
+        if args.format not in FOLDED_FORMATS:
+            raise NotImplementedError('Only the %s exports support baseline networks' % ', '.join(FOLDED_FORMATS))
+        net = build_quantized_resnet(args.model, bitW=args.bitW)
+    else:
+        net = build_meta_resnet(args.model, args.dataset, bitW=args.bitW)
+    net.load_state_dict(load_model_state(args.checkpoint))
+    net.eval()
+
+    if args.format == 'packed':
+        export_packed(net, output, args.quantize,
+                      meta={'model': args.model, 'dataset': args.dataset, 'bitW': args.bitW})
+        print('Packed model written to %s' % output)
+        packed_size_report(net, output)
+
+        if args.verify:
+            reloaded = build_meta_resnet(args.model, args.dataset, bitW=args.bitW)
+            reloaded.load_state_dict(PackedModel(output).state_dict())
+            reloaded.eval()
+            test_loader = get_dataloader(args.dataset, 'test', 100)
+            max_diff, agreement = compare_outputs(lambda x: net(x, args.quantize), lambda x: reloaded(x, args.quantize),
+                                                  test_loader, n_batches=args.n_batches)
+            print('Reloaded packed model: max logit difference %.2e, same predictions on %.2f%% of %d batches'
+                  % (max_diff, 100.0 * agreement, args.n_batches))
+    elif args.format == 'int8':
+        deploy_net = from_meta_resnet(net, args.quantize)
+        int8_net = quantize_int8(deploy_net, get_dataloader(args.dataset, 'train', 100),
+                                 n_batches=args.calibration_batches, backend=args.backend)
+        torch.jit.save(torch.jit.script(int8_net), output)
+        print('int8 model (%s) written to %s' % (args.backend, output))
+
+        if args.verify:
+            prepare_fast_eval(net, args.quantize)
+            test_loader = get_dataloader(args.dataset, 'test', 100, shuffle=False)
+            inputs, _ = next(iter(test_loader))
+            results = []
+            for name, forward in [('trained network', lambda x: net(x, args.quantize)),
+                                  ('deploy fp32', deploy_net), ('int8 %s' % args.backend, int8_net)]:
+                accuracy = forward_accuracy(forward, test_loader, n_batches=args.n_batches)
+                latency, throughput = benchmark(forward, inputs)
+                results.append((name, accuracy, latency, throughput))
+            for name, accuracy, latency, throughput in results:
+                print('%-20s test acc %.2f%% (%d batches), %8.2f ms / batch of %d, %8.1f img/s, %.2fx'
+                      % (name, accuracy, args.n_batches, 1e3 * latency, inputs.shape[0], throughput,
+                         results[0][2] / latency))
+    elif args.format in FOLDED_FORMATS:
+        folded_net = fold_resnet(net, args.quantize)
+        test_loader = get_dataloader(args.dataset, 'test', 100, shuffle=False)
+        inputs, _ = next(iter(test_loader))
+        if args.format == 'folded':
+            torch.save(folded_net, output)
+            exported = folded_net
+        elif args.format == 'torchscript':
+            exported = export_torchscript(folded_net, output)
+        else:
+            export_onnx(folded_net, output, inputs, opset_version=args.opset)
+            exported = ONNXForward(output, n_threads=torch.get_num_threads()) if onnxruntime is not None else None
+        print('%s model written to %s' % (args.format, output))
+
+        if args.verify and exported is None:
+            print('onnxruntime is not installed, the ONNX model is not verified')
+        elif args.verify:
+            max_diff, agreement = compare_outputs(lambda x: net(x, args.quantize), exported, test_loader,
+                                                  n_batches=args.n_batches)
+            print('%s model: max logit difference %.2e, same predictions on %.2f%% of %d batches'
+                  % (args.format, max_diff, 100.0 * agreement, args.n_batches))
+            if not args.baseline:
+                prepare_fast_eval(net, args.quantize)
+            reference_latency, _ = benchmark(lambda x: net(x, args.quantize), inputs)
+            latency, throughput = benchmark(exported, inputs)
+            print('CPU latency of a batch of %d: %.2f ms -> %.2f ms (%.2fx), %.1f img/s'
+                  % (inputs.shape[0], 1e3 * reference_latency, 1e3 * latency, reference_latency / latency, throughput))
+    else:
+        raise ValueError('Unknown format %s' % args.format)
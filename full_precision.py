@@ -11,6 +11,7 @@ import torchvision
 import torchvision.transforms as transforms
 import torchvision.datasets as datasets
 from utils.train_tools import progress_bar, is_int, train, test
+from utils.profiling import StepProfiler
 
 imagenet_pca = {
     'eigval': np.asarray([0.2175, 0.0188, 0.0045]),
@@ -266,6 +267,8 @@ parser.add_argument('--optimizer', '-o', type=str, default='SGD', help='Optimize
 parser.add_argument('--adjust', '-ad', default='adaptive', type=str, help='Training strategy')
 parser.add_argument('--epoch', default=200, type=int, help='Max train epoch')
 parser.add_argument('--pretrain', '-pre', type=str, default=None, help='Test with pretrain')
+parser.add_argument('--profile-steps', '--profile_steps', dest='profile_steps', type=str, default='',
+                    help='Profile the training iterations START:END with torch.profiler, saved into save_root')
 args = parser.parse_args()
 
 # 数据预处理
@@ -416,11 +419,12 @@ if not pretrain:
     ascent_count = 0
     min_train_loss = 1e9
     max_training_epoch = args.epoch
+    profiler = StepProfiler(args.profile_steps, save_root, use_cuda=use_cuda)
 
     for epoch in range(start_epoch, start_epoch + max_training_epoch):
 
         print('Epoch: [%3d]' % epoch)
-        train_loss, train_acc = train(net, trainloader, optimizer, criterion, device)
+        train_loss, train_acc = train(net, trainloader, optimizer, criterion, device, _profiler=profiler)
         test_loss, test_acc = test(net, testloader, criterion, device)
 
         # Save checkpoint.
@@ -445,7 +449,7 @@ if not pretrain:
             else:
                 ascent_count += 1
 
-            print('Current Loss: %.3f [%.3f], ascent count: %d, best_test_acc: %d' % (train_loss, min_train_loss, ascent_count, best_test_acc))
+            print('Current Loss: %.3f [%.3f], ascent count: %d, best_test_acc: %.3f' % (train_loss, min_train_loss, ascent_count, best_test_acc))
 
             if ascent_count >= 10:
                 optimizer.param_groups[0]['lr'] *= 0.1
@@ -454,6 +458,9 @@ if not pretrain:
                     print('Learning rate has decreased by three orders of magnitude!')
                     break
 
+    profiler.close()
+    print('Best test acc: %.3f' % best_test_acc)
+
 else:
     test_loss, test_acc = test(net, testloader, criterion, device)
     print('Test Loss: ', test_loss, 'Test ACC: ', test_acc)
\ No newline at end of file
@@ -2,8 +2,13 @@
 Some helper function for meta inference
 """
 
+import inspect
+import functools
 import torch
+from torch.profiler import record_function
 from utils.miscellaneous import get_layer
+import utils.global_var as gVar
+from meta_utils.history import HistoryGradStore
 import numpy as np
 import pandas as pd
 import joypy
@@ -31,12 +36,42 @@ def draw_weight_distribution(net, epoch):
     plt.savefig('/root/bqqi/fscil/MetaQuant/visualization/without_decay/epoch%s-weight.pdf' % (str(epoch)))
 
 
-def meta_gradient_generation(meta_net, net, meta_method, meta_hidden_state_dict=None, fix_meta=False, momentum_dict=None, history_grad=None):
+def record_meta_method(func):
+    """
+    Label every call of a meta gradient generation function as '<function>/<meta_method>' in
+    torch.profiler traces, so that each meta method shows up by name
+    """
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        meta_method = signature.bind_partial(*args, **kwargs).arguments.get('meta_method')
+        with record_function('%s/%s' % (func.__name__, meta_method)):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def pad_to_patch(grad_in, patch_size=1):
+    """
+    Zero pad a (1, L, 1) gradient sequence to a multiple of patch_size, so that the segments
+    of consecutive steps in the history window never share a patch
+    """
+    n_pad = (-grad_in.shape[1]) % patch_size
+    if n_pad == 0:
+        return grad_in
+    return torch.cat((grad_in, grad_in.new_zeros(grad_in.shape[0], n_pad, grad_in.shape[2])), dim=1)
+
+
+@record_meta_method
+def meta_gradient_generation(meta_net, net, meta_method, meta_hidden_state_dict=None, fix_meta=False, momentum_dict=None, history_grad=None, patch_size=1, subsampler=None):
 
     meta_grad_dict = dict()
     new_meta_hidden_state_dict = dict()
     new_momentum_dict = dict()
     layer_name_list = net.layer_name_list # 这里把主网络的层名字都拿出来了
+    if history_grad is None:
+        history_grad = HistoryGradStore(length=5)
 
     for idx, layer_info in enumerate(layer_name_list):
 
@@ -71,11 +106,18 @@ def meta_gradient_generation(meta_net, net, meta_method, meta_hidden_state_dict=
             flatten_grad = grad.data.view(-1, 1)
             flatten_weight = pre_quantized_weight.data.view(-1, 1)
 
+            # Only a rotating subset of large layers goes through the meta net
+            sub_idx = subsampler.indices(layer_name, grad.numel(), grad.device) if subsampler is not None else None
+            meta_input = flatten_weight if sub_idx is None else flatten_weight[sub_idx]
+
             if fix_meta:
                 with torch.no_grad():
-                    meta_output = meta_net(flatten_weight)
+                    meta_output = meta_net(meta_input)
             else:
-                meta_output = meta_net(flatten_weight)
+                meta_output = meta_net(meta_input)
+
+            if subsampler is not None:
+                meta_output = subsampler.merge(layer_name, 'meta', meta_output, sub_idx).view(-1, 1)
 
             meta_grad = flatten_grad * meta_output
 
@@ -178,22 +220,12 @@ def meta_gradient_generation(meta_net, net, meta_method, meta_hidden_state_dict=
             
         elif meta_method in ['MetaMambaHistory', 'MetaS4History', 'MetaS5History']:
             
-            grad_in = grad.data.view(1, -1, 1) # (16, 3, 3, 3) ()
+            grad_in = pad_to_patch(grad.data.view(1, -1, 1), patch_size) # (16, 3, 3, 3) ()
             weight_in = pre_quantized_weight.data.view(1, -1, 16)
             
             b,l,d = grad_in.shape
             
-            if history_grad is not None and layer_name in history_grad:
-                his_grad = history_grad[layer_name]
-                # new_grad = 0.3 * his_grad + (1 - 0.3) * grad_in
-                if his_grad.shape[1]/l == 5:
-                    his_grad = torch.cat((his_grad[:,-l*4:,:], grad_in), 1)
-                else:
-                    his_grad = torch.cat((his_grad, grad_in), 1)
-            else:
-                his_grad = grad_in
-                
-            history_grad[layer_name] = his_grad
+            his_grad = history_grad.update(layer_name, grad_in)
 
             if fix_meta:
                 with torch.no_grad():
@@ -201,13 +233,13 @@ def meta_gradient_generation(meta_net, net, meta_method, meta_hidden_state_dict=
             else:
                 meta_output = meta_net(his_grad)
 
-            meta_output = meta_output[:, -grad_in.shape[1]:, :] #.unsqueeze(1)
+            meta_output = meta_output[:, -grad_in.shape[1]:, :][:, :grad.numel(), :] #.unsqueeze(1)
             # meta_grad = grad_in * meta_output
             meta_grad = meta_output
             
         elif meta_method in ['MetaMambaFusion', 'MetaS4Fusion', 'MetaS5Fusion']:
             
-            grad_in = grad.data.view(1, -1, 1) # (16, 3, 3, 3) ()
+            grad_in = pad_to_patch(grad.data.view(1, -1, 1), patch_size) # (16, 3, 3, 3) ()
             weight_in = pre_quantized_weight.data.view(1, -1, 16)
         
             b,l,d = grad_in.shape
@@ -220,17 +252,8 @@ def meta_gradient_generation(meta_net, net, meta_method, meta_hidden_state_dict=
             new_momentum = 0.3 * momentum + (1 - 0.3) * grad_in
             new_momentum_dict[layer_name] = new_momentum
             
-            if history_grad is not None and layer_name in history_grad:
-                his_grad = history_grad[layer_name]
-                # new_grad = 0.3 * his_grad + (1 - 0.3) * grad_in
-                if his_grad.shape[1]/l == 5:
-                    his_grad = torch.cat((his_grad[:,-l*4:,:], new_momentum), 1)
-                else:
-                    his_grad = torch.cat((his_grad, new_momentum), 1)
-            else:
-                his_grad = grad_in
-                
-            history_grad[layer_name] = his_grad
+            # The window starts with the raw gradient, the momentum is appended from the second step on
+            his_grad = history_grad.update(layer_name, new_momentum if layer_name in history_grad else grad_in)
 
             if fix_meta:
                 with torch.no_grad():
@@ -238,7 +261,7 @@ def meta_gradient_generation(meta_net, net, meta_method, meta_hidden_state_dict=
             else:
                 meta_output = meta_net(his_grad)
 
-            meta_output = meta_output[:, -grad_in.shape[1]:, :] #.unsqueeze(1)
+            meta_output = meta_output[:, -grad_in.shape[1]:, :][:, :grad.numel(), :] #.unsqueeze(1)
             # meta_grad = grad_in * meta_output
             meta_grad = meta_output
             
@@ -260,6 +283,7 @@ def meta_gradient_generation(meta_net, net, meta_method, meta_hidden_state_dict=
     return meta_grad_dict, new_meta_hidden_state_dict, new_momentum_dict, history_grad
 
 
+@record_meta_method
 def metassm_gradient_generation(meta_net, net, meta_method, history_grad=None, conv_state_dict=None, ssm_state_dict=None, s4_state_dict=None, fix_meta=False):
 
     meta_grad_dict = dict()
@@ -349,7 +373,7 @@ def metassm_gradient_generation(meta_net, net, meta_method, history_grad=None, c
                 s4_state = torch.stack(s4_state)
             else:
                 # s4_state = torch.zeros_like(grad_in).repeat(1, 1, 16).cuda()
-                s4_state = torch.zeros((1, 1, 16)).cuda()
+                s4_state = torch.zeros((1, meta_net.d_model, meta_net.d_state), device=grad_in.device)
 
             if fix_meta:
                 with torch.no_grad():
@@ -379,7 +403,8 @@ def metassm_gradient_generation(meta_net, net, meta_method, history_grad=None, c
     return meta_grad_dict, history_grad, new_conv_state_dict, new_ssm_state_dict, new_s4_state_dict
 
 
-def meta_fast_slow_gradient_generation(fast_meta_net, slow_meta_net, net, meta_method, history_grad=None, fix_meta=False, meta_hidden_state_dict=None, length=5):
+@record_meta_method
+def meta_fast_slow_gradient_generation(fast_meta_net, slow_meta_net, net, meta_method, history_grad=None, fix_meta=False, meta_hidden_state_dict=None, length=5, patch_size=1, subsampler=None):
     
     '''
     类似momentum这种具有历史信息的梯度被认为是slow grad使用SSM、LSTM建模；当前的梯度直接用FC进行建模
@@ -390,6 +415,8 @@ def meta_fast_slow_gradient_generation(fast_meta_net, slow_meta_net, net, meta_m
     new_meta_hidden_state_dict = dict()
 
     layer_name_list = net.layer_name_list # 这里把主网络的层名字都拿出来了
+    if history_grad is None:
+        history_grad = HistoryGradStore(length=length)
 
     for idx, layer_info in enumerate(layer_name_list):
 
@@ -411,49 +438,48 @@ def meta_fast_slow_gradient_generation(fast_meta_net, slow_meta_net, net, meta_m
 
             flatten_grad = grad.data.view(-1, 1)
             flatten_weight = pre_quantized_weight.data.view(-1, 1)
+
+            # Both meta nets only see a rotating subset of large layers, the same one for fast and slow
+            sub_idx = subsampler.indices(layer_name, grad.numel(), grad.device) if subsampler is not None else None
             
             # fast meta net
+            fast_meta_input = flatten_weight if sub_idx is None else flatten_weight[sub_idx]
             if fix_meta:
                 with torch.no_grad():
-                    fast_meta_output = fast_meta_net(flatten_weight)
+                    fast_meta_output = fast_meta_net(fast_meta_input)
             else:
-                fast_meta_output = fast_meta_net(flatten_weight)
+                fast_meta_output = fast_meta_net(fast_meta_input)
+
+            if subsampler is not None:
+                fast_meta_output = subsampler.merge(layer_name, 'fast', fast_meta_output, sub_idx).view(-1, 1)
             
             fast_meta_grad = flatten_grad * fast_meta_output
             
             # slow meta net
 
-            grad_in = grad.data.view(1, -1, 1)
+            grad_in = pad_to_patch(grad.data.view(1, -1, 1), patch_size)
             weight_in = pre_quantized_weight.data.view(1, -1, 1)
             
-            # padding_size = 200 - grad_in.shape[1] % 200
-            # padding_weight = torch.cat([grad_in, torch.zeros(1, padding_size, 1).cuda()], dim=1)
-            # grad_in = padding_weight.view(1, -1, 200) # 1, l, 200
-            
             b,l,d = grad_in.shape
             
-            if history_grad is not None and layer_name in history_grad:
-                his_grad = history_grad[layer_name]
-                # new_grad = 0.3 * his_grad + (1 - 0.3) * grad_in
-                if length == 1:
-                    his_grad = grad_in
-                elif his_grad.shape[1]/l == length:
-                    l_tmp = int(l*(length-1))
-                    his_grad = torch.cat((his_grad[:,-l_tmp:,:], grad_in), 1)
-                else:
-                    his_grad = torch.cat((his_grad, grad_in), 1)
-            else:
-                his_grad = grad_in
-                
-            history_grad[layer_name] = his_grad
+            his_grad = history_grad.update(layer_name, grad_in)
+            n_current = grad.numel()
+            if sub_idx is not None:
+                # Same subset in every step of the window, each step padded to whole patches
+                his_grad = pad_to_patch(his_grad.view(-1, l)[:, sub_idx].unsqueeze(2), patch_size)
+                l = his_grad.shape[1]
+                his_grad = his_grad.reshape(1, -1, 1)
+                n_current = sub_idx.numel()
+
             if fix_meta:
                 with torch.no_grad():
                     slow_meta_output = slow_meta_net(his_grad, idx)
             else:
                 slow_meta_output = slow_meta_net(his_grad, idx)
 
-            # slow_meta_output = slow_meta_output[:, -grad_in.shape[1]:, :].reshape(1, -1, 1)[:, :-padding_size, :]
-            slow_meta_output = slow_meta_output[:, -grad_in.shape[1]:, :].view(1, -1, 1)
+            slow_meta_output = slow_meta_output[:, -l:, :][:, :n_current, :].reshape(1, -1, 1)
+            if subsampler is not None:
+                slow_meta_output = subsampler.merge(layer_name, 'slow', slow_meta_output, sub_idx).view(1, -1, 1)
             # meta_grad = grad_in * slow_meta_output
             slow_meta_grad = slow_meta_output
             
@@ -509,22 +535,12 @@ def meta_fast_slow_gradient_generation(fast_meta_net, slow_meta_net, net, meta_m
             
             # Mamba as fast meta net
 
-            grad_in = grad.data.view(1, -1, 1)
+            grad_in = pad_to_patch(grad.data.view(1, -1, 1), patch_size)
             weight_in = pre_quantized_weight.data.view(1, -1, 1)
             
             b,l,d = grad_in.shape
             
-            if history_grad is not None and layer_name in history_grad:
-                his_grad = history_grad[layer_name]
-                # new_grad = 0.3 * his_grad + (1 - 0.3) * grad_in
-                if his_grad.shape[1]/l == 5:
-                    his_grad = torch.cat((his_grad[:,-l*4:,:], grad_in), 1)
-                else:
-                    his_grad = torch.cat((his_grad, grad_in), 1)
-            else:
-                his_grad = grad_in
-                
-            history_grad[layer_name] = his_grad
+            his_grad = history_grad.update(layer_name, grad_in)
 
             if fix_meta:
                 with torch.no_grad():
@@ -532,7 +548,7 @@ def meta_fast_slow_gradient_generation(fast_meta_net, slow_meta_net, net, meta_m
             else:
                 fast_meta_output = fast_meta_net(his_grad)
 
-            fast_meta_output = fast_meta_output[:, -grad_in.shape[1]:, :]
+            fast_meta_output = fast_meta_output[:, -grad_in.shape[1]:, :][:, :grad.numel(), :]
             # meta_grad = grad_in * slow_meta_output
             fast_meta_grad = fast_meta_output
             
@@ -557,12 +573,15 @@ def meta_fast_slow_gradient_generation(fast_meta_net, slow_meta_net, net, meta_m
 
     return fast_meta_grad_dict, slow_meta_grad_dict, history_grad, new_meta_hidden_state_dict
 
+@record_meta_method
 def meta_gradient_lora_generation(fast_meta_net, slow_meta_net, net, meta_method, history_grad=None, fix_meta=False, meta_hidden_state_dict=None):
     fast_meta_grad_dict = dict()
     slow_meta_grad_dict = dict()
     new_meta_hidden_state_dict = dict()
 
     layer_name_list = net.layer_name_list # 这里把主网络的层名字都拿出来了
+    if history_grad is None:
+        history_grad = HistoryGradStore(length=5)
 
     for idx, layer_info in enumerate(layer_name_list):
 
@@ -628,17 +647,7 @@ def meta_gradient_lora_generation(fast_meta_net, slow_meta_net, net, meta_method
             con_grad_in = torch.cat((grad_A_in, grad_B_in), dim=1)
             b,l,d = con_grad_in.shape
             
-            if history_grad is not None and layer_name in history_grad:
-                his_grad = history_grad[layer_name]
-                # new_grad = 0.3 * his_grad + (1 - 0.3) * grad_in
-                if his_grad.shape[1]/l == 5:
-                    his_grad = torch.cat((his_grad[:,-l*4:,:], con_grad_in), 1)
-                else:
-                    his_grad = torch.cat((his_grad, con_grad_in), 1)
-            else:
-                his_grad = con_grad_in
-                
-            history_grad[layer_name] = his_grad
+            his_grad = history_grad.update(layer_name, con_grad_in)
             
             if fix_meta:
                 with torch.no_grad():
@@ -671,12 +680,15 @@ def meta_gradient_lora_generation(fast_meta_net, slow_meta_net, net, meta_method
 
     return fast_meta_grad_dict, slow_meta_grad_dict, history_grad, new_meta_hidden_state_dict
 
-def dual_gradient_generation(meta_net, net, meta_method, history_grad=None, fix_meta=False):
+@record_meta_method
+def dual_gradient_generation(meta_net, net, meta_method, history_grad=None, fix_meta=False, patch_size=1):
     fast_meta_grad_dict = dict()
     slow_meta_grad_dict = dict()
     new_meta_hidden_state_dict = dict()
 
     layer_name_list = net.layer_name_list # 这里把主网络的层名字都拿出来了
+    if history_grad is None:
+        history_grad = HistoryGradStore(length=5)
 
     for idx, layer_info in enumerate(layer_name_list):
 
@@ -698,22 +710,12 @@ def dual_gradient_generation(meta_net, net, meta_method, history_grad=None, fix_
             
             flatten_grad = grad.data.view(-1, 1)
             flatten_weight = pre_quantized_weight.data.view(-1, 1)
-            grad_in = grad.data.view(1, -1, 1)
+            grad_in = pad_to_patch(grad.data.view(1, -1, 1), patch_size)
             weight_in = pre_quantized_weight.data.view(1, -1, 1)
             
             b,l,d = grad_in.shape
             
-            if history_grad is not None and layer_name in history_grad:
-                his_grad = history_grad[layer_name]
-                # new_grad = 0.3 * his_grad + (1 - 0.3) * grad_in
-                if his_grad.shape[1]/l == 5:
-                    his_grad = torch.cat((his_grad[:,-l*4:,:], grad_in), 1)
-                else:
-                    his_grad = torch.cat((his_grad, grad_in), 1)
-            else:
-                his_grad = grad_in
-                
-            history_grad[layer_name] = his_grad
+            his_grad = history_grad.update(layer_name, grad_in)
             
             if fix_meta:
                 with torch.no_grad():
@@ -721,7 +723,7 @@ def dual_gradient_generation(meta_net, net, meta_method, history_grad=None, fix_
             else:
                 slow_grad, fast_grad = meta_net(flatten_weight, his_grad)
                     
-            slow_meta_grad = slow_grad[:, -grad_in.shape[1]:, :]
+            slow_meta_grad = slow_grad[:, -grad_in.shape[1]:, :][:, :grad.numel(), :]
             fast_meta_grad = flatten_grad * fast_grad
 
         else:
@@ -741,6 +743,9 @@ def dual_gradient_generation(meta_net, net, meta_method, history_grad=None, fix_
     return fast_meta_grad_dict, slow_meta_grad_dict, history_grad, new_meta_hidden_state_dict
 
 def update_parameters(net, lr):
+    # Writes through .data do not bump the version counters of the weights: invalidate the cached
+    # quantized weights of the evaluation (MetaQuantConv.eval_key) explicitly
+    gVar.eval_version += 1
     for param in net.parameters():
         # if torch.sum(torch.abs(param.grad.data)) == 0:
         #     print('[Warning] Gradient is 0, missing assigned?')
@@ -0,0 +1,592 @@
+"""
+Storage of the gradient history fed to the slow meta network
+"""
+
+import os
+import mmap
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+
+STORAGE_DTYPES = {
+    'fp32': torch.float32,
+    'fp16': torch.float16,
+    'bf16': torch.bfloat16,
+    'int8': torch.int8,
+}
+
+
+class HistoryGradStore(object):
+    """
+    Per-layer ring buffer of the last `length` gradients of every layer.
+
+    Older steps are kept in reduced precision (fp16 / bf16, or int8 with one symmetric scale per
+    layer and step) and decompressed to fp32 on the fly when the window is built. The newest step
+    is always the exact fp32 gradient, so the slow meta network output taken from the last segment
+    is never computed on a compressed input.
+    """
+
+    def __init__(self, length=5, storage='fp32'):
+
+        if storage not in STORAGE_DTYPES:
+            raise NotImplementedError('History storage %s is not supported' % storage)
+
+        self.length = int(length)
+        self.storage = storage
+        self.dtype = STORAGE_DTYPES[storage]
+
+        self.buffers = dict()  # layer_name -> (length, l) tensor in storage dtype
+        self.scales = dict()  # layer_name -> (length, ) fp32 scales, int8 only
+        self.n_stored = dict()  # layer_name -> number of valid steps in the buffer
+        self.head = dict()  # layer_name -> slot to be written next
+
+    def __contains__(self, layer_name):
+        return layer_name in self.buffers
+
+    def __len__(self):
+        return len(self.buffers)
+
+    def keys(self):
+        return self.buffers.keys()
+
+    def _allocate(self, layer_name, n_elements, device):
+
+        self.buffers[layer_name] = torch.zeros([self.length, n_elements], dtype=self.dtype, device=device)
+        if self.storage == 'int8':
+            self.scales[layer_name] = torch.ones([self.length], dtype=torch.float32, device=device)
+        self.n_stored[layer_name] = 0
+        self.head[layer_name] = 0
+
+    def _compress(self, layer_name, slot, grad):
+
+        if self.storage == 'int8':
+            scale = grad.abs().max().clamp(min=1e-12) / 127.
+            self.scales[layer_name][slot] = scale
+            self.buffers[layer_name][slot] = torch.round(grad / scale).clamp_(-127, 127).to(torch.int8)
+        else:
+            self.buffers[layer_name][slot] = grad.to(self.dtype)
+
+    def _decompress(self, layer_name, slot):
+
+        payload = self.buffers[layer_name][slot]
+        if self.storage == 'int8':
+            return payload.float() * self.scales[layer_name][slot]
+        return payload.float()
+
+    def _ordered_slots(self, layer_name):
+        """Slots of the valid steps, oldest first"""
+        n_stored = self.n_stored[layer_name]
+        head = self.head[layer_name]
+        return [(head - n_stored + i) % self.length for i in range(n_stored)]
+
+    def update(self, layer_name, grad_in):
+        """
+        Push the gradient of the current step and return the history window
+        :param layer_name:
+        :param grad_in: (1, l, 1) gradient sequence of the current step
+        :return: (1, n * l, 1) fp32 window with the n <= length latest steps, oldest first
+        """
+        grad = grad_in.detach().reshape(-1)
+
+        if layer_name not in self.buffers or self.buffers[layer_name].shape[1] != grad.numel():
+            self._allocate(layer_name, grad.numel(), grad.device)
+
+        # Older steps are decompressed, the current one is used as is
+        previous = [self._decompress(layer_name, slot)
+                    for slot in self._ordered_slots(layer_name)[-(self.length - 1):]] if self.length > 1 else []
+        window = torch.cat(previous + [grad.float()], dim=0)
+
+        slot = self.head[layer_name]
+        self._compress(layer_name, slot, grad)
+        self.head[layer_name] = (slot + 1) % self.length
+        self.n_stored[layer_name] = min(self.n_stored[layer_name] + 1, self.length)
+
+        return window.view(1, -1, 1)
+
+    def memory_bytes(self):
+        """Bytes used by the stored history"""
+        n_bytes = sum(buf.numel() * buf.element_size() for buf in self.buffers.values())
+        n_bytes += sum(scale.numel() * scale.element_size() for scale in self.scales.values())
+        return n_bytes
+
+    def fp32_bytes(self):
+        """Bytes the same history takes in fp32"""
+        return sum(buf.numel() * 4 for buf in self.buffers.values())
+
+    def state_dict(self):
+        return {
+            'length': self.length,
+            'storage': self.storage,
+            'buffers': self.buffers,
+            'scales': self.scales,
+            'n_stored': self.n_stored,
+            'head': self.head,
+        }
+
+    def load_state_dict(self, state_dict):
+        self.length = state_dict['length']
+        self.storage = state_dict['storage']
+        self.dtype = STORAGE_DTYPES[self.storage]
+        self.buffers = dict(state_dict['buffers'])
+        self.scales = dict(state_dict['scales'])
+        self.n_stored = dict(state_dict['n_stored'])
+        self.head = dict(state_dict['head'])
+
+
+# numpy has no bfloat16: bf16 payloads are mapped as int16 and viewed back as torch.bfloat16
+MEMMAP_NUMPY_DTYPES = {
+    'fp32': np.float32,
+    'fp16': np.float16,
+    'bf16': np.int16,
+    'int8': np.int8,
+}
+
+
+class MemmapHistoryGradStore(HistoryGradStore):
+    """
+    HistoryGradStore whose ring buffers live in one memory-mapped file per layer.
+
+    The OS pages the buffers in and out, so the resident memory of the history stays around one
+    layer window instead of the whole network. Layers are visited in the same order every step:
+    when a layer is done its pages are written back and dropped in a background thread, and the
+    layer that came next in the previous step is prefetched (madvise WILLNEED) meanwhile.
+    """
+
+    def __init__(self, length=5, storage='fp32', root=None, prefetch=True):
+
+        super(MemmapHistoryGradStore, self).__init__(length=length, storage=storage)
+
+        self.is_tmp_root = root is None
+        self.root = tempfile.mkdtemp(prefix='meta-history-') if root is None else root
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+
+        self.maps = dict()  # layer_name -> (file, mmap)
+        self.devices = dict()  # layer_name -> device of the gradient
+        self.layer_order = []  # layer names in visiting order
+        self.executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+
+    def _path(self, layer_name):
+        return os.path.join(self.root, '%s.bin' % layer_name)
+
+    def _release_map(self, layer_name):
+        if layer_name in self.maps:
+            f, mm = self.maps.pop(layer_name)
+            del self.buffers[layer_name]
+            mm.close()
+            f.close()
+
+    def _allocate(self, layer_name, n_elements, device):
+
+        self._release_map(layer_name)
+        np_dtype = MEMMAP_NUMPY_DTYPES[self.storage]
+        n_bytes = self.length * n_elements * np.dtype(np_dtype).itemsize
+
+        f = open(self._path(layer_name), 'w+b')
+        f.truncate(n_bytes)
+        mm = mmap.mmap(f.fileno(), n_bytes)
+        buffer = torch.from_numpy(np.frombuffer(mm, dtype=np_dtype).reshape(self.length, n_elements))
+        if self.storage == 'bf16':
+            buffer = buffer.view(torch.bfloat16)
+
+        self.maps[layer_name] = (f, mm)
+        self.buffers[layer_name] = buffer
+        if self.storage == 'int8':
+            self.scales[layer_name] = torch.ones([self.length], dtype=torch.float32)
+        self.n_stored[layer_name] = 0
+        self.head[layer_name] = 0
+        self.devices[layer_name] = device
+        if layer_name not in self.layer_order:
+            self.layer_order.append(layer_name)
+
+    def _compress(self, layer_name, slot, grad):
+        super(MemmapHistoryGradStore, self)._compress(layer_name, slot, grad.cpu())
+
+    def _decompress(self, layer_name, slot):
+        return super(MemmapHistoryGradStore, self)._decompress(layer_name, slot).to(self.devices[layer_name])
+
+    def _advise(self, layer_name, advice):
+        if layer_name not in self.maps:
+            return
+        mm = self.maps[layer_name][1]
+        try:
+            if advice == 'dontneed':
+                mm.flush()
+                mm.madvise(mmap.MADV_DONTNEED)
+            else:
+                mm.madvise(mmap.MADV_WILLNEED)
+        except (AttributeError, ValueError, OSError):
+            # madvise is not available on every platform / python version, paging still works without it
+            pass
+
+    def update(self, layer_name, grad_in):
+
+        window = super(MemmapHistoryGradStore, self).update(layer_name, grad_in)
+
+        if self.executor is not None:
+            self.executor.submit(self._advise, layer_name, 'dontneed')
+            next_idx = self.layer_order.index(layer_name) + 1
+            if next_idx < len(self.layer_order):
+                self.executor.submit(self._advise, self.layer_order[next_idx], 'willneed')
+
+        return window
+
+    def wait(self):
+        """Wait for the pending write back / prefetch"""
+        if self.executor is not None:
+            self.executor.submit(lambda: None).result()
+
+    def state_dict(self):
+        self.wait()
+        state_dict = super(MemmapHistoryGradStore, self).state_dict()
+        state_dict['buffers'] = {layer_name: buffer.clone() for layer_name, buffer in self.buffers.items()}
+        return state_dict
+
+    def load_state_dict(self, state_dict):
+        self.close(remove=False)
+        self.length = state_dict['length']
+        self.storage = state_dict['storage']
+        self.dtype = STORAGE_DTYPES[self.storage]
+        for layer_name, buffer in state_dict['buffers'].items():
+            self._allocate(layer_name, buffer.shape[1], buffer.device)
+            self.buffers[layer_name].copy_(buffer.cpu())
+        self.scales = {layer_name: scale.cpu() for layer_name, scale in state_dict['scales'].items()}
+        self.n_stored = dict(state_dict['n_stored'])
+        self.head = dict(state_dict['head'])
+
+    def close(self, remove=None):
+        self.wait()
+        for layer_name in list(self.maps.keys()):
+            self._release_map(layer_name)
+        if remove is None:
+            remove = self.is_tmp_root
+        if remove and os.path.exists(self.root):
+            shutil.rmtree(self.root)
+
+
+class HistorySummary(object):
+    """
+    Constant-size per-layer summary of the gradient history.
+
+    Each layer keeps `n_channels` running statistics of its gradient, updated in place every step.
+    The slow meta network is fed the channels followed by the exact current gradient, i.e. a
+    (1, (n_channels + 1) * l, 1) sequence whose length does not depend on --length.
+    """
+
+    mode = None
+
+    def __init__(self, n_channels, storage='fp32'):
+
+        if storage not in ['fp32', 'fp16', 'bf16']:
+            raise NotImplementedError('History summary storage %s is not supported' % storage)
+
+        self.n_channels = int(n_channels)
+        self.storage = storage
+        self.dtype = STORAGE_DTYPES[storage]
+
+        self.summaries = dict()  # layer_name -> (n_channels, l) tensor in storage dtype
+
+    def __contains__(self, layer_name):
+        return layer_name in self.summaries
+
+    def __len__(self):
+        return len(self.summaries)
+
+    def keys(self):
+        return self.summaries.keys()
+
+    def _init_summary(self, grad):
+        raise NotImplementedError
+
+    def _update_summary(self, summary, grad):
+        raise NotImplementedError
+
+    def update(self, layer_name, grad_in):
+        """
+        Fold the gradient of the current step into the summary and return the meta net input
+        :param layer_name:
+        :param grad_in: (1, l, 1) gradient sequence of the current step
+        :return: (1, (n_channels + 1) * l, 1) fp32 sequence, current gradient last
+        """
+        grad = grad_in.detach().reshape(-1).float()
+
+        if layer_name not in self.summaries or self.summaries[layer_name].shape[1] != grad.numel():
+            self.summaries[layer_name] = self._init_summary(grad).to(self.dtype)
+        else:
+            self._update_summary(self.summaries[layer_name], grad)
+
+        window = torch.cat([self.summaries[layer_name].float().reshape(-1), grad], dim=0)
+
+        return window.view(1, -1, 1)
+
+    def memory_bytes(self):
+        return sum(summary.numel() * summary.element_size() for summary in self.summaries.values())
+
+    def fp32_bytes(self):
+        return sum(summary.numel() * 4 for summary in self.summaries.values())
+
+    def state_dict(self):
+        return {
+            'n_channels': self.n_channels,
+            'storage': self.storage,
+            'summaries': self.summaries,
+        }
+
+    def load_state_dict(self, state_dict):
+        self.n_channels = state_dict['n_channels']
+        self.storage = state_dict['storage']
+        self.dtype = STORAGE_DTYPES[self.storage]
+        self.summaries = dict(state_dict['summaries'])
+
+
+class EMAHistorySummary(HistorySummary):
+    """
+    Several EMAs of the gradient with different decays, longest memory first.
+
+    Same update as the LSTMFC-momentum branch of meta_gradient_generation:
+    m = decay * m + (1 - decay) * g, initialized with the first gradient.
+    """
+
+    mode = 'ema'
+
+    def __init__(self, decays=(0.99, 0.9, 0.5), storage='fp32'):
+
+        super(EMAHistorySummary, self).__init__(n_channels=len(decays), storage=storage)
+        self.decays = sorted([float(decay) for decay in decays], reverse=True)
+        self._decay_cache = dict()  # (device, dtype) -> (n_channels, 1) decays
+
+    def _decay(self, summary):
+        key = (summary.device, summary.dtype)
+        if key not in self._decay_cache:
+            self._decay_cache[key] = torch.tensor(self.decays, device=summary.device, dtype=summary.dtype).view(-1, 1)
+        return self._decay_cache[key]
+
+    def _init_summary(self, grad):
+        return grad.unsqueeze(0).repeat(self.n_channels, 1)
+
+    def _update_summary(self, summary, grad):
+        decay = self._decay(summary)
+        summary.mul_(decay).add_((1 - decay) * grad.to(summary.dtype))
+
+    def state_dict(self):
+        state_dict = super(EMAHistorySummary, self).state_dict()
+        state_dict['decays'] = self.decays
+        return state_dict
+
+    def load_state_dict(self, state_dict):
+        super(EMAHistorySummary, self).load_state_dict(state_dict)
+        self.decays = state_dict['decays']
+        self._decay_cache = dict()
+
+
+class SketchHistorySummary(HistorySummary):
+    """
+    Random projection of the gradient history along the time axis.
+
+    Channel k accumulates s_k = decay * s_k + sqrt(1 - decay^2) * r_k * g with a fresh random sign
+    r_k per step, so inner products between the (decayed) histories of two elements are preserved
+    in expectation while the state stays at n_channels gradients per layer.
+    """
+
+    mode = 'sketch'
+
+    def __init__(self, n_channels=4, decay=0.9, storage='fp32', seed=0):
+
+        super(SketchHistorySummary, self).__init__(n_channels=n_channels, storage=storage)
+        self.decay = float(decay)
+        self.generator = torch.Generator()
+        self.generator.manual_seed(seed)
+
+    def _signs(self, grad):
+        signs = torch.randint(0, 2, [self.n_channels, 1], generator=self.generator).float() * 2 - 1
+        return signs.to(grad.device)
+
+    def _init_summary(self, grad):
+        return self._signs(grad) * grad.unsqueeze(0)
+
+    def _update_summary(self, summary, grad):
+        scale = (1 - self.decay ** 2) ** 0.5
+        summary.mul_(self.decay).add_((scale * self._signs(grad) * grad).to(summary.dtype))
+
+    def state_dict(self):
+        state_dict = super(SketchHistorySummary, self).state_dict()
+        state_dict['decay'] = self.decay
+        state_dict['generator'] = self.generator.get_state()
+        return state_dict
+
+    def load_state_dict(self, state_dict):
+        super(SketchHistorySummary, self).load_state_dict(state_dict)
+        self.decay = state_dict['decay']
+        self.generator.set_state(state_dict['generator'])
+
+
+def build_history(mode='window', length=5, storage='fp32', decays=(0.99, 0.9, 0.5), sketch_size=4, sketch_decay=0.9,
+                  backend='memory', root=None):
+
+    if mode == 'window':
+        if backend == 'mmap':
+            return MemmapHistoryGradStore(length=length, storage=storage, root=root)
+        elif backend != 'memory':
+            raise NotImplementedError('History backend %s is not supported' % backend)
+        return HistoryGradStore(length=length, storage=storage)
+    elif backend != 'memory':
+        raise NotImplementedError('History backend %s only supports --history_mode window' % backend)
+    elif mode == 'ema':
+        return EMAHistorySummary(decays=decays, storage=storage)
+    elif mode == 'sketch':
+        return SketchHistorySummary(n_channels=sketch_size, decay=sketch_decay, storage=storage)
+    else:
+        raise NotImplementedError('History mode %s is not supported' % mode)
+
+
+def print_history_memory(history_grad):
+
+    if not isinstance(history_grad, (HistoryGradStore, HistorySummary)) or len(history_grad) == 0:
+        return
+    n_bytes = history_grad.memory_bytes()
+    fp32_bytes = history_grad.fp32_bytes()
+    mode = 'window' if isinstance(history_grad, HistoryGradStore) else history_grad.mode
+    print('History gradient store [%s, %s]: %.2f MB (fp32: %.2f MB, saving %.1f%%)'
+          % (mode, history_grad.storage, n_bytes / 2 ** 20, fp32_bytes / 2 ** 20,
+             100.0 * (1 - float(n_bytes) / max(fp32_bytes, 1))))
+
+
+if __name__ == '__main__':
+
+    grad = torch.randn([1, 4608, 1])
+    for storage in ['fp32', 'fp16', 'bf16', 'int8']:
+        store = HistoryGradStore(length=5, storage=storage)
+        for step in range(7):
+            window = store.update('layer1.0.conv1', grad * (step + 1))
+        reference = torch.cat([grad * (step + 1) for step in range(2, 7)], dim=1)
+        print('%s: window %s, max abs error %.2e' % (storage, tuple(window.shape), (window - reference).abs().max().item()))
+        print_history_memory(store)
+
+    for store in [EMAHistorySummary(), SketchHistorySummary()]:
+        for step in range(7):
+            window = store.update('layer1.0.conv1', grad * (step + 1))
+        print('%s: window %s' % (store.mode, tuple(window.shape)))
+        print_history_memory(store)
+
+    # Bounded resident memory of the memory-mapped store, measured on real training steps of MetaQuantTrainer
+    # with a synthetic large model: 8 conv layers of 2.4M parameters (360 MB of fp32 history with length 5)
+    import time
+    import torch.nn as nn
+    import torch.nn.functional as F
+    from torch.utils.data import TensorDataset, DataLoader
+    import utils.global_var as gVar
+    from meta_utils.meta_quantized_module import MetaQuantConv
+    from meta_utils.trainer import MetaQuantTrainer, get_parser
+    # The trainer builds its store with meta_utils.history, not with the classes of this __main__ module
+    import meta_utils.history as history_module
+
+    def get_rss_mb():
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS'):
+                    return int(line.split()[1]) / 1024.
+        return 0.
+
+    class SyntheticNet(nn.Module):
+
+        def __init__(self, n_layers, channels, num_classes=10, bitW=1):
+            super(SyntheticNet, self).__init__()
+            self.convs = nn.ModuleList([MetaQuantConv(channels, channels, 3, padding=1, bias=False, bitW=bitW)
+                                        for _ in range(n_layers)])
+            self.fc = nn.Linear(channels, num_classes)
+            self.layer_name_list = [['convs.%d' % idx, ['convs', idx]] for idx in range(n_layers)]
+
+        def forward(self, x, quantized_type=None, meta_grad_dict=dict(), slow_grad_dict=None, lr=1e-3):
+            for (layer_name, _), conv in zip(self.layer_name_list, self.convs):
+                if layer_name in meta_grad_dict:
+                    slow_grad = None if slow_grad_dict is None else slow_grad_dict.get(layer_name)
+                    x = conv(x=x, quantized_type=quantized_type, meta_grad=meta_grad_dict[layer_name],
+                             slow_grad=slow_grad, lr=lr)
+                else:
+                    x = conv(x, quantized_type)
+                x = F.relu(x)
+            return self.fc(F.adaptive_avg_pool2d(x, 1).flatten(1))
+
+    class SyntheticTrainer(MetaQuantTrainer):
+
+        n_layers, channels = 8, 512
+
+        def build_network(self):
+            gVar.meta_count = 0
+            self.net = SyntheticNet(self.n_layers, self.channels, bitW=self.bitW)
+            self.layer_name_list = self.net.layer_name_list
+            assert (len(self.layer_name_list) == gVar.meta_count)
+            if self.use_cuda:
+                self.net.cuda()
+
+        def build_loaders(self):
+            inputs = torch.randn([16 * self.batch_size, self.channels, 4, 4])
+            targets = torch.randint(0, 10, [16 * self.batch_size])
+            self.train_loader = DataLoader(TensorDataset(inputs, targets), batch_size=self.batch_size)
+            self.test_loader = DataLoader(TensorDataset(inputs, targets), batch_size=100)
+
+    def train_rss(trainer, n_steps):
+        """Resident memory increase over training steps 2..n_steps, relative to the end of step 1"""
+        trainer.net.train()
+        data_iter = iter(trainer.train_loader)
+        base_rss, max_rss = 0., 0.
+        for batch_idx in range(n_steps):
+            inputs, targets = next(data_iter)
+            if trainer.use_cuda:
+                inputs, targets = inputs.cuda(), targets.cuda()
+            trainer.train_step(0, batch_idx, inputs, targets, time.time())
+            # Step 0 does not generate meta gradients: step 1 is the first one writing the history
+            if batch_idx == 1:
+                base_rss = get_rss_mb()
+            elif batch_idx > 1:
+                max_rss = max(max_rss, get_rss_mb() - base_rss)
+        return max_rss
+
+    work_dir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        length = 5
+        args = get_parser().parse_args(['--meta_type', 'MetaFastAndSlow', '--history_backend', 'mmap',
+                                        '--length', str(length), '--batch_size', '8', '--hidden_size', '8',
+                                        '--expand', '2', '--d_state', '4', '--meta_subsample', '1000000:8',
+                                        '--checkpoint_freq', '0', '--exp_spec', 'rss'])
+        trainer = SyntheticTrainer(args)
+        assert isinstance(trainer.history_grad, history_module.MemmapHistoryGradStore)
+        layer_mb = SyntheticTrainer.channels ** 2 * 9 * 4 / 2 ** 20
+        max_rss = train_rss(trainer, length + 2)
+        trainer.history_grad.wait()
+        history_mb = trainer.history_grad.fp32_bytes() / 2 ** 20
+        print('mmap: history %.0f MB on disk, max resident increase %.0f MB' % (history_mb, max_rss))
+        # Resident set is bounded by a few layer windows (current window + buffers being written back),
+        # the in-memory store would grow by (length - 1) windows of every layer
+        assert max_rss < 3 * (length + 1) * layer_mb, 'Resident memory of the history is not bounded'
+        trainer.close()
+
+        # The LSTM hidden state of MetaFastAndLSTM is not disk-backed, it stays in RAM: one (h, c) pair of
+        # hidden_size per weight. It is replaced at every step instead of accumulating, so the resident set stays flat
+        hidden_size = 20
+        SyntheticTrainer.n_layers, SyntheticTrainer.channels = 4, 64
+        args = get_parser().parse_args(['--meta_type', 'MetaFastAndLSTM', '--history_backend', 'mmap',
+                                        '--length', str(length), '--batch_size', '8', '--hidden_size', str(hidden_size),
+                                        '--checkpoint_freq', '0', '--exp_spec', 'rss'])
+        trainer = SyntheticTrainer(args)
+        n_elements = SyntheticTrainer.channels ** 2 * 9
+        max_rss = train_rss(trainer, length + 2)
+        hidden_mb = 2 * n_elements * hidden_size * 4 / 2 ** 20
+        for layer_name, _ in trainer.layer_name_list:
+            h, c = trainer.meta_hidden_state_dict[layer_name]
+            assert tuple(h.shape) == tuple(c.shape) == (1, n_elements, hidden_size)
+        print('LSTM: hidden state %.0f MB, max resident increase %.0f MB'
+              % (SyntheticTrainer.n_layers * hidden_mb, max_rss))
+        # Besides the hidden states of the current and the previous step of one layer, nothing accumulates
+        assert max_rss < 3 * hidden_mb + 3 * (length + 1) * n_elements * 4 / 2 ** 20, \
+            'Resident memory of the LSTM hidden state is not bounded'
+        trainer.close()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
@@ -21,10 +21,58 @@ from s5 import S5, S5Block
 meta_count = 0
 
 
+class GradPatchEmbedding(nn.Module):
+    """
+    Patch tokenization for sequence meta networks: group a flattened gradient sequence
+    (B, L, 1) into patches of patch_size elements and project every patch into one token,
+    (B, ceil(L / patch_size), d_model). The tail is zero padded when L is not divisible.
+    """
+
+    def __init__(self, patch_size, d_model):
+        super(GradPatchEmbedding, self).__init__()
+        self.patch_size = patch_size
+        self.proj = nn.Linear(patch_size, d_model)
+
+    def forward(self, x):
+
+        b, l, _ = x.shape
+        n_pad = (-l) % self.patch_size
+        if n_pad > 0:
+            x = F.pad(x, (0, 0, 0, n_pad))
+        x = x.reshape(b, -1, self.patch_size)
+
+        return self.proj(x), n_pad
+
+
+class GradPatchHead(nn.Module):
+    """
+    Inverse of GradPatchEmbedding: project every token back to patch_size elements and
+    drop the tail padding, (B, N, d_model) -> (B, N * patch_size - n_pad, 1)
+    """
+
+    def __init__(self, d_model, patch_size):
+        super(GradPatchHead, self).__init__()
+        self.patch_size = patch_size
+        self.proj = nn.Linear(d_model, patch_size)
+
+    def forward(self, x, n_pad=0):
+
+        b = x.shape[0]
+        x = self.proj(x).reshape(b, -1, 1)
+        if n_pad > 0:
+            x = x[:, :-n_pad, :]
+
+        return x
+
+
 class MetaDualGrad(nn.Module):
     
-    def __init__(self, d_model, d_state, d_conv, expand, hidden_size, use_nonlinear):
+    def __init__(self, d_model, d_state, d_conv, expand, hidden_size, use_nonlinear, patch_size=1):
         super(MetaDualGrad, self).__init__()
+        self.patch_size = patch_size
+        if patch_size > 1:
+            self.patch_embed = GradPatchEmbedding(patch_size, d_model)
+            self.patch_head = GradPatchHead(d_model, patch_size)
         self.slow_model = Mamba(d_model=d_model, d_state=d_state, d_conv=d_conv, expand=expand)
         self.fast_model = MetaMultiFC(hidden_size=hidden_size, use_nonlinear=use_nonlinear)
         
@@ -34,7 +82,11 @@ class MetaDualGrad(nn.Module):
         history_x: view(1, -1, 1) and cat( , 1)
         
         """
-        slow_grad = self.slow_model(history_x)
+        if self.patch_size > 1:
+            history_x, n_pad = self.patch_embed(history_x)
+            slow_grad = self.patch_head(self.slow_model(history_x), n_pad)
+        else:
+            slow_grad = self.slow_model(history_x)
         
         fast_grad = self.fast_model(x)
         
@@ -43,29 +95,48 @@ class MetaDualGrad(nn.Module):
 
 class MetaS5Block(nn.Module):
     
-    def __init__(self, d_input, dim, state_dim, bidir) -> None:
+    def __init__(self, d_input, dim, state_dim, bidir, patch_size=1) -> None:
         super(MetaS5Block, self).__init__()
-        self.in_linear = nn.Linear(d_input, dim, bias=False)
+        self.patch_size = patch_size
+        if patch_size > 1:
+            self.in_linear = GradPatchEmbedding(patch_size, dim)
+        else:
+            self.in_linear = nn.Linear(d_input, dim, bias=False)
         self.s5 = S5Block(
             dim=dim,
             state_dim=state_dim,
             bidir=bidir
         )
-        self.out_linear = nn.Linear(dim, d_input, bias=False)
+        if patch_size > 1:
+            self.out_linear = GradPatchHead(dim, patch_size)
+        else:
+            self.out_linear = nn.Linear(dim, d_input, bias=False)
         
     def forward(self, x):
-        x = self.in_linear(x)
+        if self.patch_size > 1:
+            x, n_pad = self.in_linear(x)
+        else:
+            x = self.in_linear(x)
         
         x = self.s5(x)
         
-        x = self.out_linear(x)
+        if self.patch_size > 1:
+            x = self.out_linear(x, n_pad)
+        else:
+            x = self.out_linear(x)
         
         return x
 
 class MetaS4(nn.Module):
     
-    def __init__(self, d_model, d_state, bidirectional=False, dropout=0.0, transposed=True, **s4_args) -> None:
+    def __init__(self, d_model, d_state, bidirectional=False, dropout=0.0, transposed=True, patch_size=1, **s4_args) -> None:
         super(MetaS4, self).__init__()
+        self.d_model = d_model
+        self.d_state = d_state
+        self.patch_size = patch_size
+        if patch_size > 1:
+            self.patch_embed = GradPatchEmbedding(patch_size, d_model)
+            self.patch_head = GradPatchHead(d_model, patch_size)
         self.s4 = S4(
             d_model=d_model,
             d_state=d_state,
@@ -80,7 +151,13 @@ class MetaS4(nn.Module):
         
     def forward(self, x, state):
         
-        y, next_state = self.s4.step(x, state)
+        if self.patch_size > 1:
+            # (n, 1) elements -> (n / patch_size, d_model) tokens stepped in parallel
+            x, n_pad = self.patch_embed(x.view(1, -1, 1))
+            y, next_state = self.s4.step(x.squeeze(0), state)
+            y = self.patch_head(y.unsqueeze(0), n_pad).view(-1, 1)
+        else:
+            y, next_state = self.s4.step(x, state)
         
         return y, next_state
     
@@ -94,14 +171,19 @@ class S4ModelHand(nn.Module):
         n_layers=1,
         dropout=0.2,
         prenorm=False,
+        patch_size=1,
         **s4_args,
     ):
         super().__init__()
 
         self.prenorm = prenorm
+        self.patch_size = patch_size
 
         # Linear encoder (d_input = 1 for grayscale and 3 for RGB)
-        self.encoder = nn.Linear(d_input, d_model)
+        if patch_size > 1:
+            self.encoder = GradPatchEmbedding(patch_size, d_model)
+        else:
+            self.encoder = nn.Linear(d_input, d_model)
 
         # Stack S4 layers as residual blocks
         self.s4_layers = nn.ModuleList()
@@ -114,13 +196,19 @@ class S4ModelHand(nn.Module):
             self.norms.append(nn.LayerNorm(d_model))
 
         # Linear decoder
-        self.decoder = nn.Linear(d_model, d_output)
+        if patch_size > 1:
+            self.decoder = GradPatchHead(d_model, patch_size)
+        else:
+            self.decoder = nn.Linear(d_model, d_output)
 
     def forward(self, x):
         """
         Input x is shape (B, L, d_input)
         """
-        x = self.encoder(x)  # (B, L, d_input) -> (B, L, d_model)
+        if self.patch_size > 1:
+            x, n_pad = self.encoder(x)  # (B, L, 1) -> (B, L / patch_size, d_model)
+        else:
+            x = self.encoder(x)  # (B, L, d_input) -> (B, L, d_model)
 
         x = x.transpose(-1, -2)  # (B, L, d_model) -> (B, d_model, L)
         for layer, norm in zip(self.s4_layers, self.norms):
@@ -150,7 +238,10 @@ class S4ModelHand(nn.Module):
         # x = x.mean(dim=1)
 
         # Decode the outputs
-        x = self.decoder(x)  # (B, d_model) -> (B, d_output)
+        if self.patch_size > 1:
+            x = self.decoder(x, n_pad)  # (B, L / patch_size, d_model) -> (B, L, 1)
+        else:
+            x = self.decoder(x)  # (B, d_model) -> (B, d_output)
 
         return x
     
@@ -213,10 +304,12 @@ class MetaMamba(nn.Module):
     
 class MetaMambaHistory(nn.Module):
     
-    def __init__(self, num_layers, d_model, d_state, d_conv, expand=4):
+    def __init__(self, num_layers, d_model, d_state, d_conv, expand=4, patch_size=1):
         super(MetaMambaHistory, self).__init__()
-        # self.A = nn.Linear(400, d_model)
-        # self.B = nn.Linear(d_model, 400)
+        self.patch_size = patch_size
+        if patch_size > 1:
+            self.patch_embed = GradPatchEmbedding(patch_size, d_model)
+            self.patch_head = GradPatchHead(d_model, patch_size)
         self.layer_embedding = nn.Embedding(num_layers, d_model)
         # self.layer_norm = nn.LayerNorm(1)
         # self.pre_map = nn.Sequential(nn.Linear(d_model, d_model*expand), nn.Tanh(), nn.Linear(d_model*expand, d_model), nn.Tanh())
@@ -229,15 +322,17 @@ class MetaMambaHistory(nn.Module):
         
         # x = self.layer_norm(x)
         
-        # x = self.A(x)
-        idx = torch.LongTensor([layer_idx]).unsqueeze(0).cuda()
+        if self.patch_size > 1:
+            x, n_pad = self.patch_embed(x)
+        idx = torch.LongTensor([layer_idx]).unsqueeze(0).to(x.device)
         layer_emb = self.layer_embedding(idx)
         x = torch.cat((layer_emb, x), dim=1)
         
         x = self.mamba(x)
         x = x[:,1:,:]
         
-        # x = self.B(x)
+        if self.patch_size > 1:
+            x = self.patch_head(x, n_pad)
         
         # x = x + res
         
@@ -246,39 +341,24 @@ class MetaMambaHistory(nn.Module):
         return x
     
     
-class MambaForImageNet(nn.Module):
+class MambaForImageNet(MetaMambaHistory):
+    """
+    MetaMambaHistory with a wide default patch (200 gradient elements per token) for the
+    large layers of ImageNet models
+    """
     
-    def __init__(self, num_layers, d_model, d_state, d_conv, expand=4):
-        super(MambaForImageNet, self).__init__()
-        self.A = nn.Linear(200, d_model)
-        self.B = nn.Linear(d_model, 200)
-        self.layer_embedding = nn.Embedding(num_layers, d_model)
-        # self.layer_norm = nn.LayerNorm(1)
-        # self.pre_map = nn.Sequential(nn.Linear(d_model, d_model*expand), nn.Tanh(), nn.Linear(d_model*expand, d_model), nn.Tanh())
-        self.mamba = Mamba(d_model=d_model, d_state=d_state, d_conv=d_conv, expand=expand)
-        # self.mamba_out = Mamba(d_model=d_model, d_state=d_state, d_conv=d_conv, expand=expand)
-        
-    def forward(self, x, layer_idx):
-        
-        # res = x
-        
-        # x = self.layer_norm(x)
-        
-        x = self.A(x)
-        idx = torch.LongTensor([layer_idx]).unsqueeze(0).cuda()
-        layer_emb = self.layer_embedding(idx)
-        x = torch.cat((layer_emb, x), dim=1)
-        
-        x = self.mamba(x)
-        x = x[:,1:,:]
-        
-        x = self.B(x)
-        
-        # x = x + res
-        
-        # x = self.mamba_out(x)
-        
-        return x
+    def __init__(self, num_layers, d_model, d_state, d_conv, expand=4, patch_size=200):
+        super(MambaForImageNet, self).__init__(num_layers, d_model, d_state, d_conv,
+                                               expand=expand, patch_size=patch_size)
+
+    # Checkpoints saved before the patch modules named the input / output projections A and B
+    LEGACY_KEYS = {'A.': 'patch_embed.proj.', 'B.': 'patch_head.proj.'}
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        for old, new in self.LEGACY_KEYS.items():
+            for key in [key for key in state_dict if key.startswith(prefix + old)]:
+                state_dict[prefix + new + key[len(prefix + old):]] = state_dict.pop(key)
+        super(MambaForImageNet, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
     
 
 class MetaLSTMFC(nn.Module):
@@ -568,6 +648,8 @@ class MetaLSTMLoRA(nn.Module):
         return x, (hn1, cn1)
 
 def update_parameters(net, lr):
+    # See meta_utils.helpers.update_parameters
+    gVar.eval_version += 1
     for param in net.parameters():
         param.data.add_(-lr * param.grad.data)
 
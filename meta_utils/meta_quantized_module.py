@@ -5,13 +5,22 @@ import torch.nn.functional as F
 import math
 import time
 
-from utils.quantize import Function_STE, Function_BWN
+from utils.quantize import Function_STE, Function_BWN, ActivationQuantizer
 from utils.miscellaneous import progress_bar, AverageMeter, accuracy
 import utils.global_var as gVar
 
 
+def captured_grad(previous, grad):
+    """Gradient kept by a hook: summed over micro-batches while gVar.accumulate_grads is set"""
+    if gVar.accumulate_grads and previous is not None:
+        return previous + grad
+    return grad
+
+
 class MetaQuantConv(nn.Module):
 
+    supports_eval_cache = True
+
     def __init__(self, in_channels, out_channels, kernel_size, stride=1,
                  padding=0, dilation=1, groups=1, bias=True, bitW = 2, layer_name=None, alpha=0.9):
         super(MetaQuantConv, self).__init__()
@@ -54,6 +63,17 @@ class MetaQuantConv(nn.Module):
         # Variable for BWN
         self.alpha = None
 
+        # (key, pre-quantized weight, quantized weight) of the current evaluation, see get_quantized_weight
+        self.eval_cache = None
+
+        # Tracked activation scale of quantized activations (gVar.a32 False); with gVar.act_quant 'batch'
+        # the max of every input is used (no state)
+        if gVar.a32 or gVar.act_quant == 'batch':
+            self.act_quantizer = None
+        else:
+            self.act_quantizer = ActivationQuantizer(bitW, in_channels, mode=gVar.act_quant,
+                                                     per_channel=gVar.act_per_channel, momentum=gVar.act_momentum)
+
         n = math.sqrt(kernel_size * kernel_size * out_channels)
         self.weight.data.uniform_(0, math.sqrt(2. / n))
         if self.bias is not None:
@@ -63,7 +83,7 @@ class MetaQuantConv(nn.Module):
 
     def save_quantized_grad(self):
         def hook(grad):
-            self.quantized_grads = grad
+            self.quantized_grads = captured_grad(self.quantized_grads, grad)
         return hook
 
     def save_pre_quantized_grad(self):
@@ -76,12 +96,53 @@ class MetaQuantConv(nn.Module):
             self.bias_grad = grad
         return hook
 
+    def eval_key(self, quantized_type):
+        return (gVar.eval_version, self.weight._version, quantized_type)
+
+    def get_quantized_weight(self, quantized_type, memory_format=torch.contiguous_format):
+        """
+        Quantized weight without meta gradient, computed once per evaluation (gVar.eval_version) and
+        reused by forward in eval mode
+        :return: pre-quantized weight and quantized weight
+        """
+        key = self.eval_key(quantized_type)
+        if self.eval_cache is None or self.eval_cache[0] != key:
+            with torch.no_grad():
+                if quantized_type == 'dorefa':
+                    temp_weight = torch.tanh(self.weight)
+                    pre_quantized_weight = (temp_weight / torch.max(torch.abs(temp_weight))) * 0.5 + 0.5
+                    quantized_weight = 2 * Function_STE.apply(pre_quantized_weight, self.bitW) - 1
+                elif quantized_type == 'BWN':
+                    pre_quantized_weight = self.weight * 1.0
+                    quantized_weight = Function_BWN.apply(pre_quantized_weight)
+                elif quantized_type == 'BWN-F':
+                    self.alpha = torch.abs(self.weight.data).mean(-1).mean(-1).mean(-1).view(-1, 1, 1, 1)
+                    pre_quantized_weight = self.weight * 1.0
+                    quantized_weight = self.alpha * Function_BWN.apply(pre_quantized_weight)
+                else:
+                    pre_quantized_weight = None
+                    quantized_weight = self.weight * 1.0
+                quantized_weight = quantized_weight.contiguous(memory_format=memory_format)
+            self.eval_cache = (key, pre_quantized_weight, quantized_weight)
+        return self.eval_cache[1], self.eval_cache[2]
+
     def forward(self, x, quantized_type = None, meta_grad = None, slow_grad = None, lr = 1e-3):
-        if not gVar.a32:
+        if not gVar.a32 and self.act_quantizer is not None:
+            x = self.act_quantizer(x)
+        elif not gVar.a32:
             # x = Function_BWN.apply(x)
             x = (x / torch.max(torch.abs(x))) * 0.5 + 0.5 # 预处理函数
             x = 2 * Function_STE.apply(x, self.bitW) - 1 # 量化函数
 
+        # Evaluation with the weight quantized once by get_quantized_weight: no calibration / meta work
+        if not self.training and meta_grad is None and self.eval_cache is not None \
+                and self.eval_cache[0] == self.eval_key(quantized_type):
+            if self.eval_cache[1] is not None:
+                self.pre_quantized_weight = self.eval_cache[1]
+            self.quantized_weight = self.eval_cache[2]
+            return F.conv2d(x, self.quantized_weight, self.bias, self.stride,
+                            self.padding, self.dilation, self.groups)
+
         # 校准
         if quantized_type == 'dorefa':
             self.calibration = 1 / (torch.max(torch.abs(torch.tanh(self.weight.data)))) \
@@ -154,6 +215,8 @@ class MetaQuantConv(nn.Module):
 
 class MetaQuantLinear(nn.Module):
 
+    supports_eval_cache = True
+
     def __init__(self, in_features, out_features, bias=True, bitW = 2, alpha=0.9):
         super(MetaQuantLinear, self).__init__()
 
@@ -188,6 +251,9 @@ class MetaQuantLinear(nn.Module):
         # Variable for BWN
         self.alpha = None
 
+        # (key, pre-quantized weight, quantized weight) of the current evaluation, see get_quantized_weight
+        self.eval_cache = None
+
         n = math.sqrt(self.out_features * self.in_features)
         self.weight.data.uniform_(0, math.sqrt(2. / n))
         if self.bias is not None:
@@ -204,7 +270,7 @@ class MetaQuantLinear(nn.Module):
 
     def save_quantized_grad(self):
         def hook(grad):
-            self.quantized_grads = grad
+            self.quantized_grads = captured_grad(self.quantized_grads, grad)
         return hook
     
     def save_bias_grad(self):
@@ -213,10 +279,43 @@ class MetaQuantLinear(nn.Module):
         return hook
 
 
+    def eval_key(self, quantized_type):
+        return (gVar.eval_version, self.weight._version, quantized_type)
+
+    def get_quantized_weight(self, quantized_type, memory_format=torch.contiguous_format):
+        """
+        Quantized weight without meta gradient, computed once per evaluation (gVar.eval_version) and
+        reused by forward in eval mode
+        :return: pre-quantized weight and quantized weight
+        """
+        key = self.eval_key(quantized_type)
+        if self.eval_cache is None or self.eval_cache[0] != key:
+            with torch.no_grad():
+                if quantized_type == 'dorefa':
+                    temp_weight = torch.tanh(self.weight)
+                    pre_quantized_weight = (temp_weight / torch.max(torch.abs(temp_weight))) * 0.5 + 0.5
+                    quantized_weight = 2 * Function_STE.apply(pre_quantized_weight, self.bitW) - 1
+                elif quantized_type in ['BWN', 'BWN-F']:
+                    pre_quantized_weight = self.weight * 1.0
+                    quantized_weight = Function_BWN.apply(pre_quantized_weight)
+                else:
+                    pre_quantized_weight = None
+                    quantized_weight = self.weight * 1.0
+            self.eval_cache = (key, pre_quantized_weight, quantized_weight)
+        return self.eval_cache[1], self.eval_cache[2]
+
     def forward(self, x, quantized_type = None, meta_grad = None, slow_grad = None, lr=1e-3):
         if not gVar.a32:
             x = Function_BWN.apply(x)
 
+        # Evaluation with the weight quantized once by get_quantized_weight: no calibration / meta work
+        if not self.training and meta_grad is None and self.eval_cache is not None \
+                and self.eval_cache[0] == self.eval_key(quantized_type):
+            if self.eval_cache[1] is not None:
+                self.pre_quantized_weight = self.eval_cache[1]
+            self.quantized_weight = self.eval_cache[2]
+            return F.linear(x, self.quantized_weight, self.bias)
+
         if quantized_type == 'dorefa':
             self.calibration = 1.0 / (torch.max(torch.abs(torch.tanh(self.weight.data))).detach()) \
                                * (1 - torch.pow(torch.tanh(self.weight.data), 2)).detach()
@@ -277,6 +376,8 @@ class MetaQuantLinear(nn.Module):
 
 
 class MetaQuantConvWithLoRA(MetaQuantConv):
+
+    supports_eval_cache = False
     
     @classmethod
     def from_object(cls, in_channels, out_channels, kernel_size, stride=1, padding=0, dilation=1, groups=1, bias=True, bitW=2, layer_name=None, rank=8, alpha_lora=16, in_obj:MetaQuantConv=None):
@@ -297,6 +398,7 @@ class MetaQuantConvWithLoRA(MetaQuantConv):
         
         self.A_grad = None
         self.B_grad = None
+        self.lora_hooks = None
         self.calibrated_grads_A = None
         self.calibrated_grads_B = None
         self.meta_A = None
@@ -306,12 +408,12 @@ class MetaQuantConvWithLoRA(MetaQuantConv):
 
     def save_A_grad(self):
         def hook(grad):
-            self.A_grad = grad
+            self.A_grad = captured_grad(self.A_grad, grad)
         return hook
     
     def save_B_grad(self):
         def hook(grad):
-            self.B_grad = grad
+            self.B_grad = captured_grad(self.B_grad, grad)
         return hook
         
     def forward(self, x, quantized_type = None, meta_grad = None, slow_grad = None, lr = 1e-3):
@@ -382,19 +484,19 @@ class MetaQuantConvWithLoRA(MetaQuantConv):
         else:
             self.quantized_weight = self.meta_weight * 1.0
 
-        try:
+        # A and B are parameters: their hooks are registered once, not at every forward
+        if self.lora_hooks is None:
             # self.quantized_weight.register_hook(self.save_quantized_grad())
-            self.A.register_hook(self.save_A_grad())
-            self.B.register_hook(self.save_B_grad())
+            self.lora_hooks = (self.A.register_hook(self.save_A_grad()), self.B.register_hook(self.save_B_grad()))
             # 在反向传播的时候，将self.quantized_weight的梯度传给self.save_quantized_grad()方法
-        except:
-            pass
 
         return F.conv2d(x, self.quantized_weight, self.meta_bias, self.stride,
                         self.padding, self.dilation, self.groups)
 
 
 class MetaQuantLinearWithLoRA(MetaQuantLinear):
+
+    supports_eval_cache = False
     
     @classmethod
     def from_object(cls, in_features, out_features, bias=True, bitW=2, rank=8, alpha_lora=16, in_obj:MetaQuantLinear=None):
@@ -424,12 +526,12 @@ class MetaQuantLinearWithLoRA(MetaQuantLinear):
         
     def save_A_grad(self):
         def hook(grad):
-            self.A_grad = grad
+            self.A_grad = captured_grad(self.A_grad, grad)
         return hook
     
     def save_B_grad(self):
         def hook(grad):
-            self.B_grad = grad
+            self.B_grad = captured_grad(self.B_grad, grad)
         return hook
         
     def forward(self, x, quantized_type = None, meta_grad = None, slow_grad = None, lr=1e-3):
@@ -0,0 +1,142 @@
+"""
+Subsampled evaluation of the meta networks on large layers
+"""
+
+import torch
+
+
+class MetaSubsampler(object):
+    """
+    Evaluate the meta networks on a rotating subset of the elements of large layers.
+
+    Layers are bucketed by size: a layer with at least `min_size` elements uses the period K of the
+    largest matching bucket, and each step only 1/K of its elements goes through the meta networks.
+    The subset rotates over a partition of the elements into K parts (strided: offset t % K,
+    random: chunks of a random permutation drawn once per layer) so that every element is refreshed
+    exactly once every K steps. The other elements reuse their last-known meta output. Layers below
+    every bucket are evaluated in full.
+    """
+
+    def __init__(self, buckets=None, mode='strided', seed=0):
+
+        if mode not in ['strided', 'random']:
+            raise NotImplementedError('Subsample mode %s is not supported' % mode)
+
+        if isinstance(buckets, str):
+            buckets = self.parse_buckets(buckets)
+        self.buckets = sorted(buckets or [])  # [(min_size, period)]
+        self.mode = mode
+        self.generator = torch.Generator()
+        self.generator.manual_seed(seed)
+
+        self.steps = dict()  # layer_name -> number of calls
+        self.perms = dict()  # layer_name -> random permutation of the elements, random mode only
+        self.cache = dict()  # (layer_name, key) -> last full meta output, detached
+
+        self.n_evaluated = 0
+        self.n_total = 0
+
+    @staticmethod
+    def parse_buckets(spec):
+        """'100000:4,1000000:8' -> [(100000, 4), (1000000, 8)]"""
+        buckets = []
+        for item in spec.split(','):
+            if item.strip() == '':
+                continue
+            min_size, period = item.split(':')
+            buckets.append((int(float(min_size)), int(period)))
+        return buckets
+
+    def period(self, n_elements):
+        period = 1
+        for min_size, bucket_period in self.buckets:
+            if n_elements >= min_size:
+                period = bucket_period
+        return period
+
+    def indices(self, layer_name, n_elements, device):
+        """
+        Elements of the layer to evaluate this step
+        :return: sorted LongTensor of indices, or None to evaluate every element
+        """
+        step = self.steps.get(layer_name, 0)
+        self.steps[layer_name] = step + 1
+        period = self.period(n_elements)
+        self.n_total += n_elements
+
+        # Full evaluation for small layers and to initialize the last-known outputs
+        if period <= 1 or step == 0:
+            self.n_evaluated += n_elements
+            return None
+
+        phase = step % period
+        if self.mode == 'strided':
+            idx = torch.arange(phase, n_elements, period)
+        else:
+            if layer_name not in self.perms or self.perms[layer_name].numel() != n_elements:
+                self.perms[layer_name] = torch.randperm(n_elements, generator=self.generator)
+            chunk = (n_elements + period - 1) // period
+            idx = self.perms[layer_name][phase * chunk: (phase + 1) * chunk].sort()[0]
+
+        self.n_evaluated += idx.numel()
+        return idx.to(device)
+
+    def merge(self, layer_name, key, output, idx):
+        """
+        Scatter the meta output of the evaluated subset into the last-known full output
+        :param key: name of the meta network, e.g. 'fast' / 'slow'
+        :param output: meta output of the subset (any shape with idx.numel() elements), or of every element
+        :return: flat meta output of every element, differentiable w.r.t. the subset output
+        """
+        output = output.reshape(-1)
+        cache_key = (layer_name, key)
+
+        if idx is None or cache_key not in self.cache:
+            full_output = output
+        else:
+            full_output = self.cache[cache_key].to(output.dtype).index_put((idx,), output)
+
+        self.cache[cache_key] = full_output.detach()
+        return full_output
+
+    def evaluated_ratio(self):
+        return float(self.n_evaluated) / max(self.n_total, 1)
+
+    def report(self, reset=True):
+        ratio = self.evaluated_ratio()
+        message = 'Meta subsample [%s]: evaluated %.1f%% of the elements (%.2fx fewer meta net evaluations)' \
+                  % (self.mode, 100.0 * ratio, 1.0 / max(ratio, 1e-12))
+        if reset:
+            self.n_evaluated = 0
+            self.n_total = 0
+        return message
+
+    def state_dict(self):
+        return {
+            'steps': self.steps,
+            'perms': self.perms,
+            'cache': self.cache,
+            'generator': self.generator.get_state(),
+        }
+
+    def load_state_dict(self, state_dict):
+        self.steps = dict(state_dict['steps'])
+        self.perms = dict(state_dict['perms'])
+        self.cache = dict(state_dict['cache'])
+        self.generator.set_state(state_dict['generator'])
+
+
+if __name__ == '__main__':
+
+    subsampler = MetaSubsampler('100000:4,1000000:8', mode='random')
+    for n_elements in [4608, 147456, 2359296]:
+        refreshed = torch.zeros(n_elements, dtype=torch.bool)
+        period = subsampler.period(n_elements)
+        for step in range(period + 1):
+            idx = subsampler.indices('layer', n_elements, 'cpu')
+            if step > 0:
+                refreshed[idx if idx is not None else slice(None)] = True
+        subsampler.steps.pop('layer')
+        print('%d elements: period %d, all refreshed within %d steps: %s'
+              % (n_elements, period, period, bool(refreshed.all())))
+    print(subsampler.report())
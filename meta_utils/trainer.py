@@ -0,0 +1,1107 @@
+"""
+Training engine of meta quantization, shared by meta-quantize.py and in-process experiments
+"""
+import os
+import json
+import shutil
+import time
+import argparse
+from tqdm import tqdm
+
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+import utils.global_var as gVar # 全局参数
+from utils.dataset import get_dataloader
+from utils.recorder import Recorder
+from utils.miscellaneous import accuracy, get_layer, PhaseTimer
+from utils.quantize import test, compare_eval_time, prepare_fast_eval, calibrate_activations
+from utils.profiling import StepProfiler
+from utils.async_eval import AsyncEvaluator
+from utils import distributed as dist_utils
+from utils.run_cache import RunCache, IGNORED_ARGS, SCHEDULE_ARGS, canonical_config, config_hash, file_digest
+from utils.checkpoint import AsyncCheckpointer, IncrementalCheckpointWriter, get_rng_state, set_rng_state
+from meta_utils.meta_network import MetaLSTMFC, MetaFC, MetaDesignedMultiFC, MetaMultiFC, MetaCNN, MetaTransformer, \
+    MetaMultiFCBN, MetaSimple, MetaLSTMLoRA, MetaMamba, MetaMambaHistory, MambaForImageNet, MetaS4, S4ModelHand, \
+    MetaS5Block, MetaDualGrad
+from meta_utils.SGD import SGD
+from meta_utils.adam import Adam
+from meta_utils.helpers import meta_gradient_generation, metassm_gradient_generation, \
+    meta_fast_slow_gradient_generation, meta_gradient_lora_generation, dual_gradient_generation, update_parameters
+from meta_utils.history import build_history, print_history_memory, MemmapHistoryGradStore
+from meta_utils.subsample import MetaSubsampler
+from meta_utils.meta_quantized_module import MetaQuantConvWithLoRA, MetaQuantLinearWithLoRA
+from models_CIFAR.quantized_meta_resnet import build_meta_resnet
+
+
+FAST_SLOW_METHODS = ['MetaFastAndSlow', 'MetaFastAndLSTM', 'MetaMambaAndFC']
+TRAIN_PHASES = ['data', 'meta_grad', 'forward', 'backward', 'all_reduce', 'meta_step', 'refine', 'update', 'record',
+                'test']
+
+
+def boolean_string(s):
+    if s not in {'False', 'True'}:
+        raise ValueError('Not a valid boolean string') # 不是有效的布尔字符串
+    return s == 'True'
+
+
+def print_best_test_acc(best_test_acc):
+
+    if type(best_test_acc) == tuple:
+        print('Best test top 1 acc: %.3f, top 5 acc: %.3f' % (best_test_acc[0], best_test_acc[1]))
+    else:
+        print('Best test acc: %.3f' %best_test_acc)
+
+
+def get_parser():
+
+    parser = argparse.ArgumentParser(description='Meta Quantization')
+    parser.add_argument('--model', '-m', type=str, default='ResNet20', help='Model Arch')
+    parser.add_argument('--dataset', '-d', type=str, default='CIFAR10', help='Dataset')
+    parser.add_argument('--optimizer', '-o', type=str, default='Adam', help='Optimizer Method')
+    parser.add_argument('--quantize', '-q', type=str, default='dorefa', help='Quantization Method')
+    parser.add_argument('--exp_spec', '-e', type=str, default='', help='Experiment Specification')
+    parser.add_argument('--init_lr', '-lr', type=float, default=1e-2, help='Initial Learning rate')
+    parser.add_argument('--bitW', '-bw', type=int, default=1, help='Quantization Bit')
+    parser.add_argument('--meta_type', '-meta', type=str, default='MultiFC', help='Type of Meta Network')
+    parser.add_argument('--hidden_size', '-hidden', type=int, default=100,
+                        help='Hidden size of meta network')
+    parser.add_argument('--num_fc', '-nfc', type=int, default=3,
+                        help='Number of layer of FC in MultiFC')
+    parser.add_argument('--num_lstm', '-nlstm', type=int, default=2,
+                        help='Number of layer of LSTM in MultiLSTMFC')
+    parser.add_argument('--n_epoch', '-n', type=int, default=100,
+                        help='Maximum training epochs')
+    parser.add_argument('--fix_meta', '-fix', type=boolean_string, default='False',
+                        help='Whether to fix meta')
+    parser.add_argument('--fix_meta_epoch', '-n_fix', type=int, default=0,
+                        help='When to fix meta')
+    parser.add_argument('--random', '-r', type=str, default=None,
+                        help='Whether to use random layer')
+    parser.add_argument('--meta_nonlinear', '-nonlinear', type=str, default=None,
+                        help='Nonlinear used in meta network')
+    parser.add_argument('--lr_adjust', '-ad', type=str,
+                        default='30', help='LR adjusting method')
+    parser.add_argument('--batch_size', '-bs', type=int, default=128, help='Batch size')
+    parser.add_argument('--weight_decay', '-decay', type=float, default=0,
+                        help='Weight decay for training meta quantizer')
+    parser.add_argument('--use_lora', action='store_true', default=False)
+    parser.add_argument('--checkpoint_dir', type=str, default='./checkpoint')
+    parser.add_argument('--break_continue', action='store_true', default=False,
+                        help='Resume exactly from the full-state checkpoint of the same configuration in checkpoint_dir')
+    parser.add_argument('--checkpoint_freq', type=int, default=1,
+                        help='Write a full-state checkpoint every N epochs in the background (0: never)')
+    parser.add_argument('--checkpoint_incremental', type=boolean_string, default='False',
+                        help='Only write the tensors changed since the last checkpoint (content-addressed blobs)')
+    parser.add_argument('--checkpoint_keep', type=int, default=3,
+                        help='Incremental checkpoints: keep the last N epochs plus the best one')
+    parser.add_argument('--checkpoint_compress', type=int, default=0,
+                        help='Incremental checkpoints: zlib level of the blobs (0: no compression)')
+    parser.add_argument('--checkpoint_downcast', type=str, default=None, choices=['fp16', 'bf16'],
+                        help='Incremental checkpoints: store float32 tensors in half precision (lossy)')
+    parser.add_argument('--a32', type=boolean_string, nargs='?', const=True, default='True',
+                        help='Full-precision activations (gVar.a32); False quantizes the inputs of the conv layers (a bare --a32 means True)')
+    parser.add_argument('--act_quant', type=str, default='batch', choices=['batch', 'ema', 'calibrated'],
+                        help='Activation scale when activations are quantized (gVar.a32 False): max of every batch, '
+                             'EMA tracked in training or calibrated once')
+    parser.add_argument('--act_per_channel', type=boolean_string, default='False',
+                        help='One activation scale per input channel (--act_quant ema / calibrated)')
+    parser.add_argument('--act_momentum', type=float, default=0.1, help='Momentum of --act_quant ema')
+    parser.add_argument('--act_calibration_batches', type=int, default=10,
+                        help='Training batches used to calibrate the scales of --act_quant calibrated')
+    parser.add_argument('--expand', type=int, default=100, help='Mamba expand')
+    parser.add_argument('--d_state', type=int, default=16, help='Mamba d_state')
+    parser.add_argument('--d_conv', type=int, default=8, help='Mamba d_conv')
+    parser.add_argument('--alpha', type=float, default=0.9, help='momentum')
+    parser.add_argument('--length', type=float, default=5, help='history gradient length')
+    parser.add_argument('--patch_size', type=int, default=1,
+                        help='Number of gradient elements per token of sequence meta networks (1: no patching)')
+    parser.add_argument('--patch_dim', type=int, default=16,
+                        help='Token dimension of sequence meta networks when patch_size > 1')
+    parser.add_argument('--history_storage', type=str, default='fp32', choices=['fp32', 'fp16', 'bf16', 'int8'],
+                        help='Precision of the stored gradient history (the current step is always fp32)')
+    parser.add_argument('--meta_subsample', type=str, default='',
+                        help='Evaluate meta nets on 1/K of the elements of large layers, "min_size:K,..." e.g. "100000:4,1000000:8"')
+    parser.add_argument('--meta_subsample_mode', type=str, default='strided', choices=['strided', 'random'],
+                        help='Rotating subset of --meta_subsample: strided or random partition')
+    parser.add_argument('--history_backend', type=str, default='memory', choices=['memory', 'mmap'],
+                        help='Keep the history window in RAM or in one memory-mapped file per layer')
+    parser.add_argument('--history_dir', type=str, default=None,
+                        help='Directory of the memory-mapped history files (default: temporary directory)')
+    parser.add_argument('--history_mode', type=str, default='window', choices=['window', 'ema', 'sketch'],
+                        help='Slow meta net input: raw window of --length steps, or a constant-size EMA / sketch summary')
+    parser.add_argument('--history_decays', type=str, default='0.99,0.9,0.5',
+                        help='Comma separated EMA decays for --history_mode ema')
+    parser.add_argument('--sketch_size', type=int, default=4, help='Number of sketch channels for --history_mode sketch')
+    parser.add_argument('--sketch_decay', type=float, default=0.9, help='Decay of the sketch for --history_mode sketch')
+    parser.add_argument('--phase_sync', type=boolean_string, default='True',
+                        help='Synchronize CUDA around every timed training phase')
+    parser.add_argument('--profile-steps', '--profile_steps', dest='profile_steps', type=str, default='',
+                        help='Profile the training iterations START:END with torch.profiler, saved into SummaryPath')
+    parser.add_argument('--accum-steps', '--accum_steps', dest='accum_steps', type=int, default=1,
+                        help='Split every batch into N micro-batches whose gradients are accumulated')
+    parser.add_argument('--fast_eval', type=boolean_string, default='True',
+                        help='Evaluate with weights quantized once per evaluation, inference_mode and channels_last')
+    parser.add_argument('--compare_eval_time', type=boolean_string, default='False',
+                        help='With --fast_eval: time the regular and the fast evaluation on a few test batches in the '
+                             'first epoch and report the evaluation time saved every epoch')
+    parser.add_argument('--async_eval', type=boolean_string, default='False',
+                        help='Evaluate weight snapshots in a background process while training the next epoch')
+    parser.add_argument('--eval_threads', type=int, default=1,
+                        help='With --async_eval: cores reserved for the evaluator (the last ones), training uses the others')
+    parser.add_argument('--result_cache', type=boolean_string, default='False',
+                        help='Key the run by a hash of its configuration and pretrain: reuse it if completed, '
+                             'resume it from its checkpoint if interrupted')
+    parser.add_argument('--force', action='store_true', default=False,
+                        help='With --result_cache, run from scratch even if the run is completed or checkpointed')
+    parser.add_argument('--dist_backend', type=str, default='gloo',
+                        help='torch.distributed backend when launched by torchrun (batch_size is the global batch)')
+
+    return parser
+
+
+class MetaQuantTrainer(object):
+    """
+    Meta quantization training of a quantized network with its meta network(s).
+
+    One training step runs the phases data -> meta_grad -> forward -> backward -> meta_step -> refine
+    -> update -> record, followed by test once per epoch. Every phase is timed by a PhaseTimer, which
+    is written through the Recorder (phase-time.txt) at the end of each epoch.
+
+    Launched by torchrun, every rank holds a replica of the network, the meta nets and the history
+    and reads 1 / world_size of each batch. After backward the gradients of the network, the captured
+    quantized_grads and the gradients of the meta nets are all-reduced (all_reduce phase), so the meta
+    inputs, the meta steps and the updates stay identical on every rank. Rank 0 evaluates, writes the
+    records and the checkpoints; the other ranks log their training records as 'rank<r>-*.txt'.
+
+    With accum_steps > 1 the forward / backward phases run on micro-batches (see forward_backward_accumulated),
+    the meta gradient generation, meta step, refine and update still run once per batch.
+    """
+
+    def __init__(self, args):
+
+        self.args = args
+        self.rank, self.world_size = dist_utils.init_distributed(args.dist_backend)
+        self.distributed = self.world_size > 1
+        self.is_main = self.rank == 0
+        self.use_cuda = torch.cuda.is_available()
+        self.device = 'cuda' if self.use_cuda else 'cpu'
+        if self.distributed and self.use_cuda:
+            torch.cuda.set_device(int(os.environ.get('LOCAL_RANK', 0)) % torch.cuda.device_count())
+        self.model_name = args.model # ResNet32
+        self.dataset_name = args.dataset
+        self.meta_method = args.meta_type # ['LSTM', 'FC', 'simple', 'MultiFC']
+        self.MAX_EPOCH = args.n_epoch
+        self.optimizer_type = args.optimizer # ['SGD', 'SGD-M', 'adam'] adam
+        self.hidden_size = args.hidden_size
+        self.lr_adjust = args.lr_adjust
+        self.batch_size = args.batch_size
+        if self.batch_size % self.world_size != 0:
+            raise ValueError('Batch size %d is not divisible by %d ranks' % (self.batch_size, self.world_size))
+        self.bitW = args.bitW
+        self.length = args.length
+        self.quantized_type = args.quantize
+        self.patch_size = args.patch_size
+        # Sequence meta networks run on single elements (d_model=1) unless gradients are patched
+        self.seq_d_model = 1 if self.patch_size == 1 else args.patch_dim
+        self.save_root = './Results/%s-%s' % (self.model_name, self.dataset_name)
+        self.checkpoint_dir = '%s/%s-%s' % (args.checkpoint_dir, self.model_name, self.dataset_name)
+        self.break_continue = args.break_continue
+        self.localtime = time.strftime("%m-%d-%H:%M:%S", time.localtime())
+
+        self.config_hash = None
+        self.cached_result = None
+        if args.result_cache:
+            self.run_cache = RunCache('%s/run-cache' % self.save_root)
+            self.config = canonical_config(args, world_size=self.world_size,
+                                           pretrain_digest=file_digest(self.pretrain_path()))
+            self.config_hash = config_hash(self.config)
+            if not args.force:
+                self.cached_result = self.run_cache.lookup(self.config_hash)
+            if self.cached_result is not None:
+                print('Run %s is already completed in %s, reuse its results'
+                      % (self.config_hash[:12], self.cached_result['SummaryPath']))
+                return
+            # Deterministic paths, so that an interrupted run is found and resumed
+            self.localtime = 'cfg-%s' % self.config_hash[:12]
+            self.checkpoint_dir = '%s/%s' % (self.checkpoint_dir, self.config_hash[:16])
+            if args.force and self.is_main and os.path.exists(self.checkpoint_dir):
+                shutil.rmtree(self.checkpoint_dir)
+            dist_utils.barrier()
+            self.break_continue = not args.force
+        else:
+            # One directory per configuration: concurrent runs must not overwrite (or resume from) each other.
+            # The number of epochs is left out, so that extending a run (e.g. search.py rungs) resumes it
+            run_key = config_hash(canonical_config(args, ignored=IGNORED_ARGS + SCHEDULE_ARGS,
+                                                   world_size=self.world_size))
+            self.checkpoint_dir = '%s/%s' % (self.checkpoint_dir, run_key[:16])
+
+        self.checkpoint_path = '%s/trainer_checkpoint.pth' % self.checkpoint_dir
+        self.checkpoint_writer = None
+        if args.checkpoint_incremental:
+            self.checkpoint_path = '%s/incremental' % self.checkpoint_dir
+            self.checkpoint_writer = IncrementalCheckpointWriter(
+                self.checkpoint_path, keep_last=args.checkpoint_keep,
+                compress_level=args.checkpoint_compress, downcast=args.checkpoint_downcast)
+        self.use_lora = args.use_lora
+        gVar.a32 = args.a32
+        gVar.act_quant, gVar.act_per_channel, gVar.act_momentum = args.act_quant, args.act_per_channel, args.act_momentum
+
+        self.meta_net = None
+        self.fast_meta_net = None
+        self.slow_meta_net = None
+        self.meta_optimizer = None
+        self.fast_meta_optimizer = None
+        self.slow_meta_optimizer = None
+
+        self.build_network()
+        self.build_loaders()
+        self.build_meta_network()
+        self.build_state()
+        self.build_optimizee()
+        self.sync_replicas()
+
+        self.start_epoch = 0
+        checkpoint = None
+        if self.break_continue:
+            checkpoint = self.load_checkpoint()
+        if checkpoint is None and args.act_quant == 'calibrated' and not gVar.a32:
+            n_quantizers = calibrate_activations(self.net, self.train_loader, self.quantized_type,
+                                                 n_batches=args.act_calibration_batches, use_cuda=self.use_cuda)
+            dist_utils.broadcast_buffers(self.net)
+            print('Calibrated %d activation scales on %d batches' % (n_quantizers, args.act_calibration_batches))
+
+        self.build_recorder(checkpoint)
+        self.phase_timer = PhaseTimer(TRAIN_PHASES, sync=args.phase_sync)
+        self.profiler = StepProfiler(args.profile_steps if self.is_main else '', self.SummaryPath,
+                                     use_cuda=self.use_cuda)
+        self.checkpointer = AsyncCheckpointer()
+        self.evaluator = None
+        if args.async_eval and self.is_main:
+            self.build_evaluator()
+
+        # RNG states are restored last, so that the data order continues as in the interrupted run
+        if checkpoint is not None:
+            set_rng_state(checkpoint['rng_state'])
+
+    ###################
+    # Initial Network #
+    ###################
+    def build_network(self):
+
+        gVar.meta_count = 0
+        self.net = build_meta_resnet(self.model_name, self.dataset_name, bitW=self.bitW, alpha=self.args.alpha)
+        if self.model_name == 'ResNet18':
+            print(self.net)
+
+        if not (self.break_continue and self.has_checkpoint()):
+            self.load_pretrain()
+
+        # Get layer name list
+        self.layer_name_list = self.net.layer_name_list
+        assert (len(self.layer_name_list) == gVar.meta_count)
+        print('Layer name list completed.')
+
+        if self.use_lora:
+            self.convert_lora()
+
+        if self.use_cuda:
+            # net = nn.DataParallel(net).cuda()
+            self.net.cuda()
+
+    def build_loaders(self):
+
+        self.train_loader = get_dataloader(self.dataset_name, 'train', self.batch_size)
+        if self.distributed:
+            self.train_loader = dist_utils.distributed_loader(self.train_loader, self.batch_size // self.world_size)
+        self.test_loader = get_dataloader(self.dataset_name, 'test', 100)
+
+    def pretrain_path(self):
+
+        if self.model_name in ['ResNet20', 'ResNet32', 'ResNet56', 'ResNet44', 'ResNet110']:
+            return '%s/%s-%s-pretrain.pth' % (self.save_root, self.model_name, self.dataset_name)
+        elif self.model_name in ['ResNet18']:
+            if self.dataset_name == 'ImageNet':
+                return '/root/bqqi/fscil/MetaQuant/Results/ResNet18-ImageNet/resnet18-5c106cde.pth'
+            elif self.dataset_name == 'CIFAR10':
+                return '/root/bqqi/fscil/MetaQuant/Results/ResNet18-CIFAR10/ResNet18-CIFAR10-pretrain.pth'
+        return None
+
+    def load_pretrain(self):
+
+        pretrain_path = self.pretrain_path()
+        if pretrain_path is None:
+            return
+        if self.model_name in ['ResNet20', 'ResNet32', 'ResNet56', 'ResNet44', 'ResNet110']:
+            self.net.load_state_dict(torch.load(pretrain_path, map_location=self.device), strict=False)
+        else:
+            self.net.load_state_dict(torch.load(pretrain_path, map_location='cpu'), strict=False)
+
+    def convert_lora(self):
+
+        net, bitW = self.net, self.bitW
+        for param in net.parameters():
+            param.requires_grad = False
+        for layer_info in self.layer_name_list:
+            layer_idx = layer_info[1] # ['layer2', 6, 'conv2']
+
+            if len(layer_idx) == 3:
+                layer = getattr(net, layer_idx[0])
+                block = layer[layer_idx[1]]
+                sublayer = getattr(block, layer_idx[2])
+                setattr(block, layer_idx[2], MetaQuantConvWithLoRA.from_object(sublayer.in_channels, sublayer.out_channels, sublayer.kernel_size, sublayer.stride, sublayer.padding, sublayer.dilation, sublayer.groups, False, bitW, rank=8, alpha_lora=16, in_obj=sublayer))
+            elif len(layer_idx) == 4:
+                layer = getattr(net, layer_idx[0])
+                block = layer[layer_idx[1]]
+                sublayers = getattr(block, layer_idx[2])
+                sublayer = sublayers[layer_idx[3]]
+                sublayers[layer_idx[3]] = MetaQuantConvWithLoRA.from_object(sublayer.in_channels, sublayer.out_channels, sublayer.kernel_size, sublayer.stride, sublayer.padding, sublayer.dilation, sublayer.groups, False, bitW, rank=8, alpha_lora=16, in_obj=sublayer)
+            elif len(layer_idx) == 1:
+                sublayer = getattr(net, layer_idx[0])
+
+                if 'fc' in layer_idx[0]:
+                    setattr(net, layer_idx[0], MetaQuantLinearWithLoRA.from_object(sublayer.in_features, sublayer.out_features, bitW=bitW, rank=8, alpha_lora=16, in_obj=sublayer))
+                else:
+                    setattr(net, layer_idx[0], MetaQuantConvWithLoRA.from_object(sublayer.in_channels, sublayer.out_channels, sublayer.kernel_size, sublayer.stride, sublayer.padding, sublayer.dilation, sublayer.groups, False, bitW, rank=8, alpha_lora=16, in_obj=sublayer))
+
+    ##########################
+    # Construct Meta-Network #
+    ##########################
+    def build_meta_network(self):
+
+        args = self.args
+        meta_method = self.meta_method
+        hidden_size = self.hidden_size
+        patch_size = self.patch_size
+        seq_d_model = self.seq_d_model
+        save_root, quantized_type, optimizer_type = self.save_root, self.quantized_type, self.optimizer_type
+        bitW, lr_adjust, MAX_EPOCH, localtime = self.bitW, self.lr_adjust, self.MAX_EPOCH, self.localtime
+
+        if meta_method in ['LSTMFC-Grad', 'LSTMFC', 'LSTMFC-merge','LSTMFC-momentum']:
+            self.meta_net = MetaLSTMFC(hidden_size=hidden_size)
+            SummaryPath = '%s/runs-Quant/Meta-%s-Nonlinear-%s-' \
+                          'hidden-size-%d-nlstm-1-%s-%s-%dbits-lr-%s-batchsize-%s-%s' \
+                          % (save_root, meta_method, args.meta_nonlinear, hidden_size,
+                             quantized_type, optimizer_type, bitW, lr_adjust, MAX_EPOCH, localtime)
+        elif meta_method in ['FC-Grad']:
+            self.meta_net = MetaFC(hidden_size=hidden_size, use_nonlinear=args.meta_nonlinear)
+            SummaryPath = '%s/runs-Quant/Meta-%s-Nonlinear-%s-' \
+                          'hidden-size-%d-%s-%s-%dbits-lr-%s-batchsize-%s' \
+                          % (save_root, meta_method, args.meta_nonlinear, hidden_size,
+                             quantized_type, optimizer_type, bitW, lr_adjust, MAX_EPOCH)
+        elif meta_method == 'MultiFC':
+            self.meta_net = MetaDesignedMultiFC(hidden_size=hidden_size,
+                                                num_layers = args.num_fc,
+                                                use_nonlinear=args.meta_nonlinear)
+            SummaryPath = '%s/runs-Quant/Meta-%s-Nonlinear-%s-' \
+                          'hidden-size-%d-nfc-%d-%s-%s-%dbits-lr-%s' \
+                          % (save_root, meta_method, args.meta_nonlinear, hidden_size, args.num_fc,
+                             quantized_type, optimizer_type, bitW, lr_adjust)
+        elif meta_method == 'MultiFC-simple':
+            self.meta_net = MetaMultiFC(hidden_size=hidden_size,
+                                        use_nonlinear=args.meta_nonlinear)
+            SummaryPath = '%s/runs-Quant/Meta-%s-Nonlinear-%s-' \
+                          'hidden-size-%d-nfc-%d-%s-%s-%dbits-lr-%s' \
+                          % (save_root, meta_method, args.meta_nonlinear, hidden_size, args.num_fc,
+                             quantized_type, optimizer_type, bitW, lr_adjust)
+        elif meta_method == 'MetaCNN':
+            self.meta_net = MetaCNN()
+            SummaryPath = '%s/runs-Quant/%s-%s-%s-%dbits-lr-%s' \
+                          % (save_root, meta_method, quantized_type, optimizer_type, bitW, lr_adjust)
+        elif meta_method == 'MetaTransformer':
+            self.meta_net = MetaTransformer(d_model=1, nhead=1, num_layers=4)
+            SummaryPath = '%s/runs-Quant/%s-%s-%s-%dbits-lr-%s' \
+                          % (save_root, meta_method, quantized_type, optimizer_type, bitW, lr_adjust)
+        elif meta_method in ['MetaMultiFCBN']:
+            self.meta_net = MetaMultiFCBN(hidden_size=hidden_size, use_nonlinear=args.meta_nonlinear)
+            SummaryPath = '%s/runs-Quant/Meta-%s-Nonlinear-%s-' \
+                          'hidden-size-%d-%s-%s-%dbits-lr-%s' \
+                          % (save_root, meta_method, args.meta_nonlinear, hidden_size,
+                             quantized_type, optimizer_type, bitW, lr_adjust)
+        elif meta_method == 'MetaSimple':
+            self.meta_net = MetaSimple()
+            SummaryPath = '%s/runs-Quant/%s-%s-%s-%dbits-lr-%s' \
+                          % (save_root, meta_method, quantized_type, optimizer_type, bitW, lr_adjust)
+        elif meta_method == 'MetaLSTMLoRA':
+            self.meta_net = MetaLSTMLoRA(hidden_size=hidden_size)
+            SummaryPath = '%s/runs-Quant/%s-%s-%s-%dbits-lr-%s-batchsize-%s' \
+                          % (save_root, meta_method, quantized_type, optimizer_type, bitW, lr_adjust, MAX_EPOCH)
+        elif meta_method == 'MetaMamba':
+            self.meta_net = MetaMamba(d_model=1, d_state=16, d_conv=4, expand=100)
+            SummaryPath = '%s/runs-Quant/%s-%s-%s-%dbits-lr-%s-batchsize-%s-%s' \
+                          % (save_root, meta_method, quantized_type, optimizer_type, bitW, lr_adjust, MAX_EPOCH, localtime)
+        elif meta_method == 'MetaMambaHistory':
+            self.meta_net = MetaMambaHistory(d_model=seq_d_model, d_state=16, d_conv=8, expand=100, patch_size=patch_size)
+            SummaryPath = '%s/runs-Quant/%s-%s-%s-%dbits-lr-%s-batchsize-%s-%s' \
+                          % (save_root, meta_method, quantized_type, optimizer_type, bitW, lr_adjust, MAX_EPOCH, localtime)
+        elif meta_method == 'MetaMambaFusion':
+            self.meta_net = MetaMambaHistory(d_model=seq_d_model, d_state=32, d_conv=4, expand=32, patch_size=patch_size)
+            SummaryPath = '%s/runs-Quant/%s-%s-%s-%dbits-lr-%s-batchsize-%s-%s' \
+                          % (save_root, meta_method, quantized_type, optimizer_type, bitW, lr_adjust, MAX_EPOCH, localtime)
+        elif meta_method == 'MetaS4':
+            self.meta_net = MetaS4(d_model=seq_d_model, d_state=16, patch_size=patch_size)
+            SummaryPath = '%s/runs-Quant/%s-%s-%s-%dbits-lr-%s-batchsize-%s-%s' \
+                          % (save_root, meta_method, quantized_type, optimizer_type, bitW, lr_adjust, MAX_EPOCH, localtime)
+        elif meta_method == 'MetaS4History':
+            self.meta_net = S4ModelHand(d_input=1, d_model=100, d_output=1, n_layers=1, d_state=16, patch_size=patch_size)
+            SummaryPath = '%s/runs-Quant/%s-%s-%s-%dbits-lr-%s-batchsize-%s-%s' \
+                          % (save_root, meta_method, quantized_type, optimizer_type, bitW, lr_adjust, MAX_EPOCH, localtime)
+        elif meta_method == 'MetaS5History':
+            self.meta_net = MetaS5Block(d_input=1, dim=8 if patch_size == 1 else args.patch_dim, state_dim=8, bidir=False, patch_size=patch_size)
+            SummaryPath = '%s/runs-Quant/%s-%s-%s-%dbits-lr-%s-batchsize-%s-%s' \
+                          % (save_root, meta_method, quantized_type, optimizer_type, bitW, lr_adjust, MAX_EPOCH, localtime)
+        elif meta_method == 'MetaS5Fusion':
+            self.meta_net = MetaS5Block(d_input=1, dim=seq_d_model, state_dim=32, bidir=False, patch_size=patch_size)
+            SummaryPath = '%s/runs-Quant/%s-%s-%s-%dbits-lr-%s-batchsize-%s-%s' \
+                          % (save_root, meta_method, quantized_type, optimizer_type, bitW, lr_adjust, MAX_EPOCH, localtime)
+        elif meta_method == 'MetaFastAndSlow':
+            if self.dataset_name == 'ImageNet':
+                self.slow_meta_net = MambaForImageNet(num_layers=len(self.layer_name_list), d_model=1, d_state=16, d_conv=8, expand=100,
+                                                      patch_size=patch_size if patch_size > 1 else 200)
+                self.patch_size = self.slow_meta_net.patch_size
+            else:
+                self.slow_meta_net = MetaMambaHistory(num_layers=len(self.layer_name_list), d_model=seq_d_model, d_state=args.d_state, d_conv=args.d_conv, expand=args.expand, patch_size=patch_size)
+            self.fast_meta_net = MetaMultiFC(hidden_size=hidden_size, use_nonlinear=args.meta_nonlinear)
+            SummaryPath = '%s/runs-Quant/%s-%s-%s-%dbits-lr-%s-batchsize-%s-%s' \
+                          % (save_root, meta_method, quantized_type, optimizer_type, bitW, lr_adjust, MAX_EPOCH, localtime)
+        elif meta_method == 'MetaFastAndLSTM':
+            self.slow_meta_net = MetaLSTMFC(hidden_size=hidden_size)
+            self.fast_meta_net = MetaMultiFC(hidden_size=hidden_size, use_nonlinear=args.meta_nonlinear)
+            SummaryPath = '%s/runs-Quant/%s-%s-%s-%dbits-lr-%s-batchsize-%s-%s' \
+                          % (save_root, meta_method, quantized_type, optimizer_type, bitW, lr_adjust, MAX_EPOCH, localtime)
+        elif meta_method == 'MetaMambaAndFC':
+            self.fast_meta_net = MetaMambaHistory(d_model=seq_d_model, d_state=16, d_conv=8, expand=100, patch_size=patch_size)
+            self.slow_meta_net = MetaMultiFC(hidden_size=hidden_size, use_nonlinear=args.meta_nonlinear)
+            SummaryPath = '%s/runs-Quant/%s-%s-%s-%dbits-lr-%s-batchsize-%s-%s' \
+                          % (save_root, meta_method, quantized_type, optimizer_type, bitW, lr_adjust, MAX_EPOCH, localtime)
+        elif meta_method == 'MetaDualGrad':
+            self.meta_net = MetaDualGrad(d_model=seq_d_model, d_state=16, d_conv=8, expand=100, hidden_size=hidden_size, use_nonlinear=args.meta_nonlinear, patch_size=patch_size)
+            SummaryPath = '%s/runs-Quant/%s-%s-%s-%dbits-lr-%s-batchsize-%s-%s' \
+                          % (save_root, meta_method, quantized_type, optimizer_type, bitW, lr_adjust, MAX_EPOCH, localtime)
+        else:
+            raise NotImplementedError
+
+        if meta_method in FAST_SLOW_METHODS:
+            print(self.slow_meta_net)
+            print(self.fast_meta_net)
+            if self.use_cuda:
+                self.slow_meta_net.cuda()
+                self.fast_meta_net.cuda()
+            self.slow_meta_optimizer = optim.Adam(self.slow_meta_net.parameters(), lr=1e-3, weight_decay=args.weight_decay)
+            self.fast_meta_optimizer = optim.Adam(self.fast_meta_net.parameters(), lr=1e-2, weight_decay=args.weight_decay)
+        else:
+            print(self.meta_net)
+            if self.use_cuda:
+                self.meta_net.cuda()
+            self.meta_optimizer = optim.Adam(self.meta_net.parameters(), lr=1e-3, weight_decay=args.weight_decay)
+
+        self.SummaryPath = SummaryPath
+
+    def build_state(self):
+
+        args = self.args
+        self.meta_hidden_state_dict = dict() # Dictionary to store hidden states for all layers for memory-based meta network
+        self.meta_grad_dict = dict() # Dictionary to store meta net output: gradient for origin network's weight / bias
+        self.momentum_dict = dict()
+        # The history is replicated: every rank feeds it the same all-reduced gradients
+        history_dir = args.history_dir
+        if self.distributed and history_dir is not None:
+            history_dir = os.path.join(history_dir, 'rank%d' % self.rank)
+        self.history_grad = build_history(mode=args.history_mode, length=self.length, storage=args.history_storage,
+                                          decays=[float(decay) for decay in args.history_decays.split(',')],
+                                          sketch_size=args.sketch_size, sketch_decay=args.sketch_decay,
+                                          backend=args.history_backend, root=history_dir)
+        if args.meta_subsample != '':
+            if self.meta_method not in ['MultiFC', 'MultiFC-simple', 'MetaCNN', 'MetaTransformer', 'MetaMultiFCBN', 'MetaSimple',
+                                        'MetaFastAndSlow'] or self.use_lora:
+                raise NotImplementedError('--meta_subsample is not supported for %s' % self.meta_method)
+            self.subsampler = MetaSubsampler(args.meta_subsample, mode=args.meta_subsample_mode)
+        else:
+            self.subsampler = None
+        self.conv_state_dict = dict()
+        self.ssm_state_dict = dict()
+        self.s4_state_dict = dict()
+        self.slow_meta_grad_dict = dict()
+        self.fast_meta_grad_dict = dict()
+
+    def meta_nets(self):
+        return [meta_net for meta_net in [self.meta_net, self.fast_meta_net, self.slow_meta_net] if meta_net is not None]
+
+    def sync_replicas(self):
+        """Start every rank from the network and meta nets of rank 0 (meta nets are randomly initialized)"""
+        if not self.distributed:
+            return
+        dist_utils.broadcast_module(self.net)
+        for meta_net in self.meta_nets():
+            dist_utils.broadcast_module(meta_net)
+
+    def build_optimizee(self):
+
+        # Optimizer for original network, just for zeroing gradient and get refined gradient
+        if self.optimizer_type == 'SGD-M':
+            self.optimizee = SGD(self.net.parameters(), lr=self.args.init_lr,
+                                 momentum=0.9, weight_decay=5e-4)
+        elif self.optimizer_type == 'SGD':
+            self.optimizee = SGD(self.net.parameters(), lr=self.args.init_lr)
+        elif self.optimizer_type in ['adam', 'Adam']:
+            self.optimizee = Adam(self.net.parameters(), lr=self.args.init_lr) # ,weight_decay=5e-4
+        else:
+            raise NotImplementedError
+
+    ##############
+    # Checkpoint #
+    ##############
+    def state_dict(self, epoch):
+        """
+        Full training state after `epoch` epochs, enough to resume the run exactly
+        """
+        layer_state = dict()
+        for layer_info in self.layer_name_list:
+            layer_name = layer_info[0]
+            layer = get_layer(self.net, layer_info[1])
+            layer_state[layer_name] = {
+                'quantized_grads': layer.quantized_grads,
+                'pre_quantized_weight': layer.pre_quantized_weight,
+            }
+
+        meta_nets = dict()
+        for name in ['meta_net', 'fast_meta_net', 'slow_meta_net']:
+            if getattr(self, name) is not None:
+                meta_nets[name] = getattr(self, name).state_dict()
+        meta_optimizers = dict()
+        for name in ['meta_optimizer', 'fast_meta_optimizer', 'slow_meta_optimizer']:
+            if getattr(self, name) is not None:
+                meta_optimizers[name] = getattr(self, name).state_dict()
+
+        return {
+            'epoch': epoch,
+            'SummaryPath': self.SummaryPath,
+            'model_state_dict': self.net.state_dict(),
+            # Gradients are read by the meta forward of the next step
+            'grads': {name: param.grad for name, param in self.net.named_parameters() if param.grad is not None},
+            'layer_state': layer_state,
+            'optimizer_state_dict': self.optimizee.state_dict(),
+            'meta_nets': meta_nets,
+            'meta_optimizers': meta_optimizers,
+            'history_grad': self.history_grad.state_dict(),
+            'subsampler': self.subsampler.state_dict() if self.subsampler is not None else None,
+            'meta_hidden_state_dict': self.meta_hidden_state_dict,
+            'momentum_dict': self.momentum_dict,
+            'conv_state_dict': self.conv_state_dict,
+            'ssm_state_dict': self.ssm_state_dict,
+            's4_state_dict': self.s4_state_dict,
+            'recorder': self.recorder.state_dict(),
+            'rng_state': get_rng_state(),
+        }
+
+    def has_checkpoint(self):
+
+        if self.checkpoint_writer is not None:
+            return self.checkpoint_writer.latest_epoch() is not None
+        return os.path.exists(self.checkpoint_path)
+
+    def save_checkpoint(self, epoch, is_best=False):
+
+        if not self.is_main:
+            return
+        if self.checkpoint_writer is not None:
+            self.checkpointer.submit(self.checkpoint_writer.save, self.state_dict(epoch), epoch, is_best)
+        else:
+            self.checkpointer.save(self.state_dict(epoch), self.checkpoint_path)
+        print('Checkpoint of epoch %d is being written to %s' % (epoch, self.checkpoint_path))
+
+    def load_checkpoint(self):
+        """
+        Restore the training state saved by save_checkpoint. The recorder state and the RNG states are
+        restored later, once the recorder exists.
+        :return: the loaded checkpoint, None if there is no checkpoint to resume from
+        """
+        if not self.has_checkpoint():
+            print('No checkpoint found in %s, start from scratch' % self.checkpoint_path)
+            return None
+
+        device = self.device
+        if self.checkpoint_writer is not None:
+            checkpoint = self.checkpoint_writer.load(map_location=device)
+        else:
+            checkpoint = torch.load(self.checkpoint_path, map_location=device, weights_only=False)
+        self.start_epoch = checkpoint['epoch']
+        self.net.load_state_dict(checkpoint['model_state_dict'])
+        for name, param in self.net.named_parameters():
+            if name in checkpoint['grads']:
+                param.grad = checkpoint['grads'][name]
+        for layer_info in self.layer_name_list:
+            layer_name = layer_info[0]
+            layer = get_layer(self.net, layer_info[1])
+            layer.quantized_grads = checkpoint['layer_state'][layer_name]['quantized_grads']
+            layer.pre_quantized_weight = checkpoint['layer_state'][layer_name]['pre_quantized_weight']
+        self.optimizee.load_state_dict(checkpoint['optimizer_state_dict'])
+
+        for name, state_dict in checkpoint['meta_nets'].items():
+            getattr(self, name).load_state_dict(state_dict)
+        for name, state_dict in checkpoint['meta_optimizers'].items():
+            getattr(self, name).load_state_dict(state_dict)
+
+        self.history_grad.load_state_dict(checkpoint['history_grad'])
+        if self.subsampler is not None and checkpoint['subsampler'] is not None:
+            self.subsampler.load_state_dict(checkpoint['subsampler'])
+        self.meta_hidden_state_dict = checkpoint['meta_hidden_state_dict']
+        self.momentum_dict = checkpoint['momentum_dict']
+        self.conv_state_dict = checkpoint['conv_state_dict']
+        self.ssm_state_dict = checkpoint['ssm_state_dict']
+        self.s4_state_dict = checkpoint['s4_state_dict']
+
+        print('Resume from %s at epoch %d' % (self.checkpoint_path, self.start_epoch))
+        return checkpoint
+
+    ####################
+    # Initial Recorder #
+    ####################
+    def build_recorder(self, checkpoint=None):
+
+        args = self.args
+
+        if checkpoint is not None:
+            # Keep writing the records of the resumed run
+            self.SummaryPath = checkpoint['SummaryPath']
+            print('Save to %s' % self.SummaryPath)
+            if self.is_main and not os.path.exists(self.SummaryPath):
+                os.makedirs(self.SummaryPath)
+            dist_utils.barrier()
+            self.recorder = Recorder(SummaryPath=self.SummaryPath, dataset_name=self.dataset_name,
+                                     task_name=self.recorder_task_name(), resume=True)
+            self.recorder.load_state_dict(checkpoint['recorder'])
+            return
+
+        SummaryPath = self.SummaryPath
+        if self.patch_size > 1:
+            SummaryPath += ('-patch%d' % self.patch_size)
+        if args.history_mode == 'ema':
+            SummaryPath += ('-hist-ema-%s' % args.history_decays.replace(',', '_'))
+        elif args.history_mode == 'sketch':
+            SummaryPath += ('-hist-sketch%d-%s' % (args.sketch_size, args.sketch_decay))
+        if args.history_storage != 'fp32':
+            SummaryPath += ('-hist-%s' % args.history_storage)
+        if self.subsampler is not None:
+            SummaryPath += ('-sub-%s-%s' % (args.meta_subsample_mode, args.meta_subsample.replace(':', 'x').replace(',', '_')))
+        if args.exp_spec != '':
+            SummaryPath += ('-' + args.exp_spec)
+        if self.config_hash is not None and self.localtime not in SummaryPath:
+            SummaryPath += ('-' + self.localtime)
+        self.SummaryPath = SummaryPath
+
+        print('Save to %s' %SummaryPath)
+
+        if self.is_main:
+            if os.path.exists(SummaryPath):
+                print('Record exist, remove')
+                # input()
+                shutil.rmtree(SummaryPath)
+                os.makedirs(SummaryPath)
+            else:
+                os.makedirs(SummaryPath)
+        dist_utils.barrier()
+
+        self.recorder = Recorder(SummaryPath=SummaryPath, dataset_name=self.dataset_name,
+                                 task_name=self.recorder_task_name())
+
+    def recorder_task_name(self):
+        return None if self.is_main else 'rank%d' % self.rank
+
+    ###################
+    # Training phases #
+    ###################
+    def zero_meta_grad(self):
+
+        if self.meta_method in FAST_SLOW_METHODS:
+            self.fast_meta_optimizer.zero_grad()
+            self.slow_meta_optimizer.zero_grad()
+        else:
+            self.meta_optimizer.zero_grad() # 元优化器
+
+    def generate_meta_grad(self):
+
+        meta_method, net = self.meta_method, self.net
+
+        if meta_method in ['MetaMamba', 'MetaS4']:
+            self.meta_grad_dict, self.history_grad, self.conv_state_dict, self.ssm_state_dict, self.s4_state_dict = \
+                metassm_gradient_generation(self.meta_net, net, meta_method, self.history_grad, self.conv_state_dict,
+                                            self.ssm_state_dict, self.s4_state_dict, False)
+        elif meta_method in FAST_SLOW_METHODS:
+            if self.use_lora:
+                self.fast_meta_grad_dict, self.slow_meta_grad_dict, self.history_grad, self.meta_hidden_state_dict = \
+                    meta_gradient_lora_generation(self.fast_meta_net, self.slow_meta_net, net, meta_method,
+                                                  self.history_grad, False, self.meta_hidden_state_dict)
+            else:
+                self.fast_meta_grad_dict, self.slow_meta_grad_dict, self.history_grad, self.meta_hidden_state_dict = \
+                    meta_fast_slow_gradient_generation(self.fast_meta_net, self.slow_meta_net, net, meta_method,
+                                                       self.history_grad, False, self.meta_hidden_state_dict,
+                                                       length=self.length, patch_size=self.patch_size,
+                                                       subsampler=self.subsampler)
+        elif meta_method in ['MetaDualGrad']:
+            self.fast_meta_grad_dict, self.slow_meta_grad_dict, self.history_grad, self.meta_hidden_state_dict = \
+                dual_gradient_generation(self.meta_net, net, meta_method, self.history_grad, False,
+                                         patch_size=self.patch_size)
+        else:
+            self.meta_grad_dict, self.meta_hidden_state_dict, self.momentum_dict, self.history_grad = \
+                meta_gradient_generation(
+                        self.meta_net, net, meta_method, self.meta_hidden_state_dict, False, self.momentum_dict,
+                        self.history_grad, patch_size=self.patch_size, subsampler=self.subsampler
+                )
+
+    def forward(self, inputs):
+
+        # Conduct inference with meta gradient, which is incorporated into the computational graph
+        if self.meta_method in FAST_SLOW_METHODS + ['MetaDualGrad']:
+            return self.net(
+                inputs, quantized_type=self.quantized_type, meta_grad_dict=self.fast_meta_grad_dict,
+                slow_grad_dict=self.slow_meta_grad_dict, lr=self.optimizee.param_groups[0]['lr']
+            )
+        else:
+            return self.net(
+                inputs, quantized_type=self.quantized_type, meta_grad_dict=self.meta_grad_dict,
+                slow_grad_dict=None, lr=self.optimizee.param_groups[0]['lr']
+            )
+
+    def backward(self, outputs, targets):
+
+        # Clear gradient, which is stored in layer.weight.grad
+        self.optimizee.zero_grad()
+
+        # Backpropagation to attain natural gradient, which is stored in layer.pre_quantized_grads
+        losses = nn.CrossEntropyLoss()(outputs, targets)
+        losses.backward()
+        return losses
+
+    def forward_backward_accumulated(self, inputs, targets):
+        """
+        Forward / backward of a batch as accum_steps micro-batches, equivalent to a single pass up to BN
+        statistics. The meta outputs are shared by every micro-batch, so their graph is retained until
+        the last backward, and the meta net gradients accumulate as usual. The forward of the meta
+        quantized layers reads the gradient of the previous step from weight.grad: it is restored before
+        every micro-batch and the new gradients are summed aside. quantized_grads (and A_grad / B_grad of
+        LoRA layers) are summed by the hooks.
+        :return: outputs of the whole batch (detached) and the loss of the whole batch
+        """
+        timer = self.phase_timer
+        params = [param for param in self.net.parameters()]
+        previous_grads = [param.grad for param in params]
+        accumulated_grads = [None] * len(params)
+
+        for layer_info in self.net.layer_name_list:
+            layer = get_layer(self.net, layer_info[1])
+            layer.quantized_grads = None
+            if hasattr(layer, 'A_grad'):
+                layer.A_grad, layer.B_grad = None, None
+        gVar.accumulate_grads = True
+
+        outputs_list = []
+        losses = 0
+        micro_inputs, micro_targets = inputs.chunk(self.args.accum_steps), targets.chunk(self.args.accum_steps)
+        try:
+            for micro_idx, (micro_input, micro_target) in enumerate(zip(micro_inputs, micro_targets)):
+                with timer.phase('forward'):
+                    for param, grad in zip(params, previous_grads):
+                        param.grad = grad
+                    outputs = self.forward(micro_input)
+
+                with timer.phase('backward'):
+                    for param in params:
+                        param.grad = None
+                    # Weighted by the micro-batch size, so that the sum is the mean over the batch
+                    micro_losses = nn.CrossEntropyLoss()(outputs, micro_target) * (micro_target.shape[0] / targets.shape[0])
+                    micro_losses.backward(retain_graph=(micro_idx < len(micro_inputs) - 1))
+                    for idx, param in enumerate(params):
+                        if param.grad is not None:
+                            accumulated_grads[idx] = param.grad if accumulated_grads[idx] is None \
+                                else accumulated_grads[idx] + param.grad
+
+                outputs_list.append(outputs.detach())
+                losses = losses + micro_losses.detach()
+        finally:
+            gVar.accumulate_grads = False
+
+        for param, grad in zip(params, accumulated_grads):
+            param.grad = grad
+        return torch.cat(outputs_list), losses
+
+    def all_reduce_grads(self):
+        """Average the gradients of the network, the captured quantized grads and the meta nets over ranks"""
+        tensors = [param.grad for param in self.net.parameters() if param.grad is not None]
+        for layer_info in self.net.layer_name_list:
+            layer = get_layer(self.net, layer_info[1])
+            if layer.quantized_grads is not None:
+                tensors.append(layer.quantized_grads)
+        for meta_net in self.meta_nets():
+            tensors += [param.grad for param in meta_net.parameters() if param.grad is not None]
+        dist_utils.all_reduce_tensors(tensors)
+
+    def meta_step(self):
+
+        if self.meta_method in FAST_SLOW_METHODS:
+            self.fast_meta_optimizer.step()
+            self.slow_meta_optimizer.step()
+        else:
+            self.meta_optimizer.step()
+
+    def refine(self):
+        """
+        Assign meta gradient for actual gradients used in update_parameters and refine them with the optimizee
+        :return: whether a meta gradient was available, i.e. whether parameters should be updated
+        """
+        net = self.net
+
+        if self.meta_method in FAST_SLOW_METHODS + ['MetaDualGrad']:
+            if len(self.fast_meta_grad_dict) == 0:
+                return False
+            for layer_info in net.layer_name_list:
+                layer_name = layer_info[0]
+                layer_idx = layer_info[1]
+                layer = get_layer(net, layer_idx)
+                if self.use_lora:
+                    try:
+                        layer.weight.grad.data = (
+                            layer.delta_w
+                        )
+                        layer.A.grad.data = (self.fast_meta_grad_dict[layer_name][1][0] * layer.calibration_A)
+                        layer.B.grad.data = (self.fast_meta_grad_dict[layer_name][1][1] * layer.calibration_B)
+                    except:
+                        pass
+                else:
+                    layer.weight.grad.data = (
+                        layer.calibration * self.fast_meta_grad_dict[layer_name][1].data
+                    )
+        else:
+            if len(self.meta_grad_dict) == 0:
+                return False
+            for layer_info in net.layer_name_list:
+                layer_name = layer_info[0]
+                layer_idx = layer_info[1]
+                layer = get_layer(net, layer_idx)
+                layer.weight.grad.data = (
+                    layer.calibration * self.meta_grad_dict[layer_name][1].data
+                )
+
+        # Get refine gradients for actual parameters update
+        self.optimizee.get_refine_gradient()
+        return True
+
+    def update(self):
+
+        # Actual parameters update using the refined gradient from meta gradient
+        update_parameters(self.net, lr=self.optimizee.param_groups[0]['lr'])
+
+    def train_step(self, epoch, batch_idx, inputs, targets, end):
+
+        timer = self.phase_timer
+
+        self.zero_meta_grad()
+
+        # Ignore the first meta gradient generation due to the lack of natural gradient
+        if not (batch_idx == 0 and epoch == 0):
+            with timer.phase('meta_grad'):
+                self.generate_meta_grad()
+
+        if self.args.accum_steps > 1:
+            outputs, losses = self.forward_backward_accumulated(inputs, targets)
+        else:
+            with timer.phase('forward'):
+                outputs = self.forward(inputs)
+
+            with timer.phase('backward'):
+                losses = self.backward(outputs, targets)
+
+        if self.distributed:
+            with timer.phase('all_reduce'):
+                self.all_reduce_grads()
+
+        with timer.phase('meta_step'):
+            self.meta_step()
+
+        with timer.phase('refine'):
+            do_update = self.refine()
+
+        if do_update:
+            with timer.phase('update'):
+                self.update()
+
+        with timer.phase('record'):
+            self.recorder.update(loss=losses.data.item(), acc=accuracy(outputs.data, targets.data, (1,5)),
+                                 batch_size=outputs.shape[0], cur_lr=self.optimizee.param_groups[0]['lr'], end=end)
+
+        return losses
+
+    def train_epoch(self, epoch):
+
+        timer = self.phase_timer
+        self.net.train()
+        end = time.time()
+
+        self.recorder.reset_performance()
+
+        if self.distributed:
+            self.train_loader.sampler.set_epoch(epoch)
+        train_loader = tqdm(self.train_loader, total=len(self.train_loader), disable=not self.is_main)
+        data_iter = iter(train_loader)
+        batch_idx = 0
+        while True:
+            with timer.phase('data'):
+                try:
+                    inputs, targets = next(data_iter)
+                except StopIteration:
+                    break
+                if self.use_cuda:
+                    inputs, targets = inputs.cuda(), targets.cuda()
+
+            self.train_step(epoch, batch_idx, inputs, targets, end)
+            self.profiler.step()
+
+            # recorder.print_training_result(batch_idx, len(train_loader))
+            end = time.time()
+            batch_idx += 1
+
+    def build_evaluator(self):
+
+        if self.use_lora:
+            raise NotImplementedError('--async_eval is not supported with LoRA layers')
+        cores = sorted(os.sched_getaffinity(0))
+        n_threads = min(self.args.eval_threads, max(len(cores) - 1, 1))
+        eval_cores = cores[-n_threads:] if len(cores) > n_threads else None
+        if eval_cores is not None and not self.use_cuda:
+            torch.set_num_threads(len(cores) - n_threads)
+        self.evaluator = AsyncEvaluator(self.net, self.model_name, self.dataset_name, self.quantized_type,
+                                        bitW=self.bitW, alpha=self.args.alpha, n_threads=n_threads, cores=eval_cores)
+
+    def record_eval_results(self, results):
+
+        for epoch, niter, test_acc, eval_time in results:
+            print('Background evaluation of epoch %d: %s (%.1fs)' % (epoch, test_acc, eval_time))
+            self.recorder.get_best_test_acc()
+            self.recorder.update(loss=None, acc=test_acc, batch_size=0, end=None, is_train=False,
+                                 epoch=epoch, niter=niter)
+
+    def evaluate_async(self):
+        """Hand a snapshot of the network to the evaluator, record the evaluations finished meanwhile"""
+        with self.phase_timer.phase('test'):
+            self.evaluator.submit(self.net, self.recorder.epoch, self.recorder.niter)
+            # A synchronous test() leaves the pre-quantized weight of the plain weight on every layer,
+            # which the next meta gradient generation reads: keep it that way
+            prepare_fast_eval(self.net, self.quantized_type)
+            for layer_info in self.layer_name_list:
+                layer = get_layer(self.net, layer_info[1])
+                if getattr(layer, 'supports_eval_cache', False) and layer.eval_cache[1] is not None:
+                    layer.pre_quantized_weight = layer.eval_cache[1]
+        self.record_eval_results(self.evaluator.poll())
+        return None
+
+    def evaluate(self):
+
+        if self.args.async_eval:
+            return self.evaluate_async() if self.is_main else None
+
+        with self.phase_timer.phase('test'):
+            # BN running statistics are the only state that is not all-reduced: use those of rank 0
+            dist_utils.broadcast_buffers(self.net)
+            test_acc = None
+            if self.is_main:
+                test_acc = test(self.net, quantized_type=self.quantized_type, test_loader=self.test_loader,
+                                use_cuda=self.use_cuda, dataset_name=self.dataset_name, n_batches_used=None,
+                                fast=self.args.fast_eval)
+            test_acc = dist_utils.broadcast_object(test_acc)
+        self.recorder.get_best_test_acc()
+        self.recorder.update(loss=None, acc=test_acc, batch_size=0, end=None, is_train=False)
+        return test_acc
+
+    def report_fast_eval(self, n_batches=10):
+        """Estimate the evaluation time per epoch saved by the fast path on a few test batches"""
+        rng_state = get_rng_state()  # The test loader shuffles, keep the run reproducible
+        slow_time, fast_time, agreement = compare_eval_time(self.net, self.quantized_type, self.test_loader,
+                                                            use_cuda=self.use_cuda, n_batches=n_batches)
+        set_rng_state(rng_state)
+        self.eval_time_saved = (slow_time - fast_time) * len(self.test_loader)
+        print('Fast eval: %.1f ms / batch instead of %.1f ms (%.2fx), same predictions on %.2f%% of %d batches, '
+              'saves ~%.1fs of evaluation per epoch' % (1e3 * fast_time, 1e3 * slow_time, slow_time / max(fast_time, 1e-12),
+                                                        100.0 * agreement, n_batches, self.eval_time_saved))
+
+    def fit(self):
+
+        if self.cached_result is not None:
+            best_test_acc = self.cached_result['best_test_acc']
+            best_test_acc = tuple(best_test_acc) if isinstance(best_test_acc, list) else best_test_acc
+            print_best_test_acc(best_test_acc)
+            return best_test_acc
+
+        recorder = self.recorder
+        start_time = time.time()
+        for epoch in range(self.start_epoch, self.MAX_EPOCH):
+
+            if recorder.stop: break
+
+            print('\nEpoch: %d, lr: %e' % (epoch, self.optimizee.param_groups[0]['lr']))
+
+            self.phase_timer.reset()
+            epoch_start_time = time.time()
+            self.train_epoch(epoch)
+            train_time = time.time() - epoch_start_time
+
+            compare_eval = self.args.fast_eval and self.args.compare_eval_time and not self.args.async_eval and self.is_main
+            if compare_eval and epoch == self.start_epoch:
+                self.report_fast_eval()
+            test_acc = self.evaluate()
+            recorder.update_phase_time(self.phase_timer)
+            if compare_eval:
+                print('Eval time: %.1fs (~%.1fs saved by the fast path)' % (self.phase_timer.total['test'], self.eval_time_saved))
+            print_history_memory(self.history_grad)
+            if self.subsampler is not None:
+                print('%s, train throughput: %.1f img/s, test acc: %s'
+                      % (self.subsampler.report(), len(self.train_loader) * self.batch_size / train_time, test_acc))
+
+            # Adjust learning rate
+            recorder.adjust_lr(optimizer=self.optimizee, adjust_type=self.lr_adjust, epoch=epoch)
+            if self.distributed:
+                lr, recorder.stop = dist_utils.broadcast_object((self.optimizee.param_groups[0]['lr'], recorder.stop))
+                for param_group in self.optimizee.param_groups:
+                    param_group['lr'] = lr
+
+            if self.args.checkpoint_freq > 0 and (epoch + 1) % self.args.checkpoint_freq == 0:
+                self.save_checkpoint(epoch + 1, is_best=recorder.best_test_flag)
+
+        if self.evaluator is not None:
+            self.record_eval_results(self.evaluator.wait())
+
+        end_time = time.time()
+        print('total time: %.1f' % ((end_time-start_time)/60))
+        best_test_acc = recorder.get_best_test_acc()
+        print_best_test_acc(best_test_acc)
+        if self.config_hash is not None and self.is_main:
+            self.save_result(best_test_acc)
+        return best_test_acc
+
+    def save_result(self, best_test_acc):
+        """Record the completed run in the run cache and as result.json in SummaryPath"""
+        self.checkpointer.wait()
+        result = {
+            'config_hash': self.config_hash,
+            'config': self.config,
+            'SummaryPath': self.SummaryPath,
+            'best_test_acc': best_test_acc,
+            'stopped_early': self.recorder.stop,
+        }
+        with open('%s/result.json' % self.SummaryPath, 'w') as f:
+            json.dump(result, f, indent=1, default=str)
+        self.run_cache.store(self.config_hash, result)
+
+    def close(self):
+
+        if self.cached_result is not None:
+            return
+
+        self.profiler.close()
+        self.checkpointer.close()
+        if self.evaluator is not None:
+            self.evaluator.close()
+        self.recorder.close()
+        if isinstance(self.history_grad, MemmapHistoryGradStore):
+            self.history_grad.close()
+        dist_utils.cleanup()
@@ -443,6 +443,27 @@ def resnet152(**kwargs):
     return ResNet(Bottleneck, [3, 8, 36, 3], **kwargs)
 
 
+def build_meta_resnet(model_name, dataset_name, bitW=1, alpha=0.9):
+    """Meta-quantized network used by meta-quantize.py for a --model / --dataset pair"""
+
+    if model_name == 'ResNet20':
+        return resnet20_cifar(bitW=bitW, alpha=alpha)
+    elif model_name == 'ResNet32':
+        return resnet32_cifar(bitW=bitW, alpha=alpha)
+    elif model_name == 'ResNet56':
+        return resnet56_cifar(num_classes=100, bitW=bitW, alpha=alpha)
+    elif model_name == 'ResNet44':
+        return resnet44_cifar(bitW=bitW, alpha=alpha)
+    elif model_name == 'ResNet110':
+        return resnet110_cifar(num_classes=100, bitW=bitW, alpha=alpha)
+    elif model_name == 'ResNet18':
+        if dataset_name == 'CIFAR10':
+            return resnet18(bitW=bitW, num_classes=10)
+        elif dataset_name == 'ImageNet':
+            return resnet18(bitW=bitW, num_classes=1000)
+    raise NotImplementedError
+
+
 if __name__ == '__main__':
     # net = preact_resnet110_cifar()
     net = resnet20_cifar(bitW=2).cuda()
@@ -249,6 +249,23 @@ def resnet1001_cifar(**kwargs):
     model = ResNet_Cifar(Bottleneck, [111, 111, 111], **kwargs)
     return model
 
+
+def build_quantized_resnet(model_name, bitW=1):
+    """Baseline quantized network used by train_baseline_quant.py for a --model"""
+
+    if model_name == 'ResNet20':
+        return resnet20_cifar(bitW=bitW)
+    elif model_name == 'ResNet32':
+        return resnet32_cifar(bitW=bitW)
+    elif model_name == 'ResNet44':
+        return resnet44_cifar(bitW=bitW)
+    elif model_name == 'ResNet56':
+        return resnet56_cifar(bitW=bitW, num_classes=100)
+    elif model_name == 'ResNet110':
+        return resnet110_cifar(bitW=bitW, num_classes=100)
+    raise NotImplementedError
+
+
 if __name__ == '__main__':
     # net = preact_resnet110_cifar()
     net = resnet20_cifar()
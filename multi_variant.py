@@ -0,0 +1,259 @@
+"""
+Train K meta-quantize variants on the same mini-batch stream in one process.
+
+    python multi_variant.py --variants '[{"alpha": 0.5}, {"alpha": 0.9}, {"init_lr": 1e-2, "hidden_size": 50}]' \
+        -m ResNet20 -d CIFAR10 -q dorefa -bw 1 -o adam -meta MultiFC -n 100
+
+Every variant is a MetaQuantTrainer built from the base arguments of meta-quantize.py updated with
+its overrides (argument dest -> value). Data loading and augmentation are done once per batch and
+shared by all variants. For element-wise meta nets (VMAP_METHODS), the variants with the same meta
+net architecture are evaluated together: their parameters are stacked and the meta net is called
+once per layer through torch.func.vmap(functional_call). Other meta nets (LSTM / Mamba / S4 /
+fast-slow: recurrent state, custom kernels) run one variant after the other.
+
+The step of the main networks (forward, backward, meta step and update) is NOT batched: it runs one
+variant after the other. It does not fit torch.func: MetaQuantConv / MetaQuantLinear keep the
+quantized weights and gradients of the step on the modules, capture them with tensor hooks
+(register_hook is not supported inside vmap / grad), read the weight gradient of the previous step
+from .grad, quantize through autograd.Functions without vmap rules, and the meta gradients must flow
+back into the meta nets through a regular backward. The gain of this mode comes from the shared data
+pipeline and the vmapped meta nets only.
+"""
+import os
+import copy
+import json
+import time
+import argparse
+
+import torch
+from torch.func import functional_call, vmap
+from tqdm import tqdm
+
+from meta_utils.trainer import get_parser, MetaQuantTrainer
+from utils.miscellaneous import accuracy, get_layer, PhaseTimer
+
+
+VMAP_METHODS = ['MultiFC', 'MultiFC-simple', 'MetaSimple']
+# Every variant is fed the batches of the first one
+SHARED_DATA_ARGS = ['dataset', 'batch_size']
+
+
+def get_variant_parser():
+
+    parser = argparse.ArgumentParser(description='Multi-variant meta quantization', add_help=False)
+    parser.add_argument('--variants', type=str, required=True,
+                        help='JSON list of argument overrides, one per variant (or a path to a JSON file)')
+    parser.add_argument('--compare_steps', type=int, default=20,
+                        help='Steps timed one variant after the other, then batched, to compare throughput (0: skip)')
+    return parser
+
+
+def meta_architecture(trainer):
+
+    return (trainer.meta_method, type(trainer.meta_net).__name__,
+            tuple((name, tuple(param.shape)) for name, param in trainer.meta_net.named_parameters()))
+
+
+class MultiVariantTrainer(object):
+
+    def __init__(self, base_args, variants):
+
+        if base_args.accum_steps > 1:
+            raise NotImplementedError('Gradient accumulation is not supported with several variants')
+        if int(os.environ.get('WORLD_SIZE', 1)) > 1:
+            raise NotImplementedError('Distributed training is not supported with several variants')
+
+        for idx, overrides in enumerate(variants):
+            shared = [name for name in SHARED_DATA_ARGS if name in overrides]
+            if len(shared) > 0:
+                raise NotImplementedError('Variant %d overrides %s: the variants share one mini-batch stream'
+                                          % (idx, ', '.join(shared)))
+
+        self.variants = variants
+        self.trainers = []
+        for idx, overrides in enumerate(variants):
+            args = copy.deepcopy(base_args)
+            for name, value in overrides.items():
+                setattr(args, name, value)
+            args.exp_spec = 'variant%d' % idx if base_args.exp_spec == '' else '%s-variant%d' % (base_args.exp_spec, idx)
+            args.checkpoint_dir = os.path.join(base_args.checkpoint_dir, 'variant%d' % idx)
+            args.result_cache = False
+            args.async_eval = False
+            self.trainers.append(MetaQuantTrainer(args))
+
+        # One mini-batch stream for every variant
+        self.train_loader = self.trainers[0].train_loader
+        for trainer in self.trainers[1:]:
+            trainer.test_loader = self.trainers[0].test_loader
+
+        groups = dict()
+        self.unbatched = []
+        for trainer in self.trainers:
+            if trainer.meta_method in VMAP_METHODS and trainer.subsampler is None and not trainer.use_lora:
+                groups.setdefault(meta_architecture(trainer), []).append(trainer)
+            else:
+                self.unbatched.append(trainer)
+        self.groups = list(groups.values())
+        # Variants that have not early-stopped
+        self.active = list(self.trainers)
+        print('%d variants: %d vmapped group(s) of sizes %s, %d run one by one'
+              % (len(self.trainers), len(self.groups), [len(group) for group in self.groups], len(self.unbatched)))
+
+        self.timer = PhaseTimer(['data', 'meta_grad', 'step'])
+
+    def generate_meta_grad_batched(self, group):
+        """Meta gradients of every variant of the group, one vmapped meta net call per layer"""
+        base_meta_net = group[0].meta_net
+        # Stacked on the fly, so that the gradients flow back to the parameters of every meta net
+        params = {name: torch.stack([dict(trainer.meta_net.named_parameters())[name] for trainer in group])
+                  for name, _ in base_meta_net.named_parameters()}
+        batched_meta_net = vmap(lambda stacked_params, x: functional_call(base_meta_net, stacked_params, (x,)))
+
+        for trainer in group:
+            trainer.meta_grad_dict = dict()
+
+        for layer_name, layer_idx in group[0].net.layer_name_list:
+            layers = [get_layer(trainer.net, layer_idx) for trainer in group]
+            meta_input = torch.stack([layer.pre_quantized_weight.data.view(-1, 1) for layer in layers])
+            meta_output = batched_meta_net(params, meta_input)
+
+            for trainer, layer, output in zip(group, layers, meta_output):
+                grad = layer.quantized_grads.data
+                meta_grad = (grad.view(-1, 1) * output).reshape(grad.shape)
+                bias_grad = layer.bias.grad.data.clone() if layer.bias is not None else None
+                trainer.meta_grad_dict[layer_name] = (layer_idx, meta_grad, bias_grad)
+
+    def train_step(self, epoch, batch_idx, inputs, targets, end, batched=True):
+        """One training step of every active variant, batched: vmapped meta nets (the main networks run one by one)"""
+
+        for trainer in self.active:
+            trainer.zero_meta_grad()
+
+        # Ignore the first meta gradient generation due to the lack of natural gradient
+        if not (batch_idx == 0 and epoch == 0):
+            with self.timer.phase('meta_grad'):
+                if batched:
+                    for group in self.groups:
+                        group = [trainer for trainer in group if trainer in self.active]
+                        if len(group) > 0:
+                            self.generate_meta_grad_batched(group)
+                    for trainer in self.unbatched:
+                        if trainer in self.active:
+                            trainer.generate_meta_grad()
+                else:
+                    for trainer in self.active:
+                        trainer.generate_meta_grad()
+
+        with self.timer.phase('step'):
+            for trainer in self.active:
+                outputs = trainer.forward(inputs)
+                losses = trainer.backward(outputs, targets)
+                trainer.meta_step()
+                if trainer.refine():
+                    trainer.update()
+                trainer.recorder.update(loss=losses.data.item(), acc=accuracy(outputs.data, targets.data, (1, 5)),
+                                        batch_size=outputs.shape[0], cur_lr=trainer.optimizee.param_groups[0]['lr'],
+                                        end=end)
+
+    def compare_throughput(self, data_iter, n_steps, epoch):
+        """
+        Time n_steps with every variant on its own (as K separate runs would, each also loading the
+        data) and n_steps batched. These are regular training steps.
+        :return: number of steps consumed
+        """
+        timing = dict()
+        for batched in [False, True]:
+            self.timer.reset()
+            start_time = time.time()
+            for step in range(n_steps):
+                with self.timer.phase('data'):
+                    inputs, targets = next(data_iter)
+                    if self.trainers[0].use_cuda:
+                        inputs, targets = inputs.cuda(), targets.cuda()
+                self.train_step(epoch, 1 + step + (n_steps if batched else 0), inputs, targets, time.time(), batched)
+            elapsed = time.time() - start_time
+            if not batched:
+                # Separate runs load and augment every batch once per variant
+                elapsed += (len(self.active) - 1) * self.timer.total['data']
+            timing[batched] = elapsed
+
+        n_images = n_steps * self.trainers[0].batch_size * len(self.active)
+        print('Aggregate throughput of %d variants: %.1f img/s in one process vs %.1f img/s as separate runs (%.2fx)'
+              % (len(self.active), n_images / timing[True], n_images / timing[False], timing[False] / timing[True]))
+        return 2 * n_steps
+
+    def fit(self, compare_steps=0):
+
+        for epoch in range(self.trainers[0].MAX_EPOCH):
+
+            if len(self.active) == 0: break
+            print('\nEpoch: %d, %d active variants' % (epoch, len(self.active)))
+
+            for trainer in self.active:
+                trainer.net.train()
+                trainer.recorder.reset_performance()
+
+            self.timer.reset()
+            start_time = time.time()
+            data_iter = iter(tqdm(self.train_loader, total=len(self.train_loader)))
+            batch_idx = 0
+            if epoch == 0:
+                # The first step has no meta gradient, run it before timing
+                inputs, targets = next(data_iter)
+                if self.trainers[0].use_cuda:
+                    inputs, targets = inputs.cuda(), targets.cuda()
+                self.train_step(epoch, 0, inputs, targets, time.time())
+                batch_idx = 1
+                if compare_steps > 0:
+                    batch_idx += self.compare_throughput(data_iter, compare_steps, epoch)
+            while True:
+                with self.timer.phase('data'):
+                    try:
+                        inputs, targets = next(data_iter)
+                    except StopIteration:
+                        break
+                    if self.trainers[0].use_cuda:
+                        inputs, targets = inputs.cuda(), targets.cuda()
+                self.train_step(epoch, batch_idx, inputs, targets, time.time())
+                batch_idx += 1
+            train_time = time.time() - start_time
+            print('Epoch time %.1fs, aggregate throughput %.1f img/s | %s'
+                  % (train_time, batch_idx * self.trainers[0].batch_size * len(self.active) / train_time,
+                     self.timer.summary()))
+
+            for idx, trainer in enumerate(self.trainers):
+                if trainer not in self.active:
+                    continue
+                test_acc = trainer.evaluate()
+                print('Variant %d %s: test acc %s' % (idx, self.variants[idx], test_acc))
+                trainer.recorder.adjust_lr(optimizer=trainer.optimizee, adjust_type=trainer.lr_adjust, epoch=epoch)
+                if trainer.recorder.stop:
+                    self.active.remove(trainer)
+
+        print('\n%-8s %-60s %s' % ('variant', 'overrides', 'best test acc'))
+        results = []
+        for idx, trainer in enumerate(self.trainers):
+            best_test_acc = trainer.recorder.get_best_test_acc()
+            results.append(best_test_acc)
+            print('%-8d %-60s %s' % (idx, json.dumps(self.variants[idx]), best_test_acc))
+        return results
+
+    def close(self):
+
+        for trainer in self.trainers:
+            trainer.close()
+
+
+if __name__ == '__main__':
+
+    variant_args, trainer_argv = get_variant_parser().parse_known_args()
+    base_args = get_parser().parse_args(trainer_argv)
+    if os.path.exists(variant_args.variants):
+        with open(variant_args.variants) as f:
+            variants = json.load(f)
+    else:
+        variants = json.loads(variant_args.variants)
+
+    multi_trainer = MultiVariantTrainer(base_args, variants)
+    multi_trainer.fit(compare_steps=variant_args.compare_steps)
+    multi_trainer.close()
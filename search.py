@@ -0,0 +1,134 @@
+"""
+Successive halving search over meta-quantize configurations.
+
+    python search.py --space sweeps/search-space.json --n_configs 27 --min_epochs 5 --eta 3 \
+        -m ResNet56 -d CIFAR100 -q dorefa -bw 1 -o adam -n 135
+
+n_configs configurations are sampled from the search space and trained for min_epochs epochs. At
+every rung the best 1 / eta of them (scored by Recorder.get_best_test_acc) are promoted and trained
+eta times longer, resuming from their checkpoint, until --n_epoch is reached. Arguments that are
+not listed below are the base arguments of meta-quantize.py.
+
+The search space maps argument names (dest of meta-quantize.py) to a list of choices or to a
+{"uniform": [low, high]}, {"log_uniform": [low, high]} or {"int_uniform": [low, high]} range:
+{"meta_type": ["MultiFC", "LSTMFC"], "hidden_size": [50, 100, 200], "init_lr": {"log_uniform": [1e-4, 1e-2]}}
+"""
+import os
+import copy
+import json
+import math
+import random
+import argparse
+from collections import OrderedDict
+
+from meta_utils.trainer import get_parser, MetaQuantTrainer
+
+
+def get_search_parser():
+
+    parser = argparse.ArgumentParser(description='Successive halving over meta quantization', add_help=False)
+    parser.add_argument('--space', type=str, required=True, help='JSON search space')
+    parser.add_argument('--n_configs', type=int, default=27, help='Number of sampled configurations')
+    parser.add_argument('--min_epochs', type=int, default=5, help='Epoch budget of the first rung')
+    parser.add_argument('--eta', type=int, default=3, help='Keep 1 / eta of the configurations at every rung')
+    parser.add_argument('--search_dir', type=str, default='./Results/search', help='Checkpoints and results')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser
+
+
+def sample_config(space, rng):
+
+    config = OrderedDict()
+    for name, values in space.items():
+        if isinstance(values, list):
+            config[name] = rng.choice(values)
+        elif 'uniform' in values:
+            config[name] = rng.uniform(*values['uniform'])
+        elif 'log_uniform' in values:
+            low, high = values['log_uniform']
+            config[name] = math.exp(rng.uniform(math.log(low), math.log(high)))
+        elif 'int_uniform' in values:
+            config[name] = rng.randint(*values['int_uniform'])
+        else:
+            raise NotImplementedError('Search space entry %s: %s is not supported' % (name, values))
+    return config
+
+
+def score(best_test_acc):
+    """Recorder.get_best_test_acc returns (top1, top5) on ImageNet, rank by top1"""
+    return best_test_acc[0] if isinstance(best_test_acc, tuple) else best_test_acc
+
+
+def rung_budgets(min_epochs, max_epochs, eta):
+
+    budgets = [min_epochs]
+    while budgets[-1] * eta < max_epochs:
+        budgets.append(budgets[-1] * eta)
+    if budgets[-1] < max_epochs:
+        budgets.append(max_epochs)
+    return budgets
+
+
+def train_trial(base_args, trial, n_epoch, search_dir):
+    """
+    Train a trial up to n_epoch epochs, resuming from its checkpoint if it was trained before
+    :return: best test accuracy so far
+    """
+    args = copy.deepcopy(base_args)
+    for name, value in trial['config'].items():
+        setattr(args, name, value)
+    args.n_epoch = n_epoch
+    args.exp_spec = 'search-%s' % trial['name'] if base_args.exp_spec == '' \
+        else '%s-search-%s' % (base_args.exp_spec, trial['name'])
+    args.checkpoint_dir = os.path.join(search_dir, trial['name'])
+    args.checkpoint_freq = 1
+    args.break_continue = trial['epochs'] > 0
+    # n_epoch is part of the result cache key, the cache would not find the checkpoint of the previous rung
+    # (the checkpoint directory itself does not depend on n_epoch)
+    args.result_cache = False
+    args.async_eval = False
+
+    trainer = MetaQuantTrainer(args)
+    best_test_acc = trainer.fit()
+    trainer.close()
+    trial['epochs'] = n_epoch
+    return best_test_acc
+
+
+if __name__ == '__main__':
+
+    search_args, trainer_argv = get_search_parser().parse_known_args()
+    base_args = get_parser().parse_args(trainer_argv)
+
+    with open(search_args.space) as f:
+        space = json.load(f, object_pairs_hook=OrderedDict)
+
+    rng = random.Random(search_args.seed)
+    trials = [{'name': 'trial%02d' % idx, 'config': sample_config(space, rng), 'epochs': 0, 'scores': {}}
+              for idx in range(search_args.n_configs)]
+    budgets = rung_budgets(search_args.min_epochs, base_args.n_epoch, search_args.eta)
+    print('Rung budgets (epochs): %s' % budgets)
+
+    if not os.path.exists(search_args.search_dir):
+        os.makedirs(search_args.search_dir)
+
+    alive = trials
+    for rung, budget in enumerate(budgets):
+        for trial in alive:
+            print('\n[Rung %d] %s, %d epochs: %s' % (rung, trial['name'], budget, dict(trial['config'])))
+            trial['scores'][budget] = score(train_trial(base_args, trial, budget, search_args.search_dir))
+
+        alive = sorted(alive, key=lambda trial: trial['scores'][budget], reverse=True)
+        print('\n[Rung %d] ranking after %d epochs:' % (rung, budget))
+        for trial in alive:
+            print('  %s: %.3f %s' % (trial['name'], trial['scores'][budget], dict(trial['config'])))
+
+        with open(os.path.join(search_args.search_dir, 'search.json'), 'w') as f:
+            json.dump({'budgets': budgets, 'trials': trials}, f, indent=1)
+
+        if rung < len(budgets) - 1:
+            alive = alive[:max(1, len(alive) // search_args.eta)]
+
+    best = alive[0]
+    print('\nBest configuration %s (%.3f after %d epochs): %s'
+          % (best['name'], best['scores'][budgets[-1]], budgets[-1], dict(best['config'])))
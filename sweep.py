@@ -0,0 +1,219 @@
+"""
+Run a sweep of experiments concurrently on the local CPU cores.
+
+    python sweep.py sweeps/resnet56-cifar100.json
+
+The config (JSON, comments for illustration only) lists runs explicitly and / or as grids:
+{
+    "log_dir": "out",
+    "cores": null,                       # cores to use, default: every core available to this process
+    "threads": 4,                        # default thread budget of a run
+    "runs": [
+        {"name": "full-precision", "script": "full_precision.py", "threads": 8,
+         "args": {"-m": "ResNet56", "-d": "CIFAR100", "-o": "Adam", "--epoch": 500}}
+    ],
+    "grids": [
+        {"name": "meta-{-meta}", "script": "meta-quantize.py",
+         "args": {"-m": "ResNet56", "-d": "CIFAR100", "-lr": 1e-3},
+         "grid": {"-meta": ["MultiFC", "LSTMFC"]}}
+    ]
+}
+
+Every run gets its own set of `threads` cores (sched_setaffinity) and the same OMP / MKL thread
+budget; runs that do not fit are queued until cores are released. "env" adds environment variables
+(e.g. CUDA_VISIBLE_DEVICES) and "after" names runs that must have succeeded first. Status, wall time
+and best test accuracy (parsed from the log) of every run are written to <log_dir>/summary.json and
+printed as a table.
+"""
+import os
+import re
+import sys
+import json
+import time
+import itertools
+import subprocess
+from collections import OrderedDict
+
+
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']
+BEST_ACC_PATTERNS = [
+    re.compile(r'Best test top 1 acc: ([0-9.]+)'),
+    re.compile(r'Best test acc: ([0-9.]+)'),
+    re.compile(r'best_test_acc: ([0-9.]+)'),
+    re.compile(r'Test ACC:\s+([0-9.]+)'),
+]
+
+
+def expand_runs(config):
+    """Explicit runs followed by the cartesian product of every grid, as a list of run dicts"""
+    runs = [dict(run) for run in config.get('runs', [])]
+    for grid in config.get('grids', []):
+        keys = list(grid['grid'].keys())
+        for values in itertools.product(*[grid['grid'][key] for key in keys]):
+            run = {key: value for key, value in grid.items() if key not in ['grid', 'name']}
+            run['args'] = OrderedDict(grid.get('args', {}))
+            run['args'].update(zip(keys, values))
+            name = grid.get('name', os.path.splitext(grid['script'])[0])
+            for key, value in zip(keys, values):
+                name = name.replace('{%s}' % key, str(value))
+            run['name'] = name
+            runs.append(run)
+
+    names = [run['name'] for run in runs]
+    if len(set(names)) != len(names):
+        raise ValueError('Run names must be unique: %s' % names)
+    return runs
+
+
+def build_command(run):
+
+    command = [sys.executable, run['script']]
+    for key, value in run.get('args', {}).items():
+        if value is True:
+            command.append(key)
+        elif value is False or value is None:
+            continue
+        else:
+            command += [key, str(value)]
+    return command
+
+
+def parse_best_acc(log_path):
+
+    if not os.path.exists(log_path):
+        return None
+    with open(log_path, errors='ignore') as f:
+        log = f.read()
+    for pattern in BEST_ACC_PATTERNS:
+        matches = pattern.findall(log)
+        if len(matches) > 0:
+            return float(matches[-1])
+    return None
+
+
+class SweepScheduler(object):
+    """
+    Pack runs onto disjoint sets of cores: a run is started as soon as `threads` cores are free
+    (and the runs it depends on succeeded), otherwise it waits in the queue, in config order.
+    """
+
+    def __init__(self, runs, log_dir, cores=None, default_threads=4, poll_interval=1.0):
+
+        available = sorted(os.sched_getaffinity(0))
+        self.free_cores = available[:cores] if cores is not None else available
+        self.runs = runs
+        self.log_dir = log_dir
+        self.default_threads = default_threads
+        self.poll_interval = poll_interval
+
+        self.queue = list(runs)
+        self.running = dict()  # name -> (run, process, cores, log file, start time)
+        self.results = OrderedDict((run['name'], {'status': 'queued'}) for run in runs)
+        self.n_cores = len(self.free_cores)
+
+        if not os.path.exists(log_dir):
+            os.makedirs(log_dir)
+
+    def threads(self, run):
+        # Thread budgets larger than the box are clamped, so that every run can start
+        return min(run.get('threads', self.default_threads), self.n_cores)
+
+    def ready(self, run):
+        return all(self.results[name]['status'] == 'done' for name in run.get('after', []))
+
+    def blocked(self, run):
+        return any(self.results[name]['status'] in ['failed', 'skipped'] for name in run.get('after', []))
+
+    def start(self, run):
+
+        threads = self.threads(run)
+        cores, self.free_cores = self.free_cores[:threads], self.free_cores[threads:]
+        env = dict(os.environ)
+        env.update({key: str(value) for key, value in run.get('env', {}).items()})
+        for name in THREAD_ENV_VARS:
+            env[name] = str(threads)
+
+        command = build_command(run)
+        log_path = os.path.join(self.log_dir, '%s.log' % run['name'])
+        log_file = open(log_path, 'w')
+        process = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT, env=env,
+                                   preexec_fn=lambda: os.sched_setaffinity(0, cores))
+        self.running[run['name']] = (run, process, cores, log_file, time.time())
+        self.results[run['name']] = {'status': 'running', 'cores': cores, 'command': ' '.join(command),
+                                     'log': log_path}
+        print('[%s] Start %s on cores %s: %s' % (time.strftime('%H:%M:%S'), run['name'], cores, ' '.join(command)))
+
+    def poll(self):
+
+        for name in list(self.running.keys()):
+            run, process, cores, log_file, start_time = self.running[name]
+            if process.poll() is None:
+                continue
+            log_file.close()
+            self.free_cores = sorted(self.free_cores + cores)
+            del self.running[name]
+            result = self.results[name]
+            result['status'] = 'done' if process.returncode == 0 else 'failed'
+            result['returncode'] = process.returncode
+            result['wall_time'] = time.time() - start_time
+            result['best_acc'] = parse_best_acc(result['log'])
+            print('[%s] %s %s in %.1f min' % (time.strftime('%H:%M:%S'), name, result['status'],
+                                              result['wall_time'] / 60))
+
+    def schedule(self):
+
+        for run in list(self.queue):
+            if self.blocked(run):
+                self.queue.remove(run)
+                self.results[run['name']] = {'status': 'skipped'}
+            elif self.ready(run) and self.threads(run) <= len(self.free_cores):
+                self.queue.remove(run)
+                self.start(run)
+
+    def run(self):
+
+        try:
+            while len(self.queue) > 0 or len(self.running) > 0:
+                self.poll()
+                self.schedule()
+                if len(self.running) == 0 and len(self.queue) > 0:
+                    # Only runs waiting for a dependency that will never finish
+                    for run in self.queue:
+                        self.results[run['name']] = {'status': 'skipped'}
+                    break
+                time.sleep(self.poll_interval)
+        finally:
+            for name, (run, process, cores, log_file, start_time) in self.running.items():
+                process.terminate()
+                log_file.close()
+                self.results[name]['status'] = 'killed'
+            self.save_summary()
+        return self.results
+
+    def save_summary(self):
+
+        with open(os.path.join(self.log_dir, 'summary.json'), 'w') as f:
+            json.dump(self.results, f, indent=1)
+
+        print('\n%-40s %-8s %10s %10s' % ('run', 'status', 'time (min)', 'best acc'))
+        for name, result in self.results.items():
+            wall_time = result.get('wall_time')
+            best_acc = result.get('best_acc')
+            print('%-40s %-8s %10s %10s' % (name, result['status'],
+                                            '%.1f' % (wall_time / 60) if wall_time is not None else '-',
+                                            '%.3f' % best_acc if best_acc is not None else '-'))
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) != 2:
+        print('Usage: python sweep.py <sweep config json>')
+        sys.exit(1)
+
+    with open(sys.argv[1]) as f:
+        config = json.load(f, object_pairs_hook=OrderedDict)
+
+    scheduler = SweepScheduler(expand_runs(config), log_dir=config.get('log_dir', 'out'),
+                               cores=config.get('cores'), default_threads=config.get('threads', 4))
+    results = scheduler.run()
+    sys.exit(0 if all(result['status'] == 'done' for result in results.values()) else 1)
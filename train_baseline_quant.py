@@ -10,6 +10,7 @@ from utils.dataset import get_dataloader
 from utils.miscellaneous import accuracy
 from utils.quantize import test
 from utils.recorder import Recorder
+from utils.profiling import StepProfiler
 
 import torch
 import torch.nn as nn
@@ -19,7 +20,7 @@ import torch.optim as optim
 ################
 # Import Model #
 ################
-from models_CIFAR.quantized_resnet import resnet20_cifar, resnet32_cifar, resnet56_cifar, resnet44_cifar, resnet110_cifar
+from models_CIFAR.quantized_resnet import build_quantized_resnet
 # from models_ImageNet.quantized_resnet import resnet18, resnet34, resnet50
 
 # ---------------------------- Configuration --------------------------
@@ -42,6 +43,8 @@ parser.add_argument('--bitW', '-bitW', type=int, default=1, help='Compression ra
 parser.add_argument('--lr_adjust', '-ad', type=str, default='30', help='LR adjusting method')
 parser.add_argument('--batch_size', '-bs', type=int, default=128, help='Batch size')
 parser.add_argument('--n_epoch', '-n', type=int, default=100, help='Maximum training epochs')
+parser.add_argument('--profile-steps', '--profile_steps', dest='profile_steps', type=str, default='',
+                    help='Profile the training iterations START:END with torch.profiler, saved into SummaryPath')
 args = parser.parse_args()
 # --------------------------------------------------------------------
 use_cuda = torch.cuda.is_available()
@@ -65,18 +68,7 @@ test_loader = get_dataloader(dataset_name, 'test', 100)
 ###################
 # Initial Network #
 ###################
-if model_name == 'ResNet20':
-    net = resnet20_cifar(bitW=bitW)
-elif model_name == 'ResNet32':
-    net = resnet32_cifar(bitW=bitW)
-elif model_name == 'ResNet44':
-    net = resnet44_cifar(bitW=bitW)
-elif model_name == 'ResNet56':
-    net = resnet56_cifar(bitW=bitW, num_classes=100)
-elif model_name == 'ResNet110':
-    net = resnet110_cifar(bitW=bitW, num_classes=100)
-else:
-    raise NotImplementedError
+net = build_quantized_resnet(model_name, bitW=bitW)
 
 pretrain_path = '%s/%s-%s-pretrain.pth' % (save_root, model_name, dataset_name)
 net.load_state_dict(torch.load(pretrain_path))
@@ -116,6 +108,7 @@ else:
     os.makedirs(SummaryPath)
 
 recorder = Recorder(SummaryPath=SummaryPath, dataset_name=dataset_name)
+profiler = StepProfiler(args.profile_steps, SummaryPath, use_cuda=use_cuda)
 
 for epoch in range(n_epoch):
 
@@ -144,6 +137,7 @@ for epoch in range(n_epoch):
                         batch_size=outputs.shape[0], cur_lr=optimizer.param_groups[0]['lr'], end=end)
 
         recorder.print_training_result(batch_idx, len(train_loader))
+        profiler.step()
         end = time.time()
 
     test_acc = test(net=net, quantized_type=quantized_type,
@@ -158,4 +152,5 @@ if type(best_test_acc) == tuple:
     print('Best test top 1 acc: %.3f, top 5 acc: %.3f' % (best_test_acc[0], best_test_acc[1]))
 else:
     print('Best test acc: %.3f' %best_test_acc)
+profiler.close()
 recorder.close()
\ No newline at end of file
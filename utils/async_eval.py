@@ -0,0 +1,124 @@
+"""
+Evaluate weight snapshots in a background process while training goes on
+"""
+import os
+import time
+import queue
+
+import torch
+import torch.multiprocessing as mp
+
+import utils.global_var as gVar
+
+
+def _global_vars():
+    """Settings of utils.global_var that change how the evaluator rebuilds the network"""
+    return {name: getattr(gVar, name) for name in ['a32', 'act_quant', 'act_per_channel', 'act_momentum']}
+
+
+def _eval_worker(model_name, dataset_name, bitW, alpha, global_vars, quantized_type, n_threads, cores,
+                 shared_states, requests, results):
+
+    from models_CIFAR.quantized_meta_resnet import build_meta_resnet
+    from utils.dataset import get_dataloader
+    from utils.quantize import test
+
+    if cores is not None:
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(n_threads)
+    for name, value in global_vars.items():
+        setattr(gVar, name, value)
+
+    net = build_meta_resnet(model_name, dataset_name, bitW=bitW, alpha=alpha)
+    test_loader = get_dataloader(dataset_name, 'test', 100)
+
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        epoch, niter, slot = request
+        start_time = time.time()
+        net.load_state_dict(shared_states[slot])
+        test_acc = test(net, quantized_type=quantized_type, test_loader=test_loader, use_cuda=False,
+                        dataset_name=dataset_name, n_batches_used=None, fast=True)
+        results.put((epoch, niter, slot, test_acc, time.time() - start_time))
+
+
+class AsyncEvaluator(object):
+    """
+    Evaluate the network in a separate process on its own cores.
+
+    submit() copies the state dict (latent weights and BN statistics) into one of n_slots buffers
+    in shared memory and returns; the evaluator process rebuilds the quantized network from it and
+    runs test() with the fast path. With two slots the next epoch can be submitted while the
+    previous one is evaluated; submit() only blocks when every slot is still in use. Results come
+    back through poll() / wait() as (epoch, niter, test_acc, eval_time), in submission order.
+    """
+
+    def __init__(self, net, model_name, dataset_name, quantized_type, bitW=1, alpha=0.9, n_threads=1, cores=None,
+                 n_slots=2):
+
+        state_dict = net.state_dict()
+        self.shared_states = [
+            {key: value.detach().to('cpu', copy=True).share_memory_() for key, value in state_dict.items()}
+            for _ in range(n_slots)
+        ]
+        self.free_slots = list(range(n_slots))
+        self.finished = []
+        self.n_pending = 0
+
+        ctx = mp.get_context('spawn')
+        self.requests = ctx.Queue()
+        self.results = ctx.Queue()
+        self.process = ctx.Process(target=_eval_worker, args=(
+            model_name, dataset_name, bitW, alpha, _global_vars(), quantized_type, n_threads, cores,
+            self.shared_states, self.requests, self.results))
+        self.process.start()
+        print('Evaluator process %d started with %d threads on cores %s' % (self.process.pid, n_threads, cores))
+
+    def submit(self, net, epoch, niter):
+
+        if len(self.free_slots) == 0:
+            self._collect(block=True)
+        slot = self.free_slots.pop(0)
+        with torch.no_grad():
+            for key, value in net.state_dict().items():
+                self.shared_states[slot][key].copy_(value)
+        self.requests.put((epoch, niter, slot))
+        self.n_pending += 1
+
+    def _collect(self, block):
+
+        while self.n_pending > 0:
+            try:
+                epoch, niter, slot, test_acc, eval_time = self.results.get(timeout=1.0 if block else 0.01)
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise RuntimeError('Evaluator process exited with code %s' % self.process.exitcode)
+                if block:
+                    continue
+                return
+            self.free_slots.append(slot)
+            self.n_pending -= 1
+            self.finished.append((epoch, niter, test_acc, eval_time))
+            if block:
+                return
+
+    def poll(self):
+        """Results finished so far, without blocking"""
+        self._collect(block=False)
+        finished, self.finished = self.finished, []
+        return finished
+
+    def wait(self):
+        """Wait for every submitted evaluation"""
+        while self.n_pending > 0:
+            self._collect(block=True)
+        finished, self.finished = self.finished, []
+        return finished
+
+    def close(self):
+
+        if self.process.is_alive():
+            self.requests.put(None)
+            self.process.join()
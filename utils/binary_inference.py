@@ -0,0 +1,292 @@
+"""
+CPU inference of bit-packed CIFAR ResNets (export.py --format packed) with XNOR / popcount.
+
+With binary activations (exported with gVar.a32 False), a quantized conv / linear layer computes
+    sum_k a_k * w_k = n_valid - 2 * popcount((a XOR w) AND mask)
+for a, w in {-1, +1} encoded as bits (1 for +1). Weights are the packed rows of the file viewed as
+int64 words; activations are packed the same way after im2col. The mask removes the zero padding of
+convolutions (and the exact zeros of the sign of linear inputs), which contribute 0 to the float
+convolution. The conv1 -> bn1 -> relu -> binarize path inside a BasicBlock is reduced to per-channel
+thresholds on the integer accumulator; the other BN layers are folded into a per-channel scale and
+shift of the accumulator.
+
+With float activations (gVar.a32 True, the default of meta-quantize.py) the same graph runs float
+convolutions with the unpacked weights.
+"""
+import re
+import time
+
+import torch
+import torch.nn.functional as F
+
+from utils.export import PackedModel
+
+
+BN_EPS = 1e-5
+
+_M1 = 0x5555555555555555
+_M2 = 0x3333333333333333
+_M4 = 0x0f0f0f0f0f0f0f0f
+_SHIFTS = torch.arange(64, dtype=torch.int64)
+
+
+def popcount64(x):
+    """Number of set bits of every int64 word (SWAR)"""
+    x = x - ((x >> 1) & _M1)
+    x = (x & _M2) + ((x >> 2) & _M2)
+    x = (x + (x >> 4)) & _M4
+    x = x + (x >> 8)
+    x = x + (x >> 16)
+    x = x + (x >> 32)
+    return x & 0x7f
+
+
+def pack_bits(bits):
+    """
+    :param bits: bool tensor (..., K)
+    :return: int64 tensor (..., ceil(K / 64)), bit i of word j is element 64 * j + i (utils.export.pack_signs order)
+    """
+    bits = bits.long()
+    n_pad = -bits.shape[-1] % 64
+    if n_pad > 0:
+        bits = F.pad(bits, (0, n_pad))
+    bits = bits.view(*bits.shape[:-1], -1, 64)
+    return (bits << _SHIFTS).sum(dim=-1)
+
+
+def fold_bn(tensors, prefix):
+    """
+    BN in eval mode as y * a + c
+    :return: per-channel a, c
+    """
+    gamma, beta = tensors['%s.weight' % prefix], tensors['%s.bias' % prefix]
+    mean, var = tensors['%s.running_mean' % prefix], tensors['%s.running_var' % prefix]
+    a = gamma / torch.sqrt(var + BN_EPS)
+    return a, beta - mean * a
+
+
+def _channel(x, dim):
+    shape = [1] * dim
+    shape[1] = -1
+    return x.view(*shape)
+
+
+class BinaryConv2d(object):
+
+    def __init__(self, packed, layer):
+
+        if layer['groups'] != 1:
+            raise NotImplementedError('Grouped binary convolution is not supported')
+        self.out_channels, _, kernel_size, _ = layer['shape']
+        self.kernel_size, self.stride = kernel_size, layer['stride']
+        self.padding, self.dilation = layer['padding'], layer['dilation']
+        self.weight_words = torch.from_numpy(packed.array(layer['bits']).copy()).view(torch.int64)
+        self.scale = torch.from_numpy(packed.array(layer['scale']).copy()) if layer['scale'] is not None else None
+        self.bias = torch.from_numpy(packed.array(layer['bias']).copy()) if layer['bias'] is not None else None
+        # Float weight (scale included) for float activations
+        self.weight = packed.weight(layer)
+        self.masks = dict()
+
+    def output_size(self, size):
+        return (size + 2 * self.padding - self.dilation * (self.kernel_size - 1) - 1) // self.stride + 1
+
+    def unfold(self, x):
+        return F.unfold(x, self.kernel_size, dilation=self.dilation, padding=self.padding, stride=self.stride)
+
+    def mask(self, in_channels, height, width):
+        """Packed mask of the taps inside the input and their number, for every output position"""
+        key = (in_channels, height, width)
+        if key not in self.masks:
+            valid = self.unfold(torch.ones(1, in_channels, height, width))[0].t() > 0.5  # (L, K)
+            self.masks[key] = (pack_bits(valid), valid.sum(dim=1))
+        return self.masks[key]
+
+    def accumulate(self, bits):
+        """
+        :param bits: bool (N, C, H, W) activation signs
+        :return: int64 (N, O, H', W') dot products of the +1 / -1 activations and weights
+        """
+        n, c, h, w = bits.shape
+        columns = pack_bits(self.unfold(bits.float()).transpose(1, 2) > 0.5)  # (N, L, words)
+        mask, n_valid = self.mask(c, h, w)
+        xor = (columns.unsqueeze(2) ^ self.weight_words.unsqueeze(0).unsqueeze(0)) & mask.unsqueeze(1).unsqueeze(0)
+        accumulator = n_valid.view(1, -1, 1) - 2 * popcount64(xor).sum(dim=-1)  # (N, L, O)
+        return accumulator.transpose(1, 2).reshape(n, self.out_channels, self.output_size(h), self.output_size(w))
+
+    def forward(self, x, binary):
+
+        if not binary:
+            return F.conv2d(x, self.weight, self.bias, self.stride, self.padding, self.dilation)
+        y = self.accumulate(x > 0).float()
+        if self.scale is not None:
+            y = y * _channel(self.scale, 4)
+        return y + _channel(self.bias, 4) if self.bias is not None else y
+
+
+class BinaryLinear(object):
+
+    def __init__(self, packed, layer):
+
+        self.out_features = layer['shape'][0]
+        self.weight_words = torch.from_numpy(packed.array(layer['bits']).copy()).view(torch.int64)
+        self.scale = torch.from_numpy(packed.array(layer['scale']).copy()) if layer['scale'] is not None else None
+        self.bias = torch.from_numpy(packed.array(layer['bias']).copy()) if layer['bias'] is not None else None
+        self.weight = packed.weight(layer)
+
+    def accumulate(self, x):
+        """
+        :param x: float (N, K) input, quantized by its sign (0 for exact zeros)
+        :return: int64 (N, O)
+        """
+        signs, mask = pack_bits(x > 0), pack_bits(x != 0)
+        xor = (signs.unsqueeze(1) ^ self.weight_words.unsqueeze(0)) & mask.unsqueeze(1)
+        return popcount64(mask).sum(dim=-1, keepdim=True) - 2 * popcount64(xor).sum(dim=-1)
+
+    def forward(self, x, binary):
+
+        if not binary:
+            return F.linear(x, self.weight, self.bias)
+        y = self.accumulate(x).float()
+        if self.scale is not None:
+            y = y * self.scale
+        return y + self.bias if self.bias is not None else y
+
+
+class BinaryBasicBlock(object):
+
+    def __init__(self, packed, tensors, layers, prefix):
+
+        self.conv1 = BinaryConv2d(packed, layers['%s.conv1' % prefix])
+        self.conv2 = BinaryConv2d(packed, layers['%s.conv2' % prefix])
+        self.bn1 = fold_bn(tensors, '%s.bn1' % prefix)
+        self.bn2 = fold_bn(tensors, '%s.bn2' % prefix)
+        if '%s.downsample.0' % prefix in layers:
+            self.downsample = BinaryConv2d(packed, layers['%s.downsample.0' % prefix])
+            self.downsample_bn = fold_bn(tensors, '%s.downsample.1' % prefix)
+        else:
+            self.downsample = None
+
+        # binarize(relu(bn1(conv1))) is 1 iff a * y + c > 0 for the accumulator y of conv1: y > -c / a
+        # for a > 0, y < -c / a for a < 0, constant for a == 0
+        a, c = self.bn1
+        if self.conv1.scale is not None:
+            a = a * self.conv1.scale
+        if self.conv1.bias is not None:
+            c = c + self.bn1[0] * self.conv1.bias
+        nonzero = a != 0
+        self.direction = torch.where(nonzero, torch.sign(a), torch.ones_like(a))
+        self.threshold = torch.where(nonzero, -c / torch.where(nonzero, a, torch.ones_like(a)),
+                                     torch.where(c > 0, -torch.ones_like(c), torch.ones_like(c)) * float('inf'))
+
+    def forward(self, x, binary):
+
+        if binary:
+            y = self.conv1.accumulate(x > 0).float()
+            bits = _channel(self.direction, 4) * (y - _channel(self.threshold, 4)) > 0
+            y = self.conv2.accumulate(bits).float()
+            if self.conv2.scale is not None:
+                y = y * _channel(self.conv2.scale, 4)
+            if self.conv2.bias is not None:
+                y = y + _channel(self.conv2.bias, 4)
+        else:
+            out = F.relu(self.conv1.forward(x, binary) * _channel(self.bn1[0], 4) + _channel(self.bn1[1], 4))
+            y = self.conv2.forward(out, binary)
+        out = y * _channel(self.bn2[0], 4) + _channel(self.bn2[1], 4)
+
+        if self.downsample is not None:
+            residual = self.downsample.forward(x, binary) * _channel(self.downsample_bn[0], 4) \
+                       + _channel(self.downsample_bn[1], 4)
+        else:
+            residual = x
+        return F.relu(out + residual)
+
+
+class BinaryResNet(object):
+    """
+    Inference of a packed CIFAR ResNet (ResNet_Cifar with BasicBlock). binary defaults to the
+    activations of the export: XNOR / popcount when it was exported with gVar.a32 False, float
+    convolutions otherwise (binary=True on such a file computes another network, for timing only).
+    """
+
+    def __init__(self, path, binary=None):
+
+        self.packed = PackedModel(path)
+        manifest = self.packed.manifest
+        layers = {layer['name']: layer for layer in self.packed.layers}
+        tensors = {name: torch.from_numpy(self.packed.array(segment).copy())
+                   for name, segment in manifest['tensors'].items()}
+        if 'conv1' not in layers or 'fc' not in layers or any(name.endswith('conv3') for name in layers):
+            raise NotImplementedError('Only CIFAR ResNets with basic blocks are supported')
+
+        self.binary = not manifest['a32'] if binary is None else binary
+        self.conv1 = BinaryConv2d(self.packed, layers['conv1'])
+        self.bn1 = fold_bn(tensors, 'bn1')
+        prefixes = sorted(set(name[:-len('.conv1')] for name in layers if re.match(r'layer\d+\.\d+\.conv1$', name)),
+                          key=lambda prefix: [int(idx) for idx in re.findall(r'\d+', prefix)])
+        self.blocks = [BinaryBasicBlock(self.packed, tensors, layers, prefix) for prefix in prefixes]
+        self.bn2 = fold_bn(tensors, 'bn2')
+        self.fc = BinaryLinear(self.packed, layers['fc'])
+
+    def __call__(self, x):
+
+        with torch.no_grad():
+            x = F.relu(self.conv1.forward(x, self.binary) * _channel(self.bn1[0], 4) + _channel(self.bn1[1], 4))
+            for block in self.blocks:
+                x = block.forward(x, self.binary)
+            x = F.avg_pool2d(x, 8, stride=1)
+            x = x.view(x.size(0), -1) * self.bn2[0] + self.bn2[1]
+            return self.fc.forward(x, self.binary)
+
+
+def benchmark(forward, inputs, n_warmup=3, n_iters=20):
+    """
+    :return: median latency of a batch (s), images / s
+    """
+    with torch.no_grad():
+        for _ in range(n_warmup):
+            forward(inputs)
+        times = []
+        for _ in range(n_iters):
+            start_time = time.time()
+            forward(inputs)
+            times.append(time.time() - start_time)
+    latency = sorted(times)[len(times) // 2]
+    return latency, inputs.shape[0] / latency
+
+
+if __name__ == '__main__':
+
+    # python -m utils.binary_inference resnet20.mqpack [n_test_batches]
+    # Parity with the float reference on test batches, then latency of a test batch for both
+    import sys
+    import utils.global_var as gVar
+    from models_CIFAR.quantized_meta_resnet import build_meta_resnet
+    from utils.dataset import get_dataloader
+    from utils.export import compare_outputs
+    from utils.quantize import prepare_fast_eval
+
+    path = sys.argv[1]
+    n_batches = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    engine = BinaryResNet(path)
+    manifest = engine.packed.manifest
+    quantized_type = manifest['quantized_type']
+    gVar.a32 = manifest['a32']
+    reference = build_meta_resnet(manifest['model'], manifest['dataset'], bitW=manifest['bitW'])
+    reference.load_state_dict(engine.packed.state_dict())
+    reference.eval()
+    prepare_fast_eval(reference, quantized_type, channels_last=False)
+
+    def reference_forward(x):
+        return reference(x, quantized_type)
+
+    test_loader = get_dataloader(manifest['dataset'], 'test', 100, shuffle=False)
+    max_diff, agreement = compare_outputs(reference_forward, engine, test_loader, n_batches=n_batches)
+    print('%s activations: max logit difference %.2e, same predictions on %.2f%% of %d batches'
+          % ('Binary (XNOR / popcount)' if engine.binary else 'Float', max_diff, 100.0 * agreement, n_batches))
+
+    inputs, _ = next(iter(test_loader))
+    for name, forward in [('fp32 reference', reference_forward), ('packed engine', engine)]:
+        latency, throughput = benchmark(forward, inputs)
+        print('%-16s %8.2f ms / batch of %d, %8.1f img/s (%d threads)'
+              % (name, 1e3 * latency, inputs.shape[0], throughput, torch.get_num_threads()))
@@ -0,0 +1,349 @@
+"""
+Asynchronous, atomic checkpointing of the full training state
+"""
+import io
+import os
+import json
+import zlib
+import random
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+
+def get_rng_state():
+
+    rng_state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        rng_state['cuda'] = torch.cuda.get_rng_state_all()
+    return rng_state
+
+
+def set_rng_state(rng_state):
+
+    random.setstate(rng_state['python'])
+    np.random.set_state(rng_state['numpy'])
+    torch.set_rng_state(rng_state['torch'].cpu())
+    if 'cuda' in rng_state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([state.cpu() for state in rng_state['cuda']])
+
+
+def snapshot_state(state):
+    """
+    Copy every tensor of a (nested dict / list / tuple) state to CPU, so that training can go on
+    while the copy is written. CUDA tensors are copied asynchronously into pinned memory.
+    :return: the copied state and a CUDA event to wait for before reading it (None on CPU)
+    """
+    has_cuda = [False]
+
+    def copy(obj):
+        if isinstance(obj, torch.Tensor):
+            obj = obj.detach()
+            if obj.is_cuda:
+                has_cuda[0] = True
+                cpu_obj = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=True)
+                cpu_obj.copy_(obj, non_blocking=True)
+                return cpu_obj
+            return obj.clone()
+        elif isinstance(obj, dict):
+            return type(obj)((key, copy(value)) for key, value in obj.items())
+        elif isinstance(obj, list):
+            return [copy(value) for value in obj]
+        elif isinstance(obj, tuple):
+            return tuple(copy(value) for value in obj)
+        return obj
+
+    snapshot = copy(state)
+    event = None
+    if has_cuda[0]:
+        event = torch.cuda.Event()
+        event.record()
+    return snapshot, event
+
+
+def atomic_save(obj, path):
+    """torch.save into a temporary file, then atomically rename it to path"""
+    tmp_path = '%s.tmp' % path
+    with open(tmp_path, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class AsyncCheckpointer(object):
+    """
+    Write checkpoints from a background thread.
+
+    save() takes a CPU snapshot of the state on the calling thread (only the device to host copy)
+    and returns; serialization and the atomic rename happen in the background, so a checkpoint is
+    either complete or absent. At most one checkpoint is in flight: a new save() first waits for the
+    previous one, which bounds the memory held by snapshots.
+    """
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+    def _write(self, write_fn, snapshot, event, args):
+        if event is not None:
+            event.synchronize()
+        write_fn(snapshot, *args)
+
+    def submit(self, write_fn, state, *args):
+        """Snapshot state and run write_fn(snapshot, *args) in the background"""
+        self.wait()
+        snapshot, event = snapshot_state(state)
+        self.pending = self.executor.submit(self._write, write_fn, snapshot, event, args)
+
+    def save(self, state, path):
+        directory = os.path.dirname(path)
+        if directory != '' and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.submit(atomic_save, state, path)
+
+    def wait(self):
+        """Wait for the checkpoint in flight, re-raising its error if writing failed"""
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+
+DOWNCAST_DTYPES = {
+    'fp16': torch.float16,
+    'bf16': torch.bfloat16,
+}
+
+
+def tensor_hash(tensor):
+    """Content hash of a CPU tensor: dtype, shape and raw bytes"""
+    data = tensor.detach().contiguous().reshape(-1).view(torch.uint8).numpy()
+    digest = hashlib.sha1()
+    digest.update(('%s%s' % (tensor.dtype, tuple(tensor.shape))).encode())
+    digest.update(data.tobytes())
+    return digest.hexdigest()
+
+
+class IncrementalCheckpointWriter(object):
+    """
+    Content-addressed checkpoints: every tensor of the state is stored once as a blob named by its
+    hash, and each checkpoint only writes the blobs that are not on disk yet (frozen BN statistics,
+    unchanged meta nets, ... are shared with the previous checkpoints).
+
+    Layout of root:
+        blobs/<key>.pt        one tensor, optionally zlib compressed and/or downcast to fp16 / bf16
+        index-<epoch>.pt      the state with every tensor replaced by a reference to its blob
+        manifest.json         retained epochs, their blobs, the best epoch and bytes written
+
+    The key of a blob is the hash of the tensor followed by how it is stored (stored dtype,
+    compression), and the references of the index and the manifest entries record the compression:
+    checkpoints are read back whatever the settings of the reader, and a save with other settings
+    writes its own blobs instead of reusing (e.g. downcast) ones.
+
+    Retention keeps the last `keep_last` checkpoints plus the best one; blobs that are no longer
+    referenced by a retained checkpoint are deleted. Downcasting float32 tensors is lossy, so an
+    exact resume needs downcast=None.
+    """
+
+    def __init__(self, root, keep_last=3, compress_level=0, downcast=None):
+
+        if downcast is not None and downcast not in DOWNCAST_DTYPES:
+            raise NotImplementedError('Checkpoint downcast %s is not supported' % downcast)
+
+        self.root = root
+        self.blob_dir = os.path.join(root, 'blobs')
+        self.keep_last = keep_last
+        self.compress_level = compress_level
+        self.downcast = downcast
+
+        if not os.path.exists(self.blob_dir):
+            os.makedirs(self.blob_dir)
+
+        self.manifest_path = os.path.join(root, 'manifest.json')
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {'epochs': {}, 'best': None, 'stats': []}
+
+    def _blob_path(self, key):
+        return os.path.join(self.blob_dir, '%s.pt' % key)
+
+    def _write_file(self, path, payload):
+        tmp_path = '%s.tmp' % path
+        with open(tmp_path, 'wb') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        return len(payload)
+
+    def _encode(self, obj):
+        buffer = io.BytesIO()
+        torch.save(obj, buffer)
+        payload = buffer.getvalue()
+        if self.compress_level > 0:
+            payload = zlib.compress(payload, self.compress_level)
+        return payload
+
+    def _decode(self, path, compressed):
+        with open(path, 'rb') as f:
+            payload = f.read()
+        if compressed is None:
+            # Written before the compression was recorded: torch.save files are zip archives
+            compressed = payload[:2] != b'PK'
+        if compressed:
+            payload = zlib.decompress(payload)
+        return torch.load(io.BytesIO(payload), map_location='cpu', weights_only=False)
+
+    def _stored_dtype(self, tensor):
+        if self.downcast is not None and tensor.dtype == torch.float32:
+            return DOWNCAST_DTYPES[self.downcast]
+        return tensor.dtype
+
+    def _split(self, obj, blobs):
+        """Replace tensors by references, collecting them into blobs (key -> tensor, stored dtype)"""
+        if isinstance(obj, torch.Tensor):
+            tensor = obj.detach().cpu()
+            stored_dtype = self._stored_dtype(tensor)
+            key = '%s-%s-z%d' % (tensor_hash(tensor), str(stored_dtype).replace('torch.', ''),
+                                 int(self.compress_level > 0))
+            if key not in blobs:
+                blobs[key] = (tensor, stored_dtype)
+            return {'__tensor_ref__': key, 'dtype': str(tensor.dtype).replace('torch.', ''),
+                    'compressed': self.compress_level > 0}
+        elif isinstance(obj, dict):
+            return type(obj)((key, self._split(value, blobs)) for key, value in obj.items())
+        elif isinstance(obj, list):
+            return [self._split(value, blobs) for value in obj]
+        elif isinstance(obj, tuple):
+            return tuple(self._split(value, blobs) for value in obj)
+        return obj
+
+    def _merge(self, obj, map_location):
+        if isinstance(obj, dict) and '__tensor_ref__' in obj:
+            tensor = self._decode(self._blob_path(obj['__tensor_ref__']), obj.get('compressed'))
+            return tensor.to(device=map_location, dtype=getattr(torch, obj['dtype']))
+        elif isinstance(obj, dict):
+            return type(obj)((key, self._merge(value, map_location)) for key, value in obj.items())
+        elif isinstance(obj, list):
+            return [self._merge(value, map_location) for value in obj]
+        elif isinstance(obj, tuple):
+            return tuple(self._merge(value, map_location) for value in obj)
+        return obj
+
+    def save(self, state, epoch, is_best=False):
+        """
+        Write the checkpoint of `epoch`
+        :return: (bytes written, bytes of a full uncompressed save of the same state)
+        """
+        blobs = dict()
+        index = self._split(state, blobs)
+
+        bytes_written = 0
+        full_bytes = 0
+        for key, (tensor, stored_dtype) in blobs.items():
+            full_bytes += tensor.numel() * tensor.element_size()
+            if os.path.exists(self._blob_path(key)):
+                continue
+            bytes_written += self._write_file(self._blob_path(key), self._encode(tensor.to(stored_dtype)))
+
+        index_name = 'index-%d.pt' % epoch
+        bytes_written += self._write_file(os.path.join(self.root, index_name), self._encode(index))
+
+        self.manifest['epochs'][str(epoch)] = {'index': index_name, 'blobs': sorted(blobs.keys()),
+                                               'compressed': self.compress_level > 0}
+        if is_best or self.manifest['best'] is None:
+            self.manifest['best'] = epoch
+        self.manifest['stats'].append({'epoch': epoch, 'bytes_written': bytes_written, 'full_bytes': full_bytes})
+        self.apply_retention()
+
+        print('Incremental checkpoint of epoch %d: %.2f MB written (full save: %.2f MB)'
+              % (epoch, bytes_written / 2 ** 20, full_bytes / 2 ** 20))
+        return bytes_written, full_bytes
+
+    def apply_retention(self):
+
+        epochs = sorted(int(epoch) for epoch in self.manifest['epochs'])
+        retained = set(epochs[-self.keep_last:]) if self.keep_last > 0 else set()
+        if self.manifest['best'] is not None:
+            retained.add(self.manifest['best'])
+
+        for epoch in epochs:
+            if epoch not in retained:
+                entry = self.manifest['epochs'].pop(str(epoch))
+                index_path = os.path.join(self.root, entry['index'])
+                if os.path.exists(index_path):
+                    os.remove(index_path)
+
+        # The manifest is written before blobs are garbage collected, so that it never references a missing blob
+        self._write_file(self.manifest_path, json.dumps(self.manifest, indent=1).encode())
+
+        referenced = set()
+        for entry in self.manifest['epochs'].values():
+            referenced.update(entry['blobs'])
+        for name in os.listdir(self.blob_dir):
+            if name.split('.')[0] not in referenced:
+                os.remove(os.path.join(self.blob_dir, name))
+
+    def epochs(self):
+        return sorted(int(epoch) for epoch in self.manifest['epochs'])
+
+    def latest_epoch(self):
+        epochs = self.epochs()
+        return epochs[-1] if len(epochs) > 0 else None
+
+    def load(self, epoch=None, map_location='cpu'):
+        """Reconstruct the state of a retained epoch, the latest one by default"""
+        if epoch is None:
+            epoch = self.latest_epoch()
+        if epoch is None or str(epoch) not in self.manifest['epochs']:
+            raise FileNotFoundError('Epoch %s is not retained in %s' % (epoch, self.root))
+        entry = self.manifest['epochs'][str(epoch)]
+        index = self._decode(os.path.join(self.root, entry['index']), entry.get('compressed'))
+        return self._merge(index, map_location)
+
+
+if __name__ == '__main__':
+
+    # Bytes written per epoch against full saves for ResNet56 / CIFAR100: between two checkpoints
+    # the latent weights change while BN statistics of frozen layers and the meta net do not
+    import time
+    import tempfile
+    import shutil
+    from models_CIFAR.quantized_meta_resnet import resnet56_cifar
+
+    net = resnet56_cifar(num_classes=100, bitW=1)
+    root = tempfile.mkdtemp(prefix='incremental-checkpoint-')
+    for compress_level, downcast in [(0, None), (6, None), (0, 'fp16')]:
+        writer = IncrementalCheckpointWriter(os.path.join(root, '%d-%s' % (compress_level, downcast)),
+                                             keep_last=2, compress_level=compress_level, downcast=downcast)
+        for epoch in range(1, 5):
+            for name, param in net.named_parameters():
+                if 'layer3' in name:
+                    param.data.add_(1e-3 * torch.randn_like(param))
+            start = time.time()
+            writer.save({'epoch': epoch, 'model_state_dict': net.state_dict()}, epoch, is_best=(epoch == 2))
+            print('compress %d, downcast %s, epoch %d: %.2fs, retained %s'
+                  % (compress_level, downcast, epoch, time.time() - start, writer.epochs()))
+        state = writer.load(2)
+        assert state['epoch'] == 2
+        # Read back with the default settings, as load_model_state does
+        state = IncrementalCheckpointWriter(writer.root).load(2)
+        assert state['epoch'] == 2
+    # A lossless save in a directory holding downcast blobs of the same tensors writes its own blobs
+    writer = IncrementalCheckpointWriter(os.path.join(root, '0-fp16'), downcast=None)
+    writer.save({'model_state_dict': net.state_dict()}, 5)
+    for name, value in writer.load(5)['model_state_dict'].items():
+        assert torch.equal(value, net.state_dict()[name]), name
+    shutil.rmtree(root)
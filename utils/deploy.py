@@ -0,0 +1,372 @@
+"""
+Inference-only CIFAR ResNets built from trained meta-quantized networks, and their int8 version.
+
+FoldedResNet (fold_resnet) is the flattened inference graph of a ResNet_Cifar, meta-quantized or
+baseline (models_CIFAR/quantized_resnet.py): every BN is folded into the weight and bias of the
+quantized conv before it, ReLU runs inside the folded conv, bn2 is folded into fc. With binary
+activations (meta networks with gVar.a32 False, 1 bit), the binarization of relu(bn1(conv1)) by
+conv2 becomes the sign of the folded conv1, i.e. a per-channel threshold given by the folded bias.
+
+DeployResNet has the structure of ResNet_Cifar (BasicBlock) with plain nn.Conv2d / nn.Linear holding
+the quantized weights: no meta gradient arguments, hooks or state written during forward.
+
+int8 path (quantize_int8): the 2^bitW dorefa levels (2k - n) / n, n = 2^bitW - 1, are integers up
+to a scale of 1 / n, so they map exactly to int8. conv + BN (+ ReLU) are fused, which multiplies
+every output channel by the BN factor f: the per-channel scale |f| / n keeps the fused weights on the
+integer grid. Activations are observed on a few calibration batches. bn2 (BatchNorm1d) and fc run in
+float after the average pooling.
+
+Serving (export_torchscript / export_onnx): FoldedResNet only uses standard ops (conv2d, relu,
+comparison for the sign, avg_pool2d, linear), so it can be scripted and exported to ONNX as is;
+ONNXForward runs the ONNX file with onnxruntime when it is installed.
+"""
+import copy
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.ao.quantization import QuantStub, DeQuantStub, get_default_qconfig, fuse_modules, prepare, convert
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+import utils.global_var as gVar
+from utils.miscellaneous import get_layer
+from utils.quantize import prepare_fast_eval
+
+
+def weight_levels(quantized_type, bitW):
+    """n such that the quantized weights are integers / n"""
+    if quantized_type == 'dorefa':
+        return 2 ** bitW - 1
+    elif quantized_type == 'BWN':
+        return 1
+    raise NotImplementedError('Integer weights of %s are not supported' % quantized_type)
+
+
+def integer_weight(layer, quantized_type):
+    """
+    :return: quantized weight of a meta-quantized layer as integers (float tensor) and the number of levels n
+    """
+    n = weight_levels(quantized_type, layer.bitW)
+    if n > 127:
+        raise NotImplementedError('%d-bit weights do not fit in int8' % layer.bitW)
+    _, quantized_weight = layer.get_quantized_weight(quantized_type)
+    integers = torch.round(quantized_weight.detach() * n)
+    if not torch.allclose(integers / n, quantized_weight.detach(), atol=1e-6):
+        raise ValueError('Quantized weight of %s is not on the %d-level grid' % (layer.layer_name, n + 1))
+    return integers, n
+
+
+class DeployBasicBlock(nn.Module):
+
+    def __init__(self, inplanes, planes, stride=1, downsample=False):
+        super(DeployBasicBlock, self).__init__()
+        self.conv1 = nn.Conv2d(inplanes, planes, kernel_size=3, stride=stride, padding=1, bias=False)
+        self.bn1 = nn.BatchNorm2d(planes)
+        self.relu1 = nn.ReLU()
+        self.conv2 = nn.Conv2d(planes, planes, kernel_size=3, padding=1, bias=False)
+        self.bn2 = nn.BatchNorm2d(planes)
+        self.downsample = nn.Sequential(
+            nn.Conv2d(inplanes, planes, kernel_size=1, stride=stride, bias=False),
+            nn.BatchNorm2d(planes)
+        ) if downsample else None
+        self.skip_add = nn.quantized.FloatFunctional()
+
+    def forward(self, x):
+        out = self.relu1(self.bn1(self.conv1(x)))
+        out = self.bn2(self.conv2(out))
+        residual = self.downsample(x) if self.downsample is not None else x
+        return self.skip_add.add_relu(out, residual)
+
+    def fuse_list(self):
+        modules = [['conv1', 'bn1', 'relu1'], ['conv2', 'bn2']]
+        if self.downsample is not None:
+            modules.append(['downsample.0', 'downsample.1'])
+        return modules
+
+
+class DeployResNet(nn.Module):
+
+    def __init__(self, layers, num_classes=10, first_stride=1):
+        super(DeployResNet, self).__init__()
+        self.quant = QuantStub()
+        self.conv1 = nn.Conv2d(3, 16, kernel_size=3, stride=first_stride, padding=1, bias=False)
+        self.bn1 = nn.BatchNorm2d(16)
+        self.relu = nn.ReLU()
+        inplanes = 16
+        for layer_idx, (planes, n_blocks) in enumerate(zip([16, 32, 64], layers)):
+            stride = 1 if layer_idx == 0 else 2
+            blocks = [DeployBasicBlock(inplanes, planes, stride, downsample=(stride != 1 or inplanes != planes))]
+            blocks += [DeployBasicBlock(planes, planes) for _ in range(1, n_blocks)]
+            setattr(self, 'layer%d' % (layer_idx + 1), nn.Sequential(*blocks))
+            inplanes = planes
+        self.avgpool = nn.AvgPool2d(8, stride=1)
+        self.dequant = DeQuantStub()
+        self.bn2 = nn.BatchNorm1d(64)
+        self.fc = nn.Linear(64, num_classes)
+
+    def forward(self, x):
+        x = self.quant(x)
+        x = self.relu(self.bn1(self.conv1(x)))
+        x = self.layer3(self.layer2(self.layer1(x)))
+        x = self.dequant(self.avgpool(x))
+        x = self.bn2(x.view(x.size(0), -1))
+        return self.fc(x)
+
+    def fuse_list(self):
+        modules = [['conv1', 'bn1', 'relu']]
+        for layer_name in ['layer1', 'layer2', 'layer3']:
+            for block_idx, block in enumerate(getattr(self, layer_name)):
+                modules += [['%s.%d.%s' % (layer_name, block_idx, name) for name in names]
+                            for names in block.fuse_list()]
+        return modules
+
+
+def from_meta_resnet(net, quantized_type):
+    """
+    DeployResNet with the quantized weights of a trained ResNet_Cifar (weights as floats); the levels n
+    of every conv are kept in conv.weight_levels for quantize_int8
+    """
+    if not gVar.a32:
+        raise NotImplementedError('Activations quantized with their per-batch maximum are not supported, '
+                                  'only full-precision activations (gVar.a32)')
+    if hasattr(net, 'layer4') or any(not hasattr(block, 'conv2') or hasattr(block, 'conv3') for block in net.layer1):
+        raise NotImplementedError('Only CIFAR ResNets with basic blocks are supported')
+
+    net.eval()
+    prepare_fast_eval(net, quantized_type, channels_last=False)
+    deploy_net = DeployResNet([len(net.layer1), len(net.layer2), len(net.layer3)], num_classes=net.fc.weight.shape[0],
+                              first_stride=net.conv1.stride)
+    # BN, fc bias and every other entry are the same, then the weights of the quantized layers
+    deploy_net.load_state_dict(net.state_dict(), strict=False)
+    modules = dict(deploy_net.named_modules())
+    for layer_name, layer_idx in net.layer_name_list:
+        layer = get_layer(net, layer_idx)
+        integers, n = integer_weight(layer, quantized_type)
+        module = modules[layer_name]
+        module.weight.data.copy_(integers / n)
+        if layer.bias is not None:
+            module.bias.data.copy_(layer.bias.data)
+        module.weight_levels = n
+    return deploy_net
+
+
+def quantize_int8(deploy_net, calibration_loader, n_batches=10, backend='fbgemm'):
+    """
+    Static int8 quantization of a DeployResNet for the quantized CPU kernels of `backend` ('fbgemm' or
+    'qnnpack'), activations calibrated on n_batches of calibration_loader
+    """
+    torch.backends.quantized.engine = backend
+    model = copy.deepcopy(deploy_net).cpu().eval()
+    levels = {name: module.weight_levels for name, module in model.named_modules() if hasattr(module, 'weight_levels')}
+
+    # Fused conv weights and their exact per-channel scale |f| / n
+    fused_weights = dict()
+    modules = dict(model.named_modules())
+    for names in model.fuse_list():
+        bn = modules[names[1]]
+        factor = (bn.weight / torch.sqrt(bn.running_var + bn.eps)).detach()
+        fused_weights[names[0]] = torch.clamp(factor.abs(), min=1e-8) / levels[names[0]]
+    fuse_modules(model, model.fuse_list(), inplace=True)
+    modules = dict(model.named_modules())
+    for name, scale in list(fused_weights.items()):
+        fused = modules[name][0] if isinstance(modules[name], nn.Sequential) else modules[name]
+        fused_weights[name] = (fused.weight.detach().clone(), fused.bias.detach().clone(), scale)
+
+    model.qconfig = get_default_qconfig(backend)
+    model.bn2.qconfig = None
+    model.fc.qconfig = None
+    prepare(model, inplace=True)
+    with torch.no_grad():
+        for batch_idx, (inputs, _) in enumerate(calibration_loader):
+            if batch_idx >= n_batches:
+                break
+            model(inputs)
+    convert(model, inplace=True)
+
+    modules = dict(model.named_modules())
+    for name, (weight, bias, scale) in fused_weights.items():
+        qweight = torch.quantize_per_channel(weight, scale.double(), torch.zeros_like(scale, dtype=torch.long),
+                                             axis=0, dtype=torch.qint8)
+        modules[name].set_weight_bias(qweight, bias)
+    return model
+
+
+def forward_accuracy(forward, loader, n_batches=None):
+    """Top-1 accuracy (%) of a forward function (inputs -> logits) on the first n_batches of loader"""
+    correct, total = 0, 0
+    with torch.no_grad():
+        for batch_idx, (inputs, targets) in enumerate(loader):
+            if n_batches is not None and batch_idx >= n_batches:
+                break
+            correct += forward(inputs).argmax(dim=1).eq(targets).sum().item()
+            total += targets.size(0)
+    return 100.0 * correct / max(total, 1)
+
+
+def quantized_weight(layer, quantized_type):
+    """Quantized weight of a meta-quantized (after prepare_fast_eval) or baseline quantized layer"""
+    if getattr(layer, 'supports_eval_cache', False):
+        return layer.get_quantized_weight(quantized_type)[1].detach().contiguous()
+    with torch.no_grad():
+        return layer.quantize_weight(quantized_type).detach().contiguous()
+
+
+def bn_affine(bn):
+    """BN in eval mode as x * a + c, per channel"""
+    a = bn.weight.detach() / torch.sqrt(bn.running_var + bn.eps)
+    return a, bn.bias.detach() - bn.running_mean * a
+
+
+def binarize(x):
+    """1-bit activation quantization of MetaQuantConv: +1 where x > 0, -1 elsewhere"""
+    return (x > 0).float() * 2 - 1
+
+
+class FoldedConv2d(nn.Module):
+    """
+    conv -> BN -> activation, BN folded into the weight and bias. activation is '' (none), 'relu' or
+    'sign' (binarize)
+    """
+
+    def __init__(self, weight, bias, stride=1, padding=0, dilation=1, groups=1, activation=''):
+        super(FoldedConv2d, self).__init__()
+        self.register_buffer('weight', weight)
+        self.register_buffer('bias', bias)
+        self.stride, self.padding, self.dilation, self.groups = stride, padding, dilation, groups
+        self.activation = activation
+
+    @classmethod
+    def fold(cls, layer, bn, quantized_type, activation=''):
+        weight = quantized_weight(layer, quantized_type)
+        a, c = bn_affine(bn)
+        if layer.bias is not None:
+            c = c + layer.bias.detach() * a
+        return cls(weight * a.view(-1, 1, 1, 1), c, layer.stride, layer.padding, layer.dilation, layer.groups,
+                   activation)
+
+    def forward(self, x):
+        x = F.conv2d(x, self.weight, self.bias, self.stride, self.padding, self.dilation, self.groups)
+        if self.activation == 'relu':
+            return F.relu(x)
+        elif self.activation == 'sign':
+            return binarize(x)
+        return x
+
+
+class FoldedBlock(nn.Module):
+
+    def __init__(self, conv1, conv2, downsample=None, binary=False):
+        super(FoldedBlock, self).__init__()
+        self.conv1 = conv1
+        self.conv2 = conv2
+        self.downsample = downsample
+        self.binary = binary
+
+    def forward(self, x):
+        inputs = binarize(x) if self.binary else x
+        out = self.conv2(self.conv1(inputs))
+        if self.downsample is not None:
+            residual = self.downsample(inputs)
+        else:
+            residual = x
+        return F.relu(out + residual)
+
+
+class FoldedResNet(nn.Module):
+
+    def __init__(self, conv1, blocks, fc_weight, fc_bias, feature_scale, feature_shift, binary=False, pool_size=8):
+        super(FoldedResNet, self).__init__()
+        self.conv1 = conv1
+        self.blocks = nn.Sequential(*blocks)
+        self.register_buffer('fc_weight', fc_weight)
+        self.register_buffer('fc_bias', fc_bias)
+        # bn2 before fc, only used with binary activations: it cannot be folded through the sign
+        self.register_buffer('feature_scale', feature_scale)
+        self.register_buffer('feature_shift', feature_shift)
+        self.binary = binary
+        self.pool_size = pool_size
+
+    def forward(self, x):
+        x = self.conv1(binarize(x) if self.binary else x)
+        x = self.blocks(x)
+        x = F.avg_pool2d(x, self.pool_size, stride=1)
+        x = x.view(x.size(0), -1)
+        if self.binary:
+            x = torch.sign(x * self.feature_scale + self.feature_shift)
+        return F.linear(x, self.fc_weight, self.fc_bias)
+
+
+def fold_resnet(net, quantized_type):
+    """FoldedResNet computing the eval output of a meta-quantized or baseline ResNet_Cifar"""
+    if hasattr(net, 'layer4'):
+        raise NotImplementedError('Only CIFAR ResNets are supported')
+    is_meta = hasattr(net, 'layer_name_list')
+    binary = is_meta and not gVar.a32
+    if binary and net.bitW != 1:
+        raise NotImplementedError('%d-bit activations are quantized with their per-batch maximum, '
+                                  'only 1-bit activations can be folded' % net.bitW)
+
+    net.eval()
+    if is_meta:
+        prepare_fast_eval(net, quantized_type, channels_last=False)
+
+    conv1 = FoldedConv2d.fold(net.conv1, net.bn1, quantized_type, 'relu')
+    blocks = []
+    for layer in [net.layer1, net.layer2, net.layer3]:
+        for block in layer:
+            if hasattr(block, 'conv3'):
+                raise NotImplementedError('Only CIFAR ResNets with basic blocks are supported')
+            downsample = None
+            if block.downsample is not None:
+                downsample = FoldedConv2d.fold(block.downsample[0], block.downsample[1], quantized_type)
+            blocks.append(FoldedBlock(FoldedConv2d.fold(block.conv1, block.bn1, quantized_type,
+                                                        'sign' if binary else 'relu'),
+                                      FoldedConv2d.fold(block.conv2, block.bn2, quantized_type),
+                                      downsample, binary))
+
+    fc_weight = quantized_weight(net.fc, quantized_type)
+    fc_bias = net.fc.bias.detach().clone() if net.fc.bias is not None else torch.zeros(fc_weight.shape[0])
+    if hasattr(net, 'bn2'):
+        feature_scale, feature_shift = bn_affine(net.bn2)
+    else:
+        feature_scale, feature_shift = torch.ones(fc_weight.shape[1]), torch.zeros(fc_weight.shape[1])
+    if not binary:
+        fc_bias = fc_bias + torch.mv(fc_weight, feature_shift)
+        fc_weight = fc_weight * feature_scale.view(1, -1)
+        feature_scale, feature_shift = torch.ones_like(feature_scale), torch.zeros_like(feature_shift)
+
+    pool_size = net.avgpool.kernel_size
+    return FoldedResNet(conv1, blocks, fc_weight, fc_bias, feature_scale, feature_shift, binary,
+                        pool_size if isinstance(pool_size, int) else pool_size[0]).eval()
+
+
+def export_torchscript(model, path):
+    """Script an inference module (e.g. FoldedResNet) to path and return the reloaded TorchScript module"""
+    torch.jit.save(torch.jit.script(model.cpu().eval()), path)
+    return torch.jit.load(path)
+
+
+def export_onnx(model, path, example_inputs, opset_version=13):
+    """ONNX graph of an inference module with a dynamic batch dimension"""
+    with torch.no_grad():
+        torch.onnx.export(model.cpu().eval(), example_inputs, path, input_names=['input'], output_names=['logits'],
+                          dynamic_axes={'input': {0: 'batch'}, 'logits': {0: 'batch'}}, opset_version=opset_version)
+
+
+class ONNXForward(object):
+    """Forward function (tensor inputs -> tensor logits) of an ONNX file run by onnxruntime on CPU"""
+
+    def __init__(self, path, n_threads=None):
+        if onnxruntime is None:
+            raise ImportError('onnxruntime is required to run ONNX models')
+        options = onnxruntime.SessionOptions()
+        if n_threads is not None:
+            options.intra_op_num_threads = n_threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+    def __call__(self, inputs):
+        outputs, = self.session.run(['logits'], {'input': inputs.detach().cpu().numpy()})
+        return torch.from_numpy(outputs)
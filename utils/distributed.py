@@ -0,0 +1,113 @@
+"""
+Data-parallel helpers over torch.distributed, for runs launched with torchrun
+"""
+import os
+
+import torch
+import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+
+def init_distributed(backend='gloo'):
+    """
+    Initialize the process group from the torchrun environment (RANK, WORLD_SIZE, MASTER_ADDR, ...)
+    :return: (rank, world_size), (0, 1) when not launched by torchrun
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size == 1:
+        return 0, 1
+    if not dist.is_initialized():
+        dist.init_process_group(backend=backend)
+    return dist.get_rank(), dist.get_world_size()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def cleanup():
+    if dist.is_available() and dist.is_initialized():
+        dist.destroy_process_group()
+
+
+def all_reduce_tensors(tensors, average=True, bucket_size=2 ** 24):
+    """
+    All-reduce a list of tensors in place. Tensors are flattened into buckets of at most bucket_size
+    elements of the same dtype, so that a few large messages are sent instead of one per tensor.
+    Every rank must pass the same tensors (shapes and order).
+    """
+    if not is_distributed():
+        return
+
+    world_size = get_world_size()
+    buckets = dict()
+    for tensor in tensors:
+        buckets.setdefault(tensor.dtype, [[]])
+        bucket = buckets[tensor.dtype][-1]
+        if len(bucket) > 0 and sum(t.numel() for t in bucket) + tensor.numel() > bucket_size:
+            bucket = []
+            buckets[tensor.dtype].append(bucket)
+        bucket.append(tensor)
+
+    for dtype_buckets in buckets.values():
+        for bucket in dtype_buckets:
+            flat = _flatten_dense_tensors(bucket)
+            dist.all_reduce(flat)
+            if average:
+                flat /= world_size
+            for tensor, synced in zip(bucket, _unflatten_dense_tensors(flat, bucket)):
+                tensor.copy_(synced)
+
+
+def broadcast_module(module, src=0):
+    """Copy the parameters and buffers of `module` on rank src to every rank"""
+    if not is_distributed():
+        return
+    with torch.no_grad():
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            dist.broadcast(tensor.data, src=src)
+
+
+def broadcast_buffers(module, src=0):
+    """Copy the buffers (e.g. BN running statistics) of `module` on rank src to every rank"""
+    if not is_distributed():
+        return
+    for buffer in module.buffers():
+        dist.broadcast(buffer.data, src=src)
+
+
+def broadcast_object(obj, src=0):
+    """Picklable object of rank src, on every rank"""
+    if not is_distributed():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=src)
+    return objects[0]
+
+
+def distributed_loader(loader, batch_size, shuffle=True, seed=0):
+    """
+    Rebuild a DataLoader over the same dataset with a DistributedSampler: each rank reads its own
+    1 / world_size of every epoch, with batch_size samples per step.
+    """
+    sampler = torch.utils.data.distributed.DistributedSampler(
+        loader.dataset, num_replicas=get_world_size(), rank=get_rank(), shuffle=shuffle, seed=seed)
+    return torch.utils.data.DataLoader(loader.dataset, batch_size=batch_size, sampler=sampler,
+                                       num_workers=loader.num_workers, pin_memory=loader.pin_memory)
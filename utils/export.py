@@ -0,0 +1,251 @@
+"""
+Export of trained meta-quantized networks for deployment.
+
+Packed format (export_packed / PackedModel), one file:
+    b'MQPACK01' | manifest length (uint64, little endian) | JSON manifest | data section
+The data section starts at the first multiple of ALIGNMENT after the manifest, and every segment in
+it is ALIGNMENT-aligned, so that the loader can memory-map the file and view segments as numpy arrays
+without copies. Offsets in the manifest are relative to the data section.
+
+Every meta-quantized layer (net.layer_name_list) is stored as the sign bits of its quantized weight,
+one row per output channel (bit i of a row is 1 for +1, little bit order), zero-padded to whole
+WORD_BITS words, plus an optional per-channel scale (BWN-F alpha) and its bias. Every other entry of
+the state dict (BN parameters and statistics, full-precision layers) is stored as is.
+"""
+import io
+import os
+import json
+import struct
+
+import numpy as np
+import torch
+
+import utils.global_var as gVar
+from utils.miscellaneous import get_layer
+from utils.quantize import prepare_fast_eval
+
+
+MAGIC = b'MQPACK01'
+ALIGNMENT = 64
+WORD_BITS = 64
+
+
+def load_model_state(path, map_location='cpu'):
+    """
+    Network state dict from a pretrain / state dict file, a trainer checkpoint (model_state_dict) or
+    an incremental checkpoint directory
+    """
+    if os.path.isdir(path):
+        from utils.checkpoint import IncrementalCheckpointWriter
+        checkpoint = IncrementalCheckpointWriter(path).load(map_location=map_location)
+    else:
+        checkpoint = torch.load(path, map_location=map_location, weights_only=False)
+    if 'model_state_dict' in checkpoint:
+        return checkpoint['model_state_dict']
+    return checkpoint
+
+
+def pack_signs(weight, word_bits=WORD_BITS):
+    """
+    :param weight: quantized weight, output channels first
+    :return: (out_channels, n_words * word_bits / 8) uint8 array of the sign bits, number of valid bits per row
+    """
+    signs = (weight.detach().reshape(weight.shape[0], -1) > 0).cpu().numpy()
+    n_bits = signs.shape[1]
+    n_padded = -(-n_bits // word_bits) * word_bits
+    bits = np.zeros((signs.shape[0], n_padded), dtype=bool)
+    bits[:, :n_bits] = signs
+    return np.packbits(bits, axis=1, bitorder='little'), n_bits
+
+
+def unpack_signs(packed, n_bits, shape):
+    """Inverse of pack_signs, as a float tensor of +1 / -1"""
+    bits = np.unpackbits(np.asarray(packed), axis=1, count=n_bits, bitorder='little')
+    return torch.from_numpy(bits.astype(np.float32) * 2 - 1).view(*shape)
+
+
+def binary_weight(layer, quantized_type):
+    """
+    Quantized weight of a meta-quantized layer as sign and per-channel scale
+    :return: quantized weight, scale (None when the weight is +1 / -1), number of zero weights
+    """
+    if not getattr(layer, 'supports_eval_cache', False):
+        raise NotImplementedError('Export of %s is not supported' % type(layer).__name__)
+    if quantized_type == 'dorefa' and layer.bitW != 1:
+        raise NotImplementedError('Packed export only supports 1-bit weights, got %d-bit dorefa' % layer.bitW)
+    if quantized_type not in ['dorefa', 'BWN', 'BWN-F']:
+        raise NotImplementedError('Packed export of %s weights is not supported' % quantized_type)
+
+    _, quantized_weight = layer.get_quantized_weight(quantized_type)
+    quantized_weight = quantized_weight.detach().contiguous().cpu()
+    rows = quantized_weight.view(quantized_weight.shape[0], -1)
+    scale = rows.abs().max(dim=1)[0]
+    nonzero = rows != 0
+    if not torch.equal(rows.abs()[nonzero], scale.view(-1, 1).expand_as(rows)[nonzero]):
+        raise ValueError('Quantized weight of %s is not binary' % layer.layer_name)
+    if torch.all(scale == 1):
+        scale = None
+    return quantized_weight, scale, int((~nonzero).sum().item())
+
+
+class _SegmentWriter(object):
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+    def add(self, array):
+        array = np.ascontiguousarray(array)
+        offset = -(-self.buffer.tell() // ALIGNMENT) * ALIGNMENT
+        self.buffer.seek(offset)
+        self.buffer.write(array.tobytes())
+        return {'offset': offset, 'dtype': array.dtype.str, 'shape': list(array.shape)}
+
+
+def export_packed(net, path, quantized_type, meta=None):
+    """
+    Write the packed format of net
+    :param meta: extra JSON entries of the manifest (model, dataset, ...)
+    :return: manifest
+    """
+    net.eval()
+    # Fresh evaluation caches, computed from the current latent weights
+    prepare_fast_eval(net, quantized_type, channels_last=False)
+
+    writer = _SegmentWriter()
+    layers = []
+    packed_names = set()
+    for layer_name, layer_idx in net.layer_name_list:
+        layer = get_layer(net, layer_idx)
+        quantized_weight, scale, n_zeros = binary_weight(layer, quantized_type)
+        packed, n_bits = pack_signs(quantized_weight)
+        prefix = '.'.join(str(info) for info in layer_idx)
+        entry = {
+            'name': layer_name,
+            'prefix': prefix,
+            'kind': 'conv' if quantized_weight.dim() == 4 else 'linear',
+            'shape': list(quantized_weight.shape),
+            'n_bits': n_bits,
+            'word_bits': WORD_BITS,
+            'n_zeros': n_zeros,
+            'bits': writer.add(packed),
+            'scale': writer.add(scale.numpy().astype(np.float32)) if scale is not None else None,
+            'bias': writer.add(layer.bias.detach().cpu().numpy()) if layer.bias is not None else None,
+        }
+        if entry['kind'] == 'conv':
+            entry.update(stride=layer.stride, padding=layer.padding, dilation=layer.dilation, groups=layer.groups)
+        layers.append(entry)
+        packed_names.update(['%s.weight' % prefix, '%s.bias' % prefix])
+
+    tensors = dict()
+    for name, value in net.state_dict().items():
+        if name not in packed_names:
+            tensors[name] = writer.add(value.detach().cpu().numpy())
+
+    manifest = dict(meta or {}, format=MAGIC.decode(), quantized_type=quantized_type, a32=gVar.a32,
+                    alignment=ALIGNMENT, layers=layers, tensors=tensors)
+    header = json.dumps(manifest).encode()
+    data_start = -(-(len(MAGIC) + 8 + len(header)) // ALIGNMENT) * ALIGNMENT
+
+    tmp_path = '%s.tmp' % path
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        f.write(b'\0' * (data_start - f.tell()))
+        f.write(writer.buffer.getvalue())
+    os.replace(tmp_path, path)
+    return manifest
+
+
+class PackedModel(object):
+    """Memory-mapped packed file: segments are numpy views of the mapping, read on access"""
+
+    def __init__(self, path):
+
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError('%s is not a packed model' % path)
+            n_header, = struct.unpack('<Q', f.read(8))
+            self.manifest = json.loads(f.read(n_header).decode())
+        self.data_start = -(-(len(MAGIC) + 8 + n_header) // ALIGNMENT) * ALIGNMENT
+        self.data = np.memmap(path, dtype=np.uint8, mode='r')
+        self.layers = self.manifest['layers']
+
+    def array(self, segment):
+
+        if segment is None:
+            return None
+        dtype = np.dtype(segment['dtype'])
+        start = self.data_start + segment['offset']
+        n_bytes = int(np.prod(segment['shape'], dtype=np.int64)) * dtype.itemsize
+        return self.data[start: start + n_bytes].view(dtype).reshape(segment['shape'])
+
+    def weight(self, layer):
+        """Quantized weight of a layer entry as a float tensor"""
+        weight = unpack_signs(self.array(layer['bits']), layer['n_bits'], layer['shape'])
+        if layer['scale'] is not None:
+            weight = weight * torch.from_numpy(np.array(self.array(layer['scale']))).view(-1, *[1] * (weight.dim() - 1))
+        return weight
+
+    def state_dict(self):
+        """
+        State dict of the network with the quantized weights as latent weights: they quantize back to
+        themselves with the quantized_type of the export
+        """
+        state_dict = {name: torch.from_numpy(np.array(self.array(segment)))
+                      for name, segment in self.manifest['tensors'].items()}
+        for layer in self.layers:
+            state_dict['%s.weight' % layer['prefix']] = self.weight(layer)
+            if layer['bias'] is not None:
+                state_dict['%s.bias' % layer['prefix']] = torch.from_numpy(np.array(self.array(layer['bias'])))
+        return state_dict
+
+
+def state_dict_bytes(state_dict):
+    """Size of a state dict saved with torch.save"""
+    buffer = io.BytesIO()
+    torch.save(state_dict, buffer)
+    return buffer.tell()
+
+
+def packed_size_report(net, path):
+    """
+    Compare the packed file with the fp32 state dict, for the whole file and for the quantized weights only
+    :return: dict of sizes in bytes
+    """
+    packed = PackedModel(path)
+    fp32_weight_bytes = sum(4 * int(np.prod(layer['shape'])) for layer in packed.layers)
+    packed_weight_bytes = sum(int(np.prod(layer['bits']['shape'])) for layer in packed.layers)
+    report = {
+        'fp32_bytes': state_dict_bytes(net.state_dict()),
+        'packed_bytes': os.path.getsize(path),
+        'fp32_weight_bytes': fp32_weight_bytes,
+        'packed_weight_bytes': packed_weight_bytes,
+        'n_zero_weights': sum(layer['n_zeros'] for layer in packed.layers),
+    }
+    print('Quantized weights: %.1f KB -> %.1f KB (%.1fx), file: %.1f KB -> %.1f KB (%.1fx)'
+          % (fp32_weight_bytes / 1024., packed_weight_bytes / 1024., fp32_weight_bytes / packed_weight_bytes,
+             report['fp32_bytes'] / 1024., report['packed_bytes'] / 1024.,
+             report['fp32_bytes'] / report['packed_bytes']))
+    if report['n_zero_weights'] > 0:
+        print('%d quantized weights are exactly 0 and were exported as -1' % report['n_zero_weights'])
+    return report
+
+
+def compare_outputs(reference, candidate, loader, n_batches=1, use_cuda=False):
+    """
+    Run two forward functions (inputs -> logits) on the first n_batches of loader
+    :return: max absolute difference of the logits, ratio of identical predictions
+    """
+    max_diff, n_same, n_total = 0., 0, 0
+    with torch.no_grad():
+        for batch_idx, (inputs, _) in enumerate(loader):
+            if batch_idx >= n_batches:
+                break
+            if use_cuda:
+                inputs = inputs.cuda()
+            reference_outputs, candidate_outputs = reference(inputs), candidate(inputs)
+            max_diff = max(max_diff, (reference_outputs - candidate_outputs).abs().max().item())
+            n_same += (reference_outputs.argmax(dim=1) == candidate_outputs.argmax(dim=1)).sum().item()
+            n_total += inputs.shape[0]
+    return max_diff, n_same / max(n_total, 1)
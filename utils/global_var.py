@@ -1,4 +1,9 @@
 meta_count = 0
 sparse_count = 0
 meta_forward_count = 0
-a32 = True
\ No newline at end of file
+a32 = True
+act_quant = 'batch' # Activation scale when a32 is False: max of every batch, 'ema' or 'calibrated' (ActivationQuantizer)
+act_per_channel = False
+act_momentum = 0.1
+accumulate_grads = False # Sum the gradients captured by hooks over micro-batches
+eval_version = 0 # Bumped by every fast evaluation, invalidates the cached quantized weights
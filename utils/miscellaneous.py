@@ -8,6 +8,8 @@ import os
 import sys
 import time
 import shutil
+from collections import OrderedDict
+from contextlib import contextmanager
 
 def get_layer(net, layer_info):
 
@@ -121,6 +123,42 @@ class AverageMeter(object):
         self.count += n
         self.avg = float(self.sum) / float(self.count)
 
+
+class PhaseTimer(object):
+    """
+    Accumulate the wall-clock time of named phases of a training step.
+    With sync=True CUDA is synchronized around every phase, so that asynchronous kernels are
+    charged to the phase that launched them. Phases are also labelled 'phase/<name>' in
+    torch.profiler traces.
+    """
+    def __init__(self, phases=None, sync=False):
+        self.phases = list(phases) if phases is not None else []
+        self.sync = sync and torch.cuda.is_available()
+        self.reset()
+
+    def reset(self):
+        self.total = OrderedDict((name, 0.) for name in self.phases)
+        self.count = OrderedDict((name, 0) for name in self.phases)
+
+    @contextmanager
+    def phase(self, name):
+        if self.sync:
+            torch.cuda.synchronize()
+        start = time.time()
+        try:
+            with torch.profiler.record_function('phase/%s' % name):
+                yield
+        finally:
+            if self.sync:
+                torch.cuda.synchronize()
+            self.total[name] = self.total.get(name, 0.) + time.time() - start
+            self.count[name] = self.count.get(name, 0) + 1
+
+    def summary(self):
+        total_time = max(sum(self.total.values()), 1e-12)
+        return ' | '.join('%s: %.1fs (%.1f%%)' % (name, value, 100.0 * value / total_time)
+                          for name, value in self.total.items())
+
 if __name__ == '__main__':
     print(is_int('adaptive'))
 
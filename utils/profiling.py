@@ -0,0 +1,93 @@
+"""
+Profile a window of training iterations with torch.profiler
+"""
+import os
+
+import torch
+from torch.profiler import profile, schedule, ProfilerActivity
+
+
+def parse_profile_steps(profile_steps):
+    """'START:END' -> (START, END), the iterations START <= step < END are profiled"""
+    if profile_steps is None or profile_steps == '':
+        return None
+    start, end = [int(step) for step in profile_steps.split(':')]
+    if start < 0 or end <= start:
+        raise ValueError('Invalid profile steps %s, expect START:END with 0 <= START < END' % profile_steps)
+    return start, end
+
+
+class StepProfiler(object):
+    """
+    Wrap the iterations START:END (counted over the whole run) in torch.profiler, recording CPU
+    (and CUDA) activities, memory and stacks. When the window is done, a Chrome trace, the table of
+    the top operators and the stacks are written into output_dir.
+    Call step() once at the end of every training iteration; it is a no-op outside of the window
+    and when profile_steps is empty.
+    """
+
+    def __init__(self, profile_steps, output_dir, use_cuda=False, row_limit=30):
+
+        self.window = parse_profile_steps(profile_steps)
+        self.output_dir = output_dir
+        self.use_cuda = use_cuda and torch.cuda.is_available()
+        self.row_limit = row_limit
+        self.prof = None
+
+        if self.window is None:
+            return
+
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+        start, end = self.window
+        activities = [ProfilerActivity.CPU]
+        if self.use_cuda:
+            activities.append(ProfilerActivity.CUDA)
+
+        # The iteration before the window (if any) is used as profiler warmup
+        warmup = 1 if start > 0 else 0
+        self.prof = profile(
+            activities=activities,
+            schedule=schedule(wait=start - warmup, warmup=warmup, active=end - start, repeat=1),
+            on_trace_ready=self.export,
+            record_shapes=True,
+            profile_memory=True,
+            with_stack=True,
+        )
+        self.prof.start()
+        print('Profile training steps [%d, %d) into %s' % (start, end, output_dir))
+
+    def export(self, prof):
+
+        start, end = self.window
+        prefix = os.path.join(self.output_dir, 'profile-steps-%d-%d' % (start, end))
+
+        prof.export_chrome_trace('%s-trace.json' % prefix)
+
+        sort_by = 'self_cuda_time_total' if self.use_cuda else 'self_cpu_time_total'
+        key_averages = prof.key_averages()
+        with open('%s-table.txt' % prefix, 'w') as f:
+            f.write('Top operators by %s\n' % sort_by)
+            f.write(key_averages.table(sort_by=sort_by, row_limit=self.row_limit))
+            f.write('\n\nTop operators by self_cpu_memory_usage\n')
+            f.write(key_averages.table(sort_by='self_cpu_memory_usage', row_limit=self.row_limit))
+        prof.export_stacks('%s-stacks.txt' % prefix,
+                           metric='self_cuda_time_total' if self.use_cuda else 'self_cpu_time_total')
+
+        print(key_averages.table(sort_by=sort_by, row_limit=10))
+        print('Profile of steps [%d, %d) saved to %s-*' % (start, end, prefix))
+
+    def step(self):
+
+        if self.prof is None:
+            return
+        self.prof.step()
+        if self.prof.step_num >= self.window[1]:
+            self.close()
+
+    def close(self):
+
+        if self.prof is not None:
+            self.prof.stop()
+            self.prof = None
@@ -11,6 +11,8 @@ from utils.miscellaneous import progress_bar, accuracy, AverageMeter
 import time
 import numpy as np
 
+import utils.global_var as gVar
+
 class Function_BWN(torch.autograd.Function):
 
     @staticmethod
@@ -43,8 +45,88 @@ class Function_STE(torch.autograd.Function):
         # return grad_outputs.clone(), None
 
 
+class ActivationQuantizer(nn.Module):
+    """
+    Activation quantization of MetaQuantConv, (x / scale) * 0.5 + 0.5 followed by the bitA-bit STE,
+    with a tracked scale instead of max(|x|) of every call (gVar.act_quant):
+        'ema': exponential moving average of max(|x|) during training, frozen in eval
+        'calibrated': fixed scale, set by calibrate_activations (max over the calibration batches)
+    per_channel keeps one scale per input channel. Inputs beyond the scale are clamped.
+    """
+
+    def __init__(self, bitA, num_channels=1, mode='ema', per_channel=False, momentum=0.1):
+        super(ActivationQuantizer, self).__init__()
+        if mode not in ['ema', 'calibrated']:
+            raise NotImplementedError('Activation quantization mode %s is not supported' % mode)
+        self.bitA = bitA
+        self.mode = mode
+        self.per_channel = per_channel
+        self.momentum = momentum
+        self.calibrating = False
+        self.register_buffer('scale', torch.ones(num_channels if per_channel else 1))
+        self.register_buffer('initialized', torch.tensor(False))
+
+    def observe(self, x):
+        with torch.no_grad():
+            if self.per_channel:
+                return torch.abs(x).transpose(0, 1).reshape(x.shape[1], -1).max(dim=1)[0]
+            return torch.max(torch.abs(x)).view(1)
+
+    def reset(self):
+        self.scale.fill_(1)
+        self.initialized.fill_(False)
+
+    def forward(self, x):
+
+        if self.calibrating:
+            observed = self.observe(x)
+            self.scale.copy_(torch.max(self.scale, observed) if self.initialized else observed)
+            self.initialized.fill_(True)
+        elif self.training and self.mode == 'ema':
+            observed = self.observe(x)
+            self.scale.copy_((1 - self.momentum) * self.scale + self.momentum * observed if self.initialized
+                             else observed)
+            self.initialized.fill_(True)
+        elif not self.initialized:
+            raise RuntimeError('Activation scales are not calibrated, see calibrate_activations')
+
+        scale = self.scale.view(1, -1, *[1] * (x.dim() - 2)) if self.per_channel else self.scale
+        x = torch.clamp(x / scale, -1, 1) * 0.5 + 0.5
+        return 2 * Function_STE.apply(x, self.bitA) - 1
+
+
+def calibrate_activations(net, loader, quantized_type, n_batches=10, use_cuda=False):
+    """
+    Fix the scale of every ActivationQuantizer of net to the max of |x| over n_batches of loader
+    (BN statistics are left untouched)
+    :return: number of calibrated quantizers
+    """
+    quantizers = [module for module in net.modules() if isinstance(module, ActivationQuantizer)]
+    for quantizer in quantizers:
+        quantizer.reset()
+        quantizer.calibrating = True
+
+    training = net.training
+    net.eval()
+    with torch.no_grad():
+        for batch_idx, (inputs, _) in enumerate(loader):
+            if batch_idx >= n_batches:
+                break
+            if use_cuda:
+                inputs = inputs.cuda()
+            net(inputs, quantized_type)
+    net.train(training)
+
+    for quantizer in quantizers:
+        quantizer.calibrating = False
+    return len(quantizers)
+
+
 class quantized_CNN(nn.Conv2d):
 
+    # Quantized weight cached between updates of the weight, see get_quantized_weight / prepare_fast_eval
+    supports_eval_cache = True
+
     def __init__(self, in_channels, out_channels, kernel_size,
                  stride=1, padding=0, dilation=1, groups=1, bias=True, bitW = 1):
 
@@ -56,11 +138,13 @@ class quantized_CNN(nn.Conv2d):
         self.alpha = None
 
         self.quantized_grads = None
+        # (key, pre-quantized weight, quantized weight) of the last forward without gradient, see get_quantized_weight
+        self.eval_cache = None
         
         print('Initial quantized CNN with bit %d' %self.bitW)
 
-    def forward(self, input, quantized):
-
+    def quantize_weight(self, quantized):
+        """Quantized weight (STE gradient to self.weight), also kept in self.quantized_weight"""
         if quantized == 'dorefa':
             temp_weight = torch.tanh(self.weight)
             self.pre_quantized_weight = (temp_weight / torch.max(torch.abs(temp_weight)).detach()) * 0.5 + 0.5
@@ -77,13 +161,42 @@ class quantized_CNN(nn.Conv2d):
             self.quantized_weight = self.alpha.data * Function_BWN.apply(self.pre_quantized_weight)
         else:
             self.quantized_weight = self.weight * 1.0
+        return self.quantized_weight
+
+    def eval_key(self, quantized_type):
+        return (gVar.eval_version, self.weight._version, quantized_type)
+
+    def get_quantized_weight(self, quantized_type, memory_format=torch.contiguous_format):
+        """
+        Quantized weight without gradient, recomputed only when the weight changed since the last call
+        (version counter of the parameter, bumped by optimizer steps and load_state_dict) or after
+        gVar.eval_version was bumped (prepare_fast_eval). Writes through weight.data do not bump the
+        version counter: bump gVar.eval_version after them.
+        :return: pre-quantized weight and quantized weight
+        """
+        key = self.eval_key(quantized_type)
+        if self.eval_cache is None or self.eval_cache[0] != key:
+            with torch.no_grad():
+                quantized_weight = self.quantize_weight(quantized_type).contiguous(memory_format=memory_format)
+            self.eval_cache = (key, self.pre_quantized_weight, quantized_weight)
+        return self.eval_cache[1], self.eval_cache[2]
+
+    def forward(self, input, quantized):
 
+        if torch.is_grad_enabled():
+            # Quantized again on every call so that the STE gradient reaches self.weight
+            self.quantize_weight(quantized)
+        else:
+            self.pre_quantized_weight, self.quantized_weight = self.get_quantized_weight(quantized)
         return F.conv2d(input, self.quantized_weight, self.bias, self.stride,
                         self.padding, self.dilation, self.groups)
 
 
 class quantized_Linear(nn.Linear):
 
+    # Quantized weight cached between updates of the weight, see get_quantized_weight / prepare_fast_eval
+    supports_eval_cache = True
+
     def __init__(self, in_features, out_features, bias=True, bitW = 1):
         super(quantized_Linear, self).__init__(in_features, out_features, bias=bias)
 
@@ -91,10 +204,11 @@ class quantized_Linear(nn.Linear):
         self.pre_quantized_weight = None
         self.bitW = bitW
         self.alpha = None
+        self.eval_cache = None
         print('Initial quantized Linear with bit %d' % self.bitW)
 
-    def forward(self, input, quantized):
-
+    def quantize_weight(self, quantized):
+        """Quantized weight (STE gradient to self.weight), also kept in self.quantized_weight"""
         if quantized == 'dorefa':
             temp_weight = torch.tanh(self.weight)
             self.pre_quantized_weight = (temp_weight / torch.max(torch.abs(temp_weight)).detach()) * 0.5 + 0.5
@@ -105,11 +219,57 @@ class quantized_Linear(nn.Linear):
             self.quantized_weight = self.alpha.data * Function_BWN.apply(self.pre_quantized_weight)
         else:
             self.quantized_weight = self.weight.clone()
+        return self.quantized_weight
+
+    def eval_key(self, quantized_type):
+        return (gVar.eval_version, self.weight._version, quantized_type)
 
+    def get_quantized_weight(self, quantized_type, memory_format=torch.contiguous_format):
+        """See quantized_CNN.get_quantized_weight"""
+        key = self.eval_key(quantized_type)
+        if self.eval_cache is None or self.eval_cache[0] != key:
+            with torch.no_grad():
+                quantized_weight = self.quantize_weight(quantized_type).contiguous(memory_format=memory_format)
+            self.eval_cache = (key, self.pre_quantized_weight, quantized_weight)
+        return self.eval_cache[1], self.eval_cache[2]
+
+    def forward(self, input, quantized):
+
+        if torch.is_grad_enabled():
+            # Quantized again on every call so that the STE gradient reaches self.weight
+            self.quantize_weight(quantized)
+        else:
+            self.pre_quantized_weight, self.quantized_weight = self.get_quantized_weight(quantized)
         return F.linear(input, self.quantized_weight, self.bias)
 
 
-def test(net, quantized_type, test_loader, use_cuda = True, dataset_name='CIFAR10', n_batches_used=None):
+def prepare_fast_eval(net, quantized_type, channels_last=True):
+    """
+    Quantize the weight of every layer supporting it once for this evaluation (see
+    MetaQuantConv.get_quantized_weight); forward in eval mode then reuses the cached weight.
+    """
+    gVar.eval_version += 1
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+    for module in net.modules():
+        if getattr(module, 'supports_eval_cache', False):
+            if isinstance(module.weight, torch.Tensor) and module.weight.dim() == 4:
+                module.get_quantized_weight(quantized_type, memory_format=memory_format)
+            else:
+                module.get_quantized_weight(quantized_type)
+
+
+def eval_context(fast):
+    return torch.inference_mode() if fast else torch.no_grad()
+
+
+def eval_inputs(inputs, fast, channels_last=True):
+    if fast and channels_last and inputs.dim() == 4:
+        return inputs.contiguous(memory_format=torch.channels_last)
+    return inputs
+
+
+def test(net, quantized_type, test_loader, use_cuda = True, dataset_name='CIFAR10', n_batches_used=None,
+         fast=False):
     """
     Test method for baseline quantization method
     :param net:
@@ -118,9 +278,12 @@ def test(net, quantized_type, test_loader, use_cuda = True, dataset_name='CIFAR1
     :param use_cuda:
     :param dataset_name:
     :param n_batches_used:
+    :param fast: quantize the weights once (prepare_fast_eval), run under inference_mode with channels_last inputs
     :return:
     """
     net.eval()
+    if fast:
+        prepare_fast_eval(net, quantized_type)
 
     if dataset_name != 'ImageNet':
         correct = 0
@@ -129,8 +292,8 @@ def test(net, quantized_type, test_loader, use_cuda = True, dataset_name='CIFAR1
             if use_cuda:
                 inputs, targets = inputs.cuda(), targets.cuda()
 
-            with torch.no_grad():
-                outputs = net(inputs, quantized_type)
+            with eval_context(fast):
+                outputs = net(eval_inputs(inputs, fast), quantized_type)
 
             _, predicted = torch.max(outputs.data, dim=1)
             correct += predicted.eq(targets.data).cpu().sum().item()
@@ -145,12 +308,12 @@ def test(net, quantized_type, test_loader, use_cuda = True, dataset_name='CIFAR1
         top1 = AverageMeter()
         top5 = AverageMeter()
 
-        with torch.no_grad():
+        with eval_context(fast):
             end = time.time()
             for batch_idx, (inputs, targets) in enumerate(test_loader):
                 if use_cuda:
                     inputs, targets = inputs.cuda(), targets.cuda()
-                outputs = net(inputs, quantized_type)
+                outputs = net(eval_inputs(inputs, fast), quantized_type)
                 losses = nn.CrossEntropyLoss()(outputs, targets)
 
                 prec1, prec5 = accuracy(outputs.data, targets.data, topk=(1, 5))
@@ -180,5 +343,63 @@ def test(net, quantized_type, test_loader, use_cuda = True, dataset_name='CIFAR1
         return top1.avg, top5.avg
 
 
+def compare_eval_time(net, quantized_type, test_loader, use_cuda=True, n_batches=10):
+    """
+    Time n_batches of the test set through the reference evaluation and the fast one (cached
+    quantized weights, inference_mode, channels_last) and check that they predict the same classes
+    :return: seconds per batch of the reference and the fast path, fraction of identical predictions
+    """
+    net.eval()
+    batches = []
+    for batch_idx, (inputs, targets) in enumerate(test_loader):
+        if batch_idx >= n_batches:
+            break
+        batches.append(inputs.cuda() if use_cuda else inputs)
+
+    timing = dict()
+    predictions = dict()
+    for fast in [False, True]:
+        if fast:
+            prepare_fast_eval(net, quantized_type)
+        predictions[fast] = []
+        if use_cuda:
+            torch.cuda.synchronize()
+        start = time.time()
+        with eval_context(fast):
+            for inputs in batches:
+                predictions[fast].append(net(eval_inputs(inputs, fast), quantized_type).argmax(dim=1))
+        if use_cuda:
+            torch.cuda.synchronize()
+        timing[fast] = (time.time() - start) / max(len(batches), 1)
+
+    agreement = torch.cat([slow.eq(fast).float() for slow, fast in zip(predictions[False], predictions[True])]).mean()
+    return timing[False], timing[True], agreement.item()
+
+
 if __name__ == '__main__':
-    pass
\ No newline at end of file
+
+    # python -m utils.quantize [quantized_type] [n_batches]
+    # Eval time of a baseline ResNet20 with the quantized weights cached between updates, against
+    # quantizing them again on every forward (cache invalidated before every batch)
+    import sys
+    from models_CIFAR.quantized_resnet import build_quantized_resnet
+
+    quantized_type = sys.argv[1] if len(sys.argv) > 1 else 'dorefa'
+    n_batches = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    net = build_quantized_resnet('ResNet20', bitW=1).eval()
+    inputs = torch.randn(100, 3, 32, 32)
+
+    timing = dict()
+    outputs = dict()
+    for cached in [False, True]:
+        with torch.no_grad():
+            net(inputs, quantized_type)
+            start = time.time()
+            for _ in range(n_batches):
+                if not cached:
+                    gVar.eval_version += 1
+                outputs[cached] = net(inputs, quantized_type)
+            timing[cached] = (time.time() - start) / n_batches
+    print('Baseline eval of a batch of %d: %.2f ms -> %.2f ms with the weight cache (%.2fx), max difference %.2e'
+          % (inputs.shape[0], 1e3 * timing[False], 1e3 * timing[True], timing[False] / timing[True],
+             (outputs[False] - outputs[True]).abs().max().item()))
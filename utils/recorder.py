@@ -10,7 +10,7 @@ class Recorder():
     A class to record training log and write into txt file
     """
 
-    def __init__(self, SummaryPath, dataset_name, task_name = None):
+    def __init__(self, SummaryPath, dataset_name, task_name = None, resume = False):
 
         self.SummaryPath = SummaryPath
 
@@ -56,26 +56,35 @@ class Recorder():
         ###################
         # Initialize file #
         ###################
+        # Append to the existing records when resuming a run
+        mode = 'a+' if resume else 'w+'
         if self.dataset_type == 'small':
-            self.loss_record = open('%s/%sloss.txt' % (self.SummaryPath, prefix), 'w+')
-            self.train_acc_record = open('%s/%strain-acc.txt' % (self.SummaryPath, prefix), 'w+')
-            self.test_acc_record = open('%s/%stest-acc.txt' % (self.SummaryPath, prefix), 'w+')
-            self.lr_record = open('%s/%slr.txt' % (self.SummaryPath, prefix), 'w+')
-            self.epoch_best_acc_record = open('%s/%sepoch-best-acc.txt' % (self.SummaryPath, prefix), 'w+')
-            self.epoch_test_acc_record = open('%s/%sepoch-test-acc.txt' % (self.SummaryPath, prefix), 'w+')
+            self.loss_record = open('%s/%sloss.txt' % (self.SummaryPath, prefix), mode)
+            self.train_acc_record = open('%s/%strain-acc.txt' % (self.SummaryPath, prefix), mode)
+            self.test_acc_record = open('%s/%stest-acc.txt' % (self.SummaryPath, prefix), mode)
+            self.lr_record = open('%s/%slr.txt' % (self.SummaryPath, prefix), mode)
+            self.epoch_best_acc_record = open('%s/%sepoch-best-acc.txt' % (self.SummaryPath, prefix), mode)
+            self.epoch_test_acc_record = open('%s/%sepoch-test-acc.txt' % (self.SummaryPath, prefix), mode)
         else:
-            self.loss_record = open('%s/%sloss.txt' % (self.SummaryPath, prefix), 'w+')
-            self.train_top1_acc_record = open('%s/%strain-top1-acc.txt' % (self.SummaryPath, prefix), 'w+')
-            self.train_top5_acc_record = open('%s/%strain-top5-acc.txt' % (self.SummaryPath, prefix), 'w+')
-            self.test_top1_acc_record = open('%s/%stest-top1-acc.txt' % (self.SummaryPath, prefix), 'w+')
-            self.test_top5_acc_record = open('%s/%stest-top5-acc.txt' % (self.SummaryPath, prefix), 'w+')
-            self.lr_record = open('%s/%slr.txt' % (self.SummaryPath, prefix), 'w+')
-            self.epoch_best_top1_acc_record = open('%s/%sepoch-best-top1-acc.txt' % (self.SummaryPath, prefix), 'w+')
-            self.epoch_best_top5_acc_record = open('%s/%sepoch-best-top5-acc.txt' % (self.SummaryPath, prefix), 'w+')
-            self.epoch_test_top1_acc_record = open('%s/%sepoch-test-top1-acc.txt' % (self.SummaryPath, prefix), 'w+')
-            self.epoch_test_top5_acc_record = open('%s/%sepoch-test-top5-acc.txt' % (self.SummaryPath, prefix), 'w+')
-
-    def update(self, loss, acc, batch_size=0, cur_lr=1e-3, end=None, is_train = True):
+            self.loss_record = open('%s/%sloss.txt' % (self.SummaryPath, prefix), mode)
+            self.train_top1_acc_record = open('%s/%strain-top1-acc.txt' % (self.SummaryPath, prefix), mode)
+            self.train_top5_acc_record = open('%s/%strain-top5-acc.txt' % (self.SummaryPath, prefix), mode)
+            self.test_top1_acc_record = open('%s/%stest-top1-acc.txt' % (self.SummaryPath, prefix), mode)
+            self.test_top5_acc_record = open('%s/%stest-top5-acc.txt' % (self.SummaryPath, prefix), mode)
+            self.lr_record = open('%s/%slr.txt' % (self.SummaryPath, prefix), mode)
+            self.epoch_best_top1_acc_record = open('%s/%sepoch-best-top1-acc.txt' % (self.SummaryPath, prefix), mode)
+            self.epoch_best_top5_acc_record = open('%s/%sepoch-best-top5-acc.txt' % (self.SummaryPath, prefix), mode)
+            self.epoch_test_top1_acc_record = open('%s/%sepoch-test-top1-acc.txt' % (self.SummaryPath, prefix), mode)
+            self.epoch_test_top5_acc_record = open('%s/%sepoch-test-top5-acc.txt' % (self.SummaryPath, prefix), mode)
+        self.phase_time_record = open('%s/%sphase-time.txt' % (self.SummaryPath, prefix), mode)
+
+    def update(self, loss, acc, batch_size=0, cur_lr=1e-3, end=None, is_train = True, epoch=None, niter=None):
+        """
+        :param epoch, niter: for test results, the epoch / iteration they belong to when they are
+            recorded later (background evaluation); the current ones by default
+        """
+        epoch = self.epoch if epoch is None else epoch
+        niter = self.niter if niter is None else niter
 
         if is_train:
 
@@ -110,7 +119,7 @@ class Recorder():
             if self.dataset_type == 'small':
 
                 self.test_acc = acc
-                self.epoch_test_acc_record.write('%d, %.3f\n' % (self.epoch, self.test_acc))
+                self.epoch_test_acc_record.write('%d, %.3f\n' % (epoch, self.test_acc))
                 self.flush([self.epoch_test_acc_record])
 
                 if self.best_test_acc < self.test_acc:
@@ -121,14 +130,14 @@ class Recorder():
                 else:
                     self.best_test_flag = False
 
-                self.test_acc_record.write('%d, %.3f\n' % (self.niter, self.test_acc))
+                self.test_acc_record.write('%d, %.3f\n' % (niter, self.test_acc))
                 self.flush([self.test_acc_record])
 
             else:
                 # pass
                 self.test_acc_top1, self.test_acc_top5 = acc[0], acc[1]
-                self.epoch_test_top1_acc_record.write('%d, %.3f\n' % (self.epoch, self.test_acc_top1))
-                self.epoch_best_top5_acc_record.write('%d, %.3f\n' % (self.epoch, self.test_acc_top5))
+                self.epoch_test_top1_acc_record.write('%d, %.3f\n' % (epoch, self.test_acc_top1))
+                self.epoch_best_top5_acc_record.write('%d, %.3f\n' % (epoch, self.test_acc_top5))
                 self.flush([self.epoch_test_top1_acc_record, self.epoch_test_top5_acc_record])
 
                 if self.best_test_acc_top1 < self.test_acc_top1 or self.best_test_acc_top5 < self.test_acc_top5:
@@ -140,12 +149,23 @@ class Recorder():
                 else:
                     self.best_test_flag = False
 
-                self.test_top1_acc_record.write('%d, %.3f\n' % (self.niter, self.test_acc_top1))
-                self.test_top5_acc_record.write('%d, %.3f\n' % (self.niter, self.test_acc_top5))
+                self.test_top1_acc_record.write('%d, %.3f\n' % (niter, self.test_acc_top1))
+                self.test_top5_acc_record.write('%d, %.3f\n' % (niter, self.test_acc_top5))
 
                 self.flush([self.test_top1_acc_record, self.test_top5_acc_record])
 
 
+    def update_phase_time(self, phase_timer):
+        """
+        Write the wall-clock time of every training phase of the epoch
+        :param phase_timer: utils.miscellaneous.PhaseTimer accumulated over the epoch
+        """
+        self.phase_time_record.write('%d, %s\n' % (self.epoch, ', '.join(
+            '%s: %.3f' % (name, value) for name, value in phase_timer.total.items())))
+        self.flush([self.phase_time_record])
+        print('Phase time: %s' % phase_timer.summary())
+
+
     def reset_performance(self):
 
         self.train_loss = 0
@@ -170,6 +190,7 @@ class Recorder():
 
     def close(self):
 
+        self.phase_time_record.close()
         if self.dataset_type == 'small':
             self.loss_record.close()
             self.train_acc_record.close()
@@ -190,6 +211,34 @@ class Recorder():
             self.epoch_test_top5_acc_record.close()
 
 
+    def state_dict(self):
+        """Counters needed to resume the record of a run"""
+        return {
+            'train_loss': self.train_loss,
+            'niter': self.niter,
+            'test_loss': self.test_loss,
+            'smallest_training_loss': self.smallest_training_loss,
+            'stop': self.stop,
+            'epoch': self.epoch,
+            'best_test_flag': self.best_test_flag,
+            'total': self.total,
+            'n_batch': self.n_batch,
+            'test_acc': self.test_acc,
+            'best_test_acc': self.best_test_acc,
+            'ascend_count': self.ascend_count,
+            'test_acc_top1': self.test_acc_top1,
+            'test_acc_top5': self.test_acc_top5,
+            'best_test_acc_top1': self.best_test_acc_top1,
+            'best_test_acc_top5': self.best_test_acc_top5,
+        }
+
+
+    def load_state_dict(self, state_dict):
+
+        for key, value in state_dict.items():
+            setattr(self, key, value)
+
+
     def get_best_test_acc(self):
 
         if self.dataset_type == 'small':
@@ -0,0 +1,71 @@
+"""
+Key runs by a hash of their effective configuration, to reuse completed runs and resume interrupted ones
+"""
+import os
+import json
+import hashlib
+
+
+# Arguments that change where / how a run is logged or stored, not its results
+IGNORED_ARGS = [
+    'checkpoint_dir', 'break_continue', 'checkpoint_freq', 'checkpoint_incremental', 'checkpoint_keep',
+    'checkpoint_compress', 'checkpoint_downcast', 'history_backend', 'history_dir', 'phase_sync', 'profile_steps',
+    'dist_backend', 'result_cache', 'force', 'fast_eval', 'compare_eval_time', 'async_eval', 'eval_threads',
+]
+
+# Arguments that only extend the schedule of a run: a longer run resumes the checkpoint of a shorter one
+SCHEDULE_ARGS = ['n_epoch']
+
+
+def file_digest(path, chunk_size=2 ** 20):
+    """sha256 of a file, None if it does not exist"""
+    if path is None or not os.path.exists(path):
+        return None
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def canonical_config(args, ignored=IGNORED_ARGS, **extra):
+    """Effective configuration of a run: parsed arguments without bookkeeping, plus `extra` entries"""
+    config = {key: value for key, value in vars(args).items() if key not in ignored}
+    config.update(extra)
+    return config
+
+
+def config_hash(config):
+    return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class RunCache(object):
+    """
+    One JSON record per completed run in root, named by its config hash. A record is only written
+    once the run is over, so an existing record means the run can be reused as is.
+    """
+
+    def __init__(self, root):
+
+        self.root = root
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+    def path(self, key):
+        return os.path.join(self.root, '%s.json' % key)
+
+    def lookup(self, key):
+
+        if not os.path.exists(self.path(key)):
+            return None
+        with open(self.path(key)) as f:
+            record = json.load(f)
+        return record if record.get('completed', False) else None
+
+    def store(self, key, record):
+
+        record = dict(record, completed=True)
+        tmp_path = '%s.tmp' % self.path(key)
+        with open(tmp_path, 'w') as f:
+            json.dump(record, f, indent=1, default=str)
+        os.replace(tmp_path, self.path(key))
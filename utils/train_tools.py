@@ -145,7 +145,7 @@ def adjust_learning_rate(optimizer, epoch, init_lr=1e-3, decrease_epoch=5):
         param_group['lr'] = lr
 
 
-def train(_net, _train_loader, _optimizer, _criterion, _device = 'cpu', _recorder = None):
+def train(_net, _train_loader, _optimizer, _criterion, _device = 'cpu', _recorder = None, _profiler = None):
 
     _net.train()
     _train_loss = 0
@@ -175,6 +175,8 @@ def train(_net, _train_loader, _optimizer, _criterion, _device = 'cpu', _recorde
         if _recorder is not None:
             _recorder.update(loss=losses.data.item(), acc=[_correct / _total], batch_size=inputs.size(0), is_train=True)
 
+        if _profiler is not None:
+            _profiler.step()
 
     return _train_loss / (len(_train_loader)), _correct / _total
 